@@ -1,8 +1,13 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+from deep_sdf.checkpoint import *
 from deep_sdf.data import *
+from deep_sdf.distributed import *
+from deep_sdf.manifest import *
 from deep_sdf.mesh import *
 from deep_sdf.metrics.chamfer import *
+from deep_sdf.profiling import *
+from deep_sdf.reconstruct import *
 from deep_sdf.utils import *
 from deep_sdf.workspace import *
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+import torch
+
+
+def snapshot_to_cpu(obj):
+    """
+    Copies every tensor in a (nested) state dict to CPU memory, so that training
+    can keep updating the originals while the copy is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def save_atomic(obj, filename):
+    # readers either see the previous file or the complete new one
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread. save() only blocks the caller for
+    the copy to CPU memory, and for as long as max_pending checkpoints are still
+    waiting to be written.
+    """
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(max_pending)
+        self.blocked_seconds = 0.0
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, filename = item
+                save_atomic(obj, filename)
+            except Exception as e:
+                logging.error('failed to write checkpoint "{}": {}'.format(item[1], e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("checkpoint writer failed") from error
+
+    def save(self, obj, filename):
+        """
+        Queues obj to be written to filename and returns how long the caller was
+        blocked.
+        """
+        self._raise_error()
+        if self.closed:
+            raise RuntimeError("checkpoint writer is closed")
+
+        start = time.time()
+        self.queue.put((snapshot_to_cpu(obj), filename))
+        blocked = time.time() - start
+
+        self.blocked_seconds += blocked
+        return blocked
+
+    def flush(self):
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
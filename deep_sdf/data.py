@@ -1,50 +1,39 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+import collections
 import glob
 import logging
 import numpy as np
 import os
+import queue
 import random
+import threading
 import torch
 import torch.utils.data
 
+import deep_sdf.manifest
 import deep_sdf.workspace as ws
 
 
 def get_instance_filenames(data_source, split):
-    npzfiles = []
-    for dataset in split:
-        for class_name in split[dataset]:
-            for instance_name in split[dataset][class_name]:
-                instance_filename = os.path.join(
-                    dataset, class_name, instance_name + ".npz"
-                )
-                if not os.path.isfile(
-                    os.path.join(data_source, ws.sdf_samples_subdir, instance_filename)
-                ):
-                    # raise RuntimeError(
-                    #     'Requested non-existent file "' + instance_filename + "'"
-                    # )
-                    logging.warning(
-                        "Requested non-existent file '{}'".format(instance_filename)
-                    )
-                else:
-                    npzfiles += [instance_filename]
-    return npzfiles
+    return get_instance_classnames_filenames(data_source, split)[0]
+
 
 def get_instance_classnames_filenames(data_source, split):
+    # the cached listing of the class directories, rather than a stat per file
+    class_instances = deep_sdf.manifest.get_sdf_samples_manifest(data_source, split)
+
     npzfiles = []
     class_names = []
     for dataset in split:
         for class_name in split[dataset]:
+            instances = class_instances[dataset + "/" + class_name]
             for instance_name in split[dataset][class_name]:
                 instance_filename = os.path.join(
                     dataset, class_name, instance_name + ".npz"
                 )
-                if not os.path.isfile(
-                    os.path.join(data_source, ws.sdf_samples_subdir, instance_filename)
-                ):
+                if instance_name not in instances:
                     # raise RuntimeError(
                     #     'Requested non-existent file "' + instance_filename + "'"
                     # )
@@ -85,30 +74,221 @@ def remove_nans(tensor):
     return tensor[~tensor_nan, :]
 
 
-def read_sdf_samples_into_ram(filename, class_embedding=None):
-    npz = np.load(filename)
-    pos_tensor = torch.from_numpy(npz["pos"])
-    neg_tensor = torch.from_numpy(npz["neg"])
+class SdfSamplesCache:
+    """
+    A least recently used cache of decoded [pos, neg] sample tensors, keyed by
+    the path and mtime of their .npz file, which holds at most max_bytes of
+    samples. The cached tensors are shared between callers and must not be
+    modified in place.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # a row of a shared tensor the stats are mirrored to, see
+        # SdfSamplesCacheWorkerInit
+        self.shared_stats = None
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+            self._publish()
+
+    def get_stats(self):
+        with self.lock:
+            return dict(zip(sdf_samples_cache_stat_names, self._get_stat_values()))
+
+    def _get_stat_values(self):
+        return [
+            self.hits,
+            self.misses,
+            self.evictions,
+            len(self.entries),
+            self.num_bytes,
+        ]
+
+    def share_stats(self, shared_stats):
+        """
+        Mirrors the stats to shared_stats, an int64 tensor in shared memory, on
+        every load. The counters continue from the ones it already holds, e.g.
+        those of the worker it was shared with before.
+        """
+        with self.lock:
+            self.hits, self.misses, self.evictions = shared_stats[:3].tolist()
+            self.shared_stats = shared_stats
+            self._publish()
+
+    def _publish(self):
+        if self.shared_stats is not None:
+            self.shared_stats.copy_(
+                torch.tensor(self._get_stat_values(), dtype=torch.int64)
+            )
+
+    def _evict(self):
+        while self.num_bytes > self.max_bytes and len(self.entries) > 0:
+            _, (_, num_bytes) = self.entries.popitem(last=False)
+            self.num_bytes -= num_bytes
+            self.evictions += 1
+
+    def load(self, filename, filter_nans):
+        key = (os.path.abspath(filename), os.stat(filename).st_mtime_ns, filter_nans)
+
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                self._publish()
+                return list(entry[0])
+            self.misses += 1
+            self._publish()
+
+        # decoded outside of the lock, a concurrent miss just decodes twice
+        npz = np.load(filename)
+        pos_tensor = torch.from_numpy(npz["pos"])
+        neg_tensor = torch.from_numpy(npz["neg"])
+        if filter_nans:
+            pos_tensor = remove_nans(pos_tensor)
+            neg_tensor = remove_nans(neg_tensor)
+
+        num_bytes = sum(t.numel() * t.element_size() for t in [pos_tensor, neg_tensor])
+        if num_bytes <= self.max_bytes:
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = ((pos_tensor, neg_tensor), num_bytes)
+                    self.num_bytes += num_bytes
+                    self._evict()
+                    self._publish()
+
+        return [pos_tensor, neg_tensor]
+
+
+sdf_samples_cache_stat_names = ["hits", "misses", "evictions", "entries", "bytes"]
+
+# per process, every DataLoader worker holds its own cache. It is disabled
+# until it is given a size.
+sdf_samples_cache = SdfSamplesCache(0)
+
+
+def set_sdf_samples_cache_size(max_bytes):
+    sdf_samples_cache.set_max_bytes(max_bytes)
+
+
+class SdfSamplesCacheWorkerInit:
+    """
+    The worker_init_fn of a DataLoader whose workers load samples through the
+    cache. It gives the cache of every worker its share of max_bytes, which also
+    holds under the spawn start method where the workers import this module
+    anew, and mirrors the stats of every worker to a row of a shared tensor, so
+    that the main process can report them. Without workers, it is called with
+    worker 0 in the main process.
+    """
+
+    def __init__(self, max_bytes, num_workers):
+        self.worker_max_bytes = max_bytes // max(1, num_workers)
+        self.stats = torch.zeros(
+            max(1, num_workers), len(sdf_samples_cache_stat_names), dtype=torch.int64
+        ).share_memory_()
+
+    def __call__(self, worker_id):
+        set_sdf_samples_cache_size(self.worker_max_bytes)
+        sdf_samples_cache.share_stats(self.stats[worker_id])
+
+    def get_stats(self):
+        return dict(zip(sdf_samples_cache_stat_names, self.stats.sum(0).tolist()))
+
+
+def log_sdf_samples_cache_stats(cache_init=None):
+    """
+    Logs the stats of the cache of this process or, given the
+    SdfSamplesCacheWorkerInit of a DataLoader, the sum over its workers.
+    """
+    if cache_init is not None:
+        max_bytes = cache_init.worker_max_bytes
+        stats = cache_init.get_stats()
+    else:
+        max_bytes = sdf_samples_cache.max_bytes
+        stats = sdf_samples_cache.get_stats()
+    if max_bytes == 0 or stats["hits"] + stats["misses"] == 0:
+        return
+    logging.info(
+        "sample cache: {} hits, {} misses, {} evictions, {} shapes in {:.1f} MB".format(
+            stats["hits"],
+            stats["misses"],
+            stats["evictions"],
+            stats["entries"],
+            stats["bytes"] / 2 ** 20,
+        )
+    )
+
+
+def read_sdf_samples_into_ram(filename):
+    return sdf_samples_cache.load(filename, filter_nans=False)
+
+
+# quantized samples are int16 [x, y, z, sdf] rows: x, y, z in units of
+# bound / quantized_coordinate_max, the sdf as the bit pattern of a float16
+quantized_coordinate_max = 32767
+
+
+def get_quantization_bound(samples):
+    # the bounding cube of a shape's samples, in float32 like its coordinates
+    bound = max(
+        [float(torch.max(torch.abs(s[:, :3]))) for s in samples if s.numel() > 0]
+        + [0.0]
+    )
+    return float(np.float32(bound if bound > 0 else 1.0))
+
+
+def quantize_sdf_samples(samples, bound):
+    quantized = torch.empty(samples.shape, dtype=torch.int16)
+    quantized[:, :3] = torch.round(
+        torch.clamp(samples[:, :3] / bound, -1.0, 1.0) * quantized_coordinate_max
+    ).to(torch.int16)
+    quantized[:, 3] = samples[:, 3].to(torch.float16).view(torch.int16)
+    return quantized
 
-    if class_embedding is not None:
-        class_index = class_embedding
-        one_hot_vector = torch.zeros((pos_tensor.shape[0], 9))
-        one_hot_vector[:, class_index] = 1
-        pos_tensor = torch.cat((pos_tensor, one_hot_vector), dim=1)
 
-        class_index = class_embedding
-        one_hot_vector = torch.zeros((neg_tensor.shape[0], 9))
-        one_hot_vector[:, class_index] = 1
-        neg_tensor = torch.cat((neg_tensor, one_hot_vector), dim=1)
-    return [pos_tensor, neg_tensor]
+def dequantize_sdf_samples(quantized, bound):
+    """
+    Dequantize int16 [..., 4] samples, with a bound that is either a number or a
+    tensor broadcasting against [..., 1].
+    """
+    samples = torch.empty(quantized.shape, dtype=torch.float32)
+    samples[..., :3] = quantized[..., :3].float() * (bound / quantized_coordinate_max)
+    samples[..., 3] = quantized[..., 3].contiguous().view(torch.float16).float()
+    return samples
+
+
+def get_quantization_error_bound(bound, max_abs_sdf):
+    """
+    The largest possible absolute error of the coordinates and of the sdf of
+    samples quantized with the given bound: half a coordinate step, and half a
+    float16 ulp of the largest sdf.
+    """
+    # plus float32 rounding: x / bound and its scaling to steps in quantize,
+    # the step size and the product in dequantize each add up to bound * 2 ** -24
+    return (
+        bound / quantized_coordinate_max / 2 + 4 * bound * 2.0 ** -24,
+        max(max_abs_sdf * 2.0 ** -11, 2.0 ** -25),
+    )
 
 
 def unpack_sdf_samples(filename, subsample=None):
-    npz = np.load(filename)
     if subsample is None:
-        return npz
-    pos_tensor = remove_nans(torch.from_numpy(npz["pos"]))
-    neg_tensor = remove_nans(torch.from_numpy(npz["neg"]))
+        return np.load(filename)
+    pos_tensor, neg_tensor = sdf_samples_cache.load(filename, filter_nans=True)
 
     # split the sample into half
     half = int(subsample / 2)
@@ -124,8 +304,253 @@ def unpack_sdf_samples(filename, subsample=None):
     return samples
 
 
-def unpack_sdf_samples_from_ram(data, subsample=None):
+def pack_sdf_samples(
+    data_source, split, packed_samples, dtype=np.float32, quantize=False
+):
+    """
+    Write the NaN-free SDF samples of every shape in a split into a single
+    contiguous file of [x, y, z, sdf] rows, plus an index holding the
+    (pos start, neg start, end) row offsets of each shape. The rows of each shape
+    are shuffled once while packing, like SDFSamples does with load_ram.
+    With quantize, the rows are stored as int16 quantized over the bounding cube
+    of each shape, whose size is kept in the index, and the largest error is
+    logged.
+    """
+    npzfiles, class_names = get_instance_classnames_filenames(data_source, split)
+
+    data_filename, index_filename = ws.get_packed_samples_filenames(packed_samples)
+
+    offsets = np.zeros((len(npzfiles), 3), dtype=np.int64)
+    bounds = np.ones(len(npzfiles), dtype=np.float32)
+    head = 0
+
+    max_error = np.zeros(2)
+    max_error_bound = np.zeros(2)
+
+    with open(data_filename, "wb") as f:
+        for i, npzfile in enumerate(npzfiles):
+            logging.debug("packing {}".format(npzfile))
+
+            npz = np.load(os.path.join(data_source, ws.sdf_samples_subdir, npzfile))
+
+            shape_samples = []
+            for key in ["pos", "neg"]:
+                samples = npz[key]
+                samples = samples[~np.isnan(samples[:, 3])]
+                shape_samples.append(samples[np.random.permutation(samples.shape[0])])
+
+            if quantize:
+                shape_samples = [torch.from_numpy(s) for s in shape_samples]
+                bounds[i] = get_quantization_bound(shape_samples)
+
+            offsets[i, 0] = head
+            for j, samples in enumerate(shape_samples):
+                if quantize:
+                    quantized = quantize_sdf_samples(samples, float(bounds[i]))
+                    error = torch.abs(
+                        dequantize_sdf_samples(quantized, float(bounds[i])) - samples
+                    )
+                    if error.numel() > 0:
+                        max_error = np.maximum(
+                            max_error,
+                            [float(error[:, :3].max()), float(error[:, 3].max())],
+                        )
+                        max_error_bound = np.maximum(
+                            max_error_bound,
+                            get_quantization_error_bound(
+                                float(bounds[i]), float(samples[:, 3].abs().max())
+                            ),
+                        )
+                    quantized.numpy().tofile(f)
+                else:
+                    samples.astype(dtype).tofile(f)
+
+                head += samples.shape[0]
+                offsets[i, j + 1] = head
+
+    if quantize:
+        dtype = np.int16
+        logging.info(
+            "largest quantization error: {} (bound {}) in xyz, {} (bound {}) in sdf".format(
+                max_error[0], max_error_bound[0], max_error[1], max_error_bound[1]
+            )
+        )
+
+    np.savez(
+        index_filename,
+        offsets=offsets,
+        filenames=np.array(npzfiles, dtype=str),
+        classnames=np.array(class_names, dtype=str),
+        dtype=np.dtype(dtype).str,
+        bounds=bounds,
+    )
+
+    return head
+
+
+def load_packed_sdf_samples_index(packed_samples, split=None):
+    """
+    Read the index of a packed sample store. If a split is given, only its shapes
+    are returned, in split order. The bounds are None unless the samples are
+    quantized.
+    """
+    index = np.load(ws.get_packed_samples_filenames(packed_samples)[1])
+
+    offsets = index["offsets"]
+    npzfiles = index["filenames"].tolist()
+    class_names = index["classnames"].tolist()
+    dtype = np.dtype(str(index["dtype"]))
+
+    bounds = None
+    if dtype == np.int16:
+        bounds = index["bounds"]
+
+    if split is None:
+        return offsets, npzfiles, class_names, dtype, bounds
+
+    rows = {npzfile: i for i, npzfile in enumerate(npzfiles)}
+    selected = []
+    for dataset in split:
+        for class_name in split[dataset]:
+            for instance_name in split[dataset][class_name]:
+                instance_filename = os.path.join(
+                    dataset, class_name, instance_name + ".npz"
+                )
+                if instance_filename not in rows:
+                    logging.warning(
+                        "Requested file '{}' is not in packed samples '{}'".format(
+                            instance_filename, packed_samples
+                        )
+                    )
+                else:
+                    selected.append(rows[instance_filename])
+
+    return (
+        offsets[selected],
+        [npzfiles[i] for i in selected],
+        [class_names[i] for i in selected],
+        dtype,
+        bounds[selected] if bounds is not None else None,
+    )
+
+
+def open_packed_sdf_samples(packed_samples, dtype):
+    data_filename = ws.get_packed_samples_filenames(packed_samples)[0]
+    return np.memmap(data_filename, dtype=dtype, mode="r").reshape(-1, 4)
+
+
+def concatenate_sdf_samples(shapes):
+    """
+    Concatenate the [pos, neg] sample tensors of several shapes into one flat
+    [num_rows, 4] buffer, plus the (pos start, neg start, end) row offsets of each
+    shape, the layout of packed samples.
+    """
+    offsets = np.zeros((len(shapes), 3), dtype=np.int64)
+    head = 0
+    for i, (pos_tensor, neg_tensor) in enumerate(shapes):
+        offsets[i] = (
+            head,
+            head + pos_tensor.shape[0],
+            head + pos_tensor.shape[0] + neg_tensor.shape[0],
+        )
+        head = offsets[i, 2]
+
+    samples = torch.cat([tensor for shape in shapes for tensor in shape], 0)
+
+    return samples, offsets
+
+
+def sample_sdf_rows(offsets, subsample, generator=None):
+    """
+    Draw the rows of subsample / 2 positive and as many negative samples for every
+    shape of a [num_shapes, 3] offsets table at once. Returns the row indices as a
+    [num_shapes, 2 * (subsample / 2)] tensor, positive rows first.
+    """
+    offsets = torch.as_tensor(offsets, dtype=torch.int64)
+
+    # split the sample into half
+    half = int(subsample / 2)
+
+    starts = offsets[:, :2].unsqueeze(-1)
+    counts = (offsets[:, 1:] - offsets[:, :2]).unsqueeze(-1)
+
+    uniform = torch.rand((offsets.shape[0], 2, half), generator=generator)
+
+    return (starts + (uniform * counts).long()).view(offsets.shape[0], 2 * half)
+
+
+def gather_sdf_rows(samples, rows, bounds=None):
+    """
+    Gather the [num_shapes, n] given rows of a flat sample buffer, either a tensor
+    or a (mapped) numpy array, into a float32 tensor of shape [num_shapes, n, 4].
+    Quantized samples are dequantized with the bounds of the num_shapes shapes,
+    only the gathered rows.
+    """
+    flat_rows = rows.reshape(-1)
+
+    if torch.is_tensor(samples):
+        gathered = torch.index_select(samples, 0, flat_rows)
+    else:
+        # read the mapped pages in file order, then restore the sampled order
+        flat_rows = flat_rows.numpy()
+        order = np.argsort(flat_rows)
+        gathered = np.empty(
+            (flat_rows.shape[0], 4),
+            dtype=samples.dtype if bounds is not None else np.float32,
+        )
+        gathered[order] = samples[flat_rows[order]]
+        gathered = torch.from_numpy(gathered)
+
+    gathered = gathered.view(tuple(rows.shape) + (4,))
+
+    if bounds is not None:
+        bounds = torch.as_tensor(bounds, dtype=torch.float32).view(-1, 1, 1)
+        return dequantize_sdf_samples(gathered, bounds)
+
+    return gathered.float()
+
+
+def unpack_sdf_samples_from_packed(samples, offsets, subsample=None, bound=None):
+    pos_start, neg_start, end = (int(o) for o in offsets)
+
     if subsample is None:
+        if bound is not None:
+            return [
+                dequantize_sdf_samples(torch.as_tensor(samples[start:end]), bound)
+                for start, end in [(pos_start, neg_start), (neg_start, end)]
+            ]
+        return [
+            torch.as_tensor(np.asarray(samples[pos_start:neg_start], np.float32)),
+            torch.as_tensor(np.asarray(samples[neg_start:end], np.float32)),
+        ]
+
+    return gather_sdf_rows(
+        samples,
+        sample_sdf_rows(offsets[None], subsample),
+        None if bound is None else [bound],
+    )[0]
+
+
+def quantize_sdf_samples_in_ram(data):
+    """
+    Quantize the [pos, neg] samples of a shape to [pos, neg, bound], which
+    unpack_sdf_samples_from_ram dequantizes as they are sampled.
+    """
+    bound = get_quantization_bound(data[:2])
+    return [
+        quantize_sdf_samples(data[0], bound),
+        quantize_sdf_samples(data[1], bound),
+        bound,
+    ]
+
+
+def unpack_sdf_samples_from_ram(data, subsample=None, generator=None):
+    # quantized shapes carry their bound as a third element
+    bound = data[2] if len(data) > 2 else None
+
+    if subsample is None:
+        if bound is not None:
+            return [dequantize_sdf_samples(t, bound) for t in data[:2]]
         return data
     pos_tensor = data[0]
     neg_tensor = data[1]
@@ -133,14 +558,17 @@ def unpack_sdf_samples_from_ram(data, subsample=None):
     # split the sample into half
     half = int(subsample / 2)
 
-    random_pos = (torch.rand(half) * pos_tensor.shape[0]).long()
-    random_neg = (torch.rand(half) * neg_tensor.shape[0]).long()
+    random_pos = (torch.rand(half, generator=generator) * pos_tensor.shape[0]).long()
+    random_neg = (torch.rand(half, generator=generator) * neg_tensor.shape[0]).long()
 
     sample_pos = torch.index_select(pos_tensor, 0, random_pos)
     sample_neg = torch.index_select(neg_tensor, 0, random_neg)
 
     samples = torch.cat([sample_pos, sample_neg], 0)
 
+    if bound is not None:
+        samples = dequantize_sdf_samples(samples, bound)
+
     return samples
 
 
@@ -154,14 +582,34 @@ class SDFSamples(torch.utils.data.Dataset):
         print_filename=False,
         num_files=1000000,
         class_embedding = [],
-        use_class_embedding = False
+        use_class_embedding = False,
+        packed_samples=None,
+        share_memory=False,
+        quantize=False,
+        contiguous_windows=False,
     ):
         self.subsample = subsample
         self.class_embedding = class_embedding
         self.data_source = data_source
-        self.npyfiles, self.classnames = get_instance_classnames_filenames(data_source, split)
         self.use_class_embedding = use_class_embedding
-        
+        self.packed_samples = packed_samples
+
+        if packed_samples is not None:
+            (
+                self.packed_offsets,
+                self.npyfiles,
+                self.classnames,
+                self.packed_dtype,
+                self.packed_bounds,
+            ) = load_packed_sdf_samples_index(packed_samples, split)
+            # mapped lazily, so that every DataLoader worker maps the file itself
+            self.packed_data = None
+            data_source = packed_samples
+        else:
+            self.npyfiles, self.classnames = get_instance_classnames_filenames(
+                data_source, split
+            )
+
         logging.info(
             "using "
             + str(len(self.npyfiles))
@@ -169,47 +617,428 @@ class SDFSamples(torch.utils.data.Dataset):
             + data_source
         )
 
-        self.load_ram = load_ram
+        # numpy string arrays instead of lists of Python strings, whose refcount
+        # updates would copy their pages into every forked DataLoader worker
+        self.npyfiles = np.array(self.npyfiles, dtype=str)
+        self.classnames = np.array(self.classnames, dtype=str)
+
+        self.load_ram = load_ram and packed_samples is None
+
+        # slices of the shuffled in-RAM samples instead of random rows
+        self.contiguous_windows = contiguous_windows and self.load_ram
+        if contiguous_windows and not self.load_ram:
+            logging.warning("contiguous windows require samples loaded into RAM")
+        self.share_memory = share_memory
+        self.window_cursors = None
+        self.window_orders = None
+        # while workers share the samples, every pass over a shape's samples
+        # takes these blocks of a window in an order of its own
+        self.window_block_size = max(1, int(subsample / 2) // 8) if subsample else 1
+
+        # the class of every scene, which the decoder expands into its class
+        # columns, rather than class columns in every sample
+        if self.use_class_embedding:
+            self.class_indices = np.array(
+                [self.class_embedding[c] for c in self.classnames], dtype=np.int64
+            )
 
-        if load_ram:
-            self.loaded_data = []
+        if self.load_ram:
+            loaded_data = []
             for f in self.npyfiles:
                 filename = os.path.join(self.data_source, ws.sdf_samples_subdir, f)
                 npz = np.load(filename)
                 pos_tensor = remove_nans(torch.from_numpy(npz["pos"]))
                 neg_tensor = remove_nans(torch.from_numpy(npz["neg"]))
-                                
-                self.loaded_data.append(
-                    [
-                        pos_tensor[torch.randperm(pos_tensor.shape[0])],
-                        neg_tensor[torch.randperm(neg_tensor.shape[0])],
-                    ]
+
+                shape_data = [
+                    pos_tensor[torch.randperm(pos_tensor.shape[0])],
+                    neg_tensor[torch.randperm(neg_tensor.shape[0])],
+                ]
+                if quantize:
+                    # half the memory, sampled rows are dequantized per batch
+                    shape_data = quantize_sdf_samples_in_ram(shape_data)
+                loaded_data.append(shape_data)
+
+            self.ram_bounds = None
+            if quantize:
+                self.ram_bounds = np.array(
+                    [shape_data[2] for shape_data in loaded_data], dtype=np.float32
                 )
 
+            # one flat buffer, so that whole batches are drawn with a single gather
+            self.ram_samples, self.ram_offsets = concatenate_sdf_samples(
+                [shape_data[:2] for shape_data in loaded_data]
+            )
+            del loaded_data
+
+            if share_memory:
+                # DataLoader workers attach to the buffer instead of copying it,
+                # whichever start method they are created with
+                self.ram_samples.share_memory_()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.packed_samples is not None:
+            state["packed_data"] = None
+        state["window_cursors"] = None
+        state["window_orders"] = None
+        return state
+
     def __len__(self):
         return len(self.npyfiles)
 
-    def __getitem__(self, idx):
-        filename = os.path.join(
-            self.data_source, ws.sdf_samples_subdir, self.npyfiles[idx]
+    def supports_batches(self):
+        # whole batches can be drawn when all samples are in (mapped) memory
+        return self.subsample is not None and (
+            self.load_ram or self.packed_samples is not None
         )
-        if self.load_ram:
-            npz = unpack_sdf_samples_from_ram(self.loaded_data[idx], self.subsample)
-            if self.use_class_embedding:
-                # One hot encoded class embedding
-                class_index = self.class_embedding[self.classnames[idx]]
-                one_hot_vector = torch.zeros((npz.shape[0], 9))
-                one_hot_vector[:, class_index] = 1
-                npz = torch.cat((npz, one_hot_vector), dim=1)
-            return (
-                npz,
-                idx,
+
+    def _get_resident_samples(self):
+        if self.packed_samples is not None:
+            if self.packed_data is None:
+                self.packed_data = open_packed_sdf_samples(
+                    self.packed_samples, self.packed_dtype
+                )
+            return self.packed_data, self.packed_offsets, self.packed_bounds
+        return self.ram_samples, self.ram_offsets, self.ram_bounds
+
+    def sample_batch(self, indices):
+        """
+        Subsample all scenes of a batch at once, returning a
+        [len(indices), subsample, 4] tensor and the indices as a tensor.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+
+        if self.contiguous_windows:
+            return self.sample_windows(indices), indices
+
+        samples, offsets, bounds = self._get_resident_samples()
+        batch = gather_sdf_rows(
+            samples,
+            sample_sdf_rows(offsets[indices.numpy()], self.subsample),
+            None if bounds is None else bounds[indices.numpy()],
+        )
+
+        return batch, indices
+
+    def _get_window_cursors(self):
+        # every process, i.e. every DataLoader worker, keeps cursors of its own,
+        # which start at their own random rotations of the samples so that
+        # workers do not draw the same windows
+        if self.window_cursors is None or self.window_cursors_pid != os.getpid():
+            self.window_rng = np.random.RandomState(torch.initial_seed() % 2 ** 32)
+            counts = self.ram_offsets[:, 1:] - self.ram_offsets[:, :2]
+            self.window_rotations = (
+                self.window_rng.rand(*counts.shape) * counts
+            ).astype(np.int64)
+            self.window_cursors = np.zeros(counts.shape, dtype=np.int64)
+            self.window_orders = {}
+            self.window_cursors_pid = os.getpid()
+        return self.window_cursors
+
+    def _start_window_pass(self, idx, side, start, count):
+        if not self.share_memory:
+            segment = self.ram_samples[start : start + count]
+            segment.copy_(segment[torch.randperm(count)])
+            return
+        # other workers read the shared buffer concurrently, so the pass takes
+        # the full blocks of a new rotation of the samples in a random order of
+        # this worker's own, followed by the remaining rows
+        self.window_rotations[idx, side] = self.window_rng.randint(count)
+        self.window_orders[idx, side] = self.window_rng.permutation(
+            count // self.window_block_size
+        ).astype(np.int32)
+
+    def _next_window(self, idx, side, half):
+        """
+        Returns the next half rows of the pos (side 0) or neg (side 1) samples of
+        a shape as (first row, number of rows) slices, and advances its cursor.
+        Every pass over the samples of a shape takes each of them once, starting
+        at a rotation of them; a window that reaches the end of a pass continues
+        with the next one. Each pass reshuffles the samples in place, or, while
+        DataLoader workers share them, takes the blocks of window_block_size
+        rows of a new random rotation of them in a new random order.
+        """
+        cursors = self._get_window_cursors()
+        start = int(self.ram_offsets[idx, side])
+        count = int(self.ram_offsets[idx, side + 1]) - start
+
+        if self.share_memory and (idx, side) not in self.window_orders:
+            self._start_window_pass(idx, side, start, count)
+
+        slices = []
+        while half > 0:
+            cursor = int(cursors[idx, side])
+            if cursor == count:
+                self._start_window_pass(idx, side, start, count)
+                cursor = 0
+
+            length = min(half, count - cursor)
+            position = cursor
+            if self.share_memory:
+                order = self.window_orders[idx, side]
+                block, offset = divmod(cursor, self.window_block_size)
+                if block < len(order):
+                    length = min(length, self.window_block_size - offset)
+                    position = int(order[block]) * self.window_block_size + offset
+            first = (int(self.window_rotations[idx, side]) + position) % count
+            if first + length > count:
+                slices.append((start + first, count - first))
+                slices.append((start, first + length - count))
+            else:
+                slices.append((start + first, length))
+
+            cursors[idx, side] = cursor + length
+            half -= length
+
+        return slices
+
+    def sample_windows(self, indices):
+        """
+        Subsample the scenes of a batch like sample_batch, but with contiguous
+        windows of the shuffled pos and neg samples of each scene, which are
+        copied as one to a few slices each rather than gathered row by row.
+        """
+        half = int(self.subsample / 2)
+        samples = self.ram_samples
+
+        batch = samples.new_empty((len(indices), 2 * half, 4))
+        for i, idx in enumerate(indices.tolist()):
+            for side in range(2):
+                start, end = (int(o) for o in self.ram_offsets[idx, side : side + 2])
+                if end - start < half:
+                    # too few samples for a window, repeat them
+                    rows = start + torch.arange(half) % (end - start)
+                    window = torch.index_select(samples, 0, rows)
+                    batch[i, side * half : (side + 1) * half] = window
+                    continue
+                head = side * half
+                for first, length in self._next_window(idx, side, half):
+                    batch[i, head : head + length] = samples[first : first + length]
+                    head += length
+
+        if self.ram_bounds is not None:
+            bounds = torch.from_numpy(self.ram_bounds[indices.numpy()]).view(-1, 1, 1)
+            return dequantize_sdf_samples(batch, bounds)
+
+        return batch.float()
+
+    def __getitem__(self, idx):
+        # a list of indices, as yielded by a BatchSampler, gives a whole batch
+        if not isinstance(idx, int) and not np.isscalar(idx):
+            return self.sample_batch(idx)
+
+        if self.supports_batches():
+            batch, _ = self.sample_batch([idx])
+            return batch[0], idx
+
+        if self.packed_samples is not None or self.load_ram:
+            samples, offsets, bounds = self._get_resident_samples()
+            npz = unpack_sdf_samples_from_packed(
+                samples,
+                offsets[idx],
+                self.subsample,
+                None if bounds is None else float(bounds[idx]),
             )
         else:
+            filename = os.path.join(
+                self.data_source, ws.sdf_samples_subdir, self.npyfiles[idx]
+            )
             npz = unpack_sdf_samples(filename, self.subsample)
-            if self.use_class_embedding:
-                class_index = self.class_embedding[self.classnames[idx]]
-                one_hot_vector = torch.zeros((npz.shape[0], 9))
-                one_hot_vector[:, class_index] = 1
-                npz = torch.cat((npz, one_hot_vector), dim=1)
-            return npz, idx
+
+        return npz, idx
+
+
+def _read_into(f, array):
+    view = memoryview(array.reshape(-1).view(np.uint8))
+    head = 0
+    while head < len(view):
+        num_read = f.readinto(view[head:])
+        if not num_read:
+            raise Exception('unexpected end of file "{}"'.format(f.name))
+        head += num_read
+
+
+class StreamingSDFSamples(torch.utils.data.IterableDataset):
+    """
+    Streams the shapes of a packed sample store for training sets that do not fit
+    into RAM. Every epoch, the shapes of this rank (every world_size-th scene, as
+    with SceneShardSampler) are split into shards of shard_size shapes that are
+    adjacent in the file. The shards are read in a random order, one shape per
+    sequential read, by a background thread, into a pool of at most pool_size
+    shapes, and every batch takes batch_size random shapes out of the pool.
+    Memory therefore stays at about pool_size + prefetch shapes, whatever the
+    size of the split. Yields whole [batch_size, subsample, 4] batches together
+    with their scene indices, like SDFSamples.sample_batch.
+    """
+
+    def __init__(
+        self,
+        packed_samples,
+        split,
+        subsample,
+        batch_size,
+        pool_size=256,
+        shard_size=64,
+        prefetch=32,
+        num_workers=0,
+        class_embedding=[],
+        use_class_embedding=False,
+        rank=0,
+        world_size=1,
+        seed=0,
+    ):
+        self.packed_samples = packed_samples
+        self.subsample = subsample
+        self.batch_size = batch_size
+        self.pool_size = pool_size
+        self.shard_size = shard_size
+        self.prefetch = prefetch
+        self.num_workers = num_workers
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+
+        (
+            self.offsets,
+            npyfiles,
+            classnames,
+            self.dtype,
+            self.bounds,
+        ) = load_packed_sdf_samples_index(packed_samples, split)
+
+        logging.info(
+            "streaming {} shapes from {}".format(len(npyfiles), packed_samples)
+        )
+
+        self.npyfiles = np.array(npyfiles, dtype=str)
+        self.classnames = np.array(classnames, dtype=str)
+
+        if use_class_embedding:
+            self.class_indices = np.array(
+                [class_embedding[c] for c in self.classnames], dtype=np.int64
+            )
+
+    def __len__(self):
+        return len(self.npyfiles)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_shards(self, rank, worker_id, num_workers):
+        scenes = np.arange(rank, len(self.npyfiles), self.world_size)
+        scenes = scenes[np.argsort(self.offsets[scenes, 0], kind="stable")]
+
+        shards = [
+            scenes[i : i + self.shard_size]
+            for i in range(0, scenes.shape[0], self.shard_size)
+        ]
+
+        # the same order in all workers of a rank, which split it between them
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(shards))
+
+        return [shards[i] for i in order[worker_id :: max(num_workers, 1)]]
+
+    def get_num_batches(self):
+        """
+        The number of batches that every rank can yield this epoch, i.e. the
+        smallest number of full batches among the ranks, which distributed
+        training has to stop at so that all ranks take the same steps.
+        """
+        return min(
+            sum(
+                sum(len(shard) for shard in self.get_shards(r, w, self.num_workers))
+                // self.batch_size
+                for w in range(max(self.num_workers, 1))
+            )
+            for r in range(self.world_size)
+        )
+
+    def _read_shapes(self, shards, shapes, stop):
+        row_bytes = 4 * self.dtype.itemsize
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    shapes.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        try:
+            data_filename = ws.get_packed_samples_filenames(self.packed_samples)[0]
+            with open(data_filename, "rb", buffering=0) as f:
+                for shard in shards:
+                    for idx in shard:
+                        start, neg_start, end = (int(o) for o in self.offsets[idx])
+                        rows = np.empty((end - start, 4), dtype=self.dtype)
+                        if f.tell() != start * row_bytes:
+                            f.seek(start * row_bytes)
+                        _read_into(f, rows)
+                        put((int(idx), rows, neg_start - start))
+                        if stop.is_set():
+                            return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def _sample_batch(self, shapes):
+        indices = torch.tensor([idx for idx, _, _ in shapes], dtype=torch.int64)
+
+        batch = []
+        for idx, rows, num_pos in shapes:
+            offsets = np.array([[0, num_pos, rows.shape[0]]], dtype=np.int64)
+            batch.append(
+                gather_sdf_rows(
+                    torch.from_numpy(rows),
+                    sample_sdf_rows(offsets, self.subsample),
+                    None if self.bounds is None else self.bounds[[idx]],
+                )
+            )
+
+        return torch.cat(batch, 0), indices
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            shards = self.get_shards(self.rank, 0, 1)
+        else:
+            shards = self.get_shards(self.rank, worker_info.id, worker_info.num_workers)
+
+        shapes = queue.Queue(self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(
+            target=self._read_shapes, args=(shards, shapes, stop), daemon=True
+        )
+        reader.start()
+
+        try:
+            pool = []
+            batch = []
+            exhausted = False
+            while True:
+                # top the pool up with the shapes read in the meantime
+                while not exhausted and len(pool) < self.pool_size:
+                    shape = shapes.get()
+                    if shape is None:
+                        exhausted = True
+                    elif isinstance(shape, Exception):
+                        raise shape
+                    else:
+                        pool.append(shape)
+
+                if len(pool) == 0:
+                    break
+
+                j = int(torch.randint(len(pool), (1,)))
+                pool[j], pool[-1] = pool[-1], pool[j]
+                batch.append(pool.pop())
+
+                if len(batch) == self.batch_size:
+                    yield self._sample_batch(batch)
+                    batch = []
+        finally:
+            stop.set()
+            reader.join()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import logging
+import math
+import os
+import torch
+import torch.distributed as dist
+import torch.utils.data as data_utils
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def launched_distributed():
+    # set by torchrun and by spawn_distributed
+    return int(os.environ.get("WORLD_SIZE", 1)) > 1
+
+
+def init_distributed(device):
+    """
+    Joins the process group described by the torchrun environment variables and
+    returns the device of this rank: gloo for CPU training, nccl with one GPU per
+    local rank otherwise.
+    """
+    if device.type == "cuda":
+        device = torch.device("cuda", int(os.environ.get("LOCAL_RANK", 0)))
+        torch.cuda.set_device(device)
+        backend = "nccl"
+    else:
+        backend = "gloo"
+
+    dist.init_process_group(backend)
+
+    logging.info(
+        "rank {} of {} on {} ({})".format(get_rank(), get_world_size(), device, backend)
+    )
+
+    return device
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def _spawned_worker(rank, world_size, function, args):
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    function(*args)
+
+
+def spawn_distributed(function, args, nprocs):
+    """
+    Runs function(*args) in nprocs local processes that form one process group,
+    for single machine training without torchrun.
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    torch.multiprocessing.spawn(
+        _spawned_worker, args=(nprocs, function, args), nprocs=nprocs
+    )
+
+
+def get_num_shard_rows(num_rows, rank, world_size):
+    return len(range(rank, num_rows, world_size))
+
+
+def get_shard_rows(global_indices, world_size):
+    # scene i is owned by rank i % world_size, as row i // world_size
+    return global_indices // world_size
+
+
+class SceneShardSampler(data_utils.distributed.DistributedSampler):
+    """
+    A DistributedSampler whose ranks always see the same scenes, every
+    world_size-th one, so that each rank only has to hold the latent codes of its
+    own shard. The shard is reshuffled every epoch.
+    """
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0):
+        super().__init__(dataset, num_replicas, rank, shuffle, seed)
+        if len(self.dataset) < self.num_replicas:
+            raise Exception(
+                "cannot shard {} scenes over {} ranks".format(
+                    len(self.dataset), self.num_replicas
+                )
+            )
+
+    def __iter__(self):
+        indices = torch.arange(self.rank, len(self.dataset), self.num_replicas)
+
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch + self.rank)
+            indices = indices[torch.randperm(len(indices), generator=g)]
+
+        indices = indices.tolist()
+
+        # shards differ by at most one scene, every rank takes the same number of
+        # steps
+        indices += indices[: self.num_samples - len(indices)]
+
+        return iter(indices)
+
+
+def gather_shard_rows(local_rows, num_rows):
+    """
+    Gathers the rows of a table sharded by scene index, returning the full
+    [num_rows, ...] table on every rank.
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return local_rows
+
+    max_rows = int(math.ceil(num_rows / world_size))
+    padded = local_rows.new_zeros((max_rows,) + tuple(local_rows.shape[1:]))
+    padded[: local_rows.shape[0]] = local_rows
+
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+
+    # [world_size, max_rows, ...] -> row r * world_size + rank
+    table = torch.stack(gathered, 1).reshape((-1,) + tuple(local_rows.shape[1:]))
+    return table[:num_rows]
+
+
+def shard_rows(rows):
+    return rows[get_rank() :: get_world_size()]
+
+
+def all_reduce_mean(tensor):
+    if not is_distributed():
+        return tensor
+    tensor = tensor.clone()
+    dist.all_reduce(tensor)
+    return tensor / get_world_size()
+
+
+def get_mean_sharded_latent_magnitude(latent_vectors):
+    norms = torch.norm(latent_vectors.weight.data.detach(), dim=1)
+    if not is_distributed():
+        return torch.mean(norms)
+    total = torch.stack([norms.sum(), norms.new_tensor(norms.shape[0])])
+    dist.all_reduce(total)
+    return total[0] / total[1]
+
+
+def _get_group_param_state(optimizer_state, group):
+    param_id = optimizer_state["param_groups"][group]["params"][0]
+    return param_id, optimizer_state["state"].get(param_id, None)
+
+
+def gather_sharded_optimizer_state(optimizer_state, num_rows, group):
+    """
+    Replaces the per-row state (e.g. Adam's moments) of the sharded parameter in
+    the given param group by the full table, as saved by a single process run.
+    """
+    param_id, param_state = _get_group_param_state(optimizer_state, group)
+    if param_state is None or get_world_size() == 1:
+        return optimizer_state
+
+    # the state dict shares its per-parameter dicts with the optimizer
+    param_state = dict(param_state)
+    for key, value in param_state.items():
+        if torch.is_tensor(value) and value.dim() > 0:
+            param_state[key] = gather_shard_rows(value, num_rows)
+    optimizer_state["state"][param_id] = param_state
+
+    return optimizer_state
+
+
+def shard_optimizer_state(optimizer_state, group):
+    param_id, param_state = _get_group_param_state(optimizer_state, group)
+    if param_state is None or get_world_size() == 1:
+        return optimizer_state
+
+    for key, value in param_state.items():
+        if torch.is_tensor(value) and value.dim() > 0:
+            param_state[key] = shard_rows(value).clone()
+
+    return optimizer_state
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import json
+import logging
+import os
+
+import deep_sdf.workspace as ws
+
+manifest_version = 2
+
+
+def get_sdf_samples_manifest_filename(data_source):
+    return os.path.join(
+        data_source, ws.sdf_samples_subdir, ws.sdf_samples_manifest_filename
+    )
+
+
+def scan_class_directory(class_dir):
+    """
+    Lists the instance names of the .npz files of a class directory with a single
+    os.scandir.
+    """
+    with os.scandir(class_dir) as entries:
+        return sorted(
+            entry.name[: -len(".npz")]
+            for entry in entries
+            if entry.name.endswith(".npz") and entry.is_file()
+        )
+
+
+def load_sdf_samples_manifest(data_source):
+    try:
+        with open(get_sdf_samples_manifest_filename(data_source), "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+
+    if manifest is None or manifest.get("version", None) != manifest_version:
+        manifest = {"version": manifest_version, "classes": {}}
+
+    return manifest
+
+
+def save_sdf_samples_manifest(data_source, manifest):
+    filename = get_sdf_samples_manifest_filename(data_source)
+    tmp_filename = "{}.{}.tmp".format(filename, os.getpid())
+    try:
+        with open(tmp_filename, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_filename, filename)
+    except OSError as e:
+        # e.g. a read-only data source, the manifest is rebuilt next time
+        logging.warning('could not write manifest "{}": {}'.format(filename, e))
+
+
+def get_sdf_samples_manifest(data_source, split):
+    """
+    Returns the set of instance names in every class directory of a split, keyed
+    by "<dataset>/<class_name>". The listing of each class directory is cached in
+    the data source's SdfSamples/.manifest.json and only rescanned when the mtime
+    of the directory changes, i.e. when files are added, removed or renamed, so
+    that resolving a split only takes one stat per class directory.
+    """
+    samples_dir = os.path.join(data_source, ws.sdf_samples_subdir)
+
+    manifest = load_sdf_samples_manifest(data_source)
+    changed = False
+
+    class_instances = {}
+    for dataset in split:
+        for class_name in split[dataset]:
+            key = dataset + "/" + class_name
+            class_dir = os.path.join(samples_dir, dataset, class_name)
+
+            try:
+                mtime = os.stat(class_dir).st_mtime_ns
+            except FileNotFoundError:
+                class_instances[key] = set()
+                continue
+
+            cached = manifest["classes"].get(key, None)
+            if cached is None or cached["mtime"] != mtime:
+                logging.debug("scanning {}".format(class_dir))
+                cached = {"mtime": mtime, "instances": scan_class_directory(class_dir)}
+                manifest["classes"][key] = cached
+                changed = True
+
+            class_instances[key] = set(cached["instances"])
+
+    if changed:
+        save_sdf_samples_manifest(data_source, manifest)
+
+    return class_instances
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+import concurrent.futures
+import itertools
 import logging
+import multiprocessing
 import numpy as np
-import plyfile
 import skimage.measure
 import time
 import torch
@@ -12,66 +14,392 @@ import deep_sdf.utils
 
 
 def create_mesh(
-    decoder, latent_vec, filename, N=256, max_batch=32 ** 3, offset=None, scale=None, class_embedding=None
+    decoder, latent_vec, filename, N=256, max_batch=None, offset=None, scale=None, class_embedding=None,
+    octree_levels=0, write_normals=False, precision="fp32", quantize=False,
+    volume_dtype=torch.float32,
 ):
     start = time.time()
     ply_filename = filename
 
+    deep_sdf.utils.check_mesh_decoder(decoder)
+
+    # with quantize, the decoder is converted on every call, callers meshing
+    # several times pass the int8 decoder from get_mesh_decoder instead
+    decoder = deep_sdf.utils.get_mesh_decoder(decoder, quantize, precision)
+
     decoder.eval()
 
+    device = deep_sdf.utils.get_module_device(decoder)
+    if max_batch is None:
+        max_batch = deep_sdf.utils.get_default_max_batch(device)
+    if latent_vec is not None:
+        latent_vec = latent_vec.to(device)
+
     # NOTE: the voxel_origin is actually the (bottom, left, down) corner, not the middle
     voxel_origin = [-1, -1, -1]
     voxel_size = 2.0 / (N - 1)
 
-    overall_index = torch.arange(0, N ** 3, 1, out=torch.LongTensor())
-    samples = torch.zeros(N ** 3, 4)
-
-    # transform first 3 columns
-    # to be the x, y, z index
-    samples[:, 2] = overall_index % N
-    samples[:, 1] = (overall_index.long() / N) % N
-    samples[:, 0] = ((overall_index.long() / N) / N) % N
-
-    # transform first 3 columns
-    # to be the x, y, z coordinate
-    samples[:, 0] = (samples[:, 0] * voxel_size) + voxel_origin[2]
-    samples[:, 1] = (samples[:, 1] * voxel_size) + voxel_origin[1]
-    samples[:, 2] = (samples[:, 2] * voxel_size) + voxel_origin[0]
+    if octree_levels > 0:
+        with deep_sdf.utils.autocast(device, precision):
+            sdf_values = sample_sdf_grid_coarse_to_fine(
+                decoder,
+                latent_vec,
+                N,
+                voxel_origin,
+                voxel_size,
+                max_batch,
+                class_embedding,
+                octree_levels,
+                volume_dtype,
+            )
+
+        end = time.time()
+        print("sampling takes: %f" % (end - start))
+
+        convert_sdf_samples_to_ply(
+            sdf_values,
+            voxel_origin,
+            voxel_size,
+            ply_filename + ".ply",
+            offset,
+            scale,
+            write_normals,
+        )
+        return
 
     num_samples = N ** 3
 
-    samples.requires_grad = False
+    # the grid points of every chunk are generated from their flat indices, so
+    # only the SDF volume is held for the whole grid
+    sdf_values = torch.empty(num_samples, dtype=volume_dtype)
 
     head = 0
 
     while head < num_samples:
-        sample_subset = samples[head : min(head + max_batch, num_samples), 0:3].cuda()
+        tail = min(head + max_batch, num_samples)
+        sample_subset = get_grid_points(head, tail, N, voxel_origin, voxel_size, device)
         if class_embedding is not None:
-            class_embedding_vec = class_embedding.repeat(sample_subset.shape[0], 1).cuda()
+            class_embedding_vec = class_embedding.repeat(sample_subset.shape[0], 1).to(device)
             sample_subset = torch.cat((sample_subset, class_embedding_vec), dim=1)
 
-        samples[head : min(head + max_batch, num_samples), 3] = (
-            deep_sdf.utils.decode_sdf(decoder, latent_vec, sample_subset)
-            .squeeze(1)
-            .detach()
-            .cpu()
-        )
-        head += max_batch
+        with deep_sdf.utils.autocast(device, precision):
+            sdf = deep_sdf.utils.decode_sdf(decoder, latent_vec, sample_subset)
+        sdf_values[head:tail] = sdf.squeeze(1).detach().cpu()
+        head = tail
 
-    sdf_values = samples[:, 3]
     sdf_values = sdf_values.reshape(N, N, N)
 
     end = time.time()
     print("sampling takes: %f" % (end - start))
 
     convert_sdf_samples_to_ply(
-        sdf_values.data.cpu(),
+        sdf_values,
         voxel_origin,
         voxel_size,
         ply_filename + ".ply",
         offset,
         scale,
+        write_normals,
+    )
+
+
+def create_meshes(
+    decoder,
+    latent_vecs,
+    filenames,
+    N=256,
+    max_batch=None,
+    offsets=None,
+    scales=None,
+    class_embeddings=None,
+    write_normals=False,
+    precision="fp32",
+    quantize=False,
+    volume_dtype=torch.float32,
+    shapes_per_batch=8,
+    num_workers=4,
+):
+    """
+    Mesh a list of shapes as create_mesh does for one. Every decoder call takes
+    the same grid chunk of up to shapes_per_batch shapes as a B x S batch, and
+    the volumes of every batch are handed to marching cubes in num_workers
+    processes (or run in place if it is 0) while the next shapes are decoded.
+    offsets, scales and class_embeddings hold an entry per shape, or are None.
+    """
+    start = time.time()
+
+    deep_sdf.utils.check_mesh_decoder(decoder)
+
+    # with quantize, the decoder is converted on every call, callers meshing
+    # several times pass the int8 decoder from get_mesh_decoder instead
+    decoder = deep_sdf.utils.get_mesh_decoder(decoder, quantize, precision)
+
+    decoder.eval()
+
+    device = deep_sdf.utils.get_module_device(decoder)
+    if max_batch is None:
+        max_batch = deep_sdf.utils.get_default_max_batch(device)
+
+    voxel_origin = [-1, -1, -1]
+    voxel_size = 2.0 / (N - 1)
+    num_samples = N ** 3
+    num_shapes = len(filenames)
+
+    executor = None
+    if num_workers > 0:
+        # forked workers would inherit a CUDA context they cannot use
+        executor = concurrent.futures.ProcessPoolExecutor(
+            num_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    # at most one batch of volumes waits for marching cubes besides the running ones
+    max_pending = max(num_workers, shapes_per_batch)
+    pending = []
+
+    try:
+        for first in range(0, num_shapes, shapes_per_batch):
+            shapes = range(first, min(first + shapes_per_batch, num_shapes))
+
+            latents = torch.stack([latent_vecs[i].reshape(-1) for i in shapes])
+            latents = latents.to(device)
+            classes = None
+            if class_embeddings is not None:
+                classes = torch.stack([class_embeddings[i].reshape(-1) for i in shapes])
+                classes = classes.to(device, latents.dtype)
+
+            volumes = torch.empty(len(shapes), num_samples, dtype=volume_dtype)
+            chunk_size = max(1, max_batch // len(shapes))
+
+            head = 0
+
+            while head < num_samples:
+                tail = min(head + chunk_size, num_samples)
+                xyz = get_grid_points(head, tail, N, voxel_origin, voxel_size, device)
+                inputs = [
+                    latents.unsqueeze(1).expand(-1, tail - head, -1),
+                    xyz.unsqueeze(0).expand(len(shapes), -1, -1),
+                ]
+                if classes is not None:
+                    inputs.append(classes.unsqueeze(1).expand(-1, tail - head, -1))
+
+                with deep_sdf.utils.autocast(device, precision):
+                    sdf = decoder(torch.cat(inputs, 2))
+                volumes[:, head:tail] = sdf.squeeze(2).detach().cpu()
+                head = tail
+
+            logging.debug(
+                "sampled shapes {} to {} in {} s".format(
+                    first, shapes[-1], time.time() - start
+                )
+            )
+
+            for k, i in enumerate(shapes):
+                args = (
+                    voxel_origin,
+                    voxel_size,
+                    filenames[i] + ".ply",
+                    None if offsets is None else offsets[i],
+                    None if scales is None else scales[i],
+                    write_normals,
+                )
+                if executor is None:
+                    convert_sdf_samples_to_ply(volumes[k].reshape(N, N, N), *args)
+                else:
+                    pending.append(
+                        executor.submit(
+                            _convert_sdf_volume_to_ply,
+                            volumes[k].reshape(N, N, N).numpy(),
+                            *args
+                        )
+                    )
+
+            pending = _wait_for_meshes(pending, max_pending)
+
+        _wait_for_meshes(pending, 0)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    logging.debug("meshed {} shapes in {} s".format(num_shapes, time.time() - start))
+
+
+def _convert_sdf_volume_to_ply(numpy_3d_sdf_array, *args):
+    convert_sdf_samples_to_ply(torch.from_numpy(numpy_3d_sdf_array), *args)
+
+
+def _wait_for_meshes(pending, max_pending):
+    # raises the errors of finished meshes
+    while len(pending) > max_pending:
+        done, not_done = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED
+        )
+        for future in done:
+            future.result()
+        pending = list(not_done)
+    return pending
+
+
+def get_grid_points(start, end, N, voxel_origin, voxel_size, device=None):
+    """
+    The coordinates of the points start to end - 1 of an N x N x N grid, in the
+    order of its flattened (x, y, z) voxel indices, as an M x 3 tensor.
+    """
+    index = torch.arange(start, end, device=device)
+    grid_indices = torch.stack([index // (N * N), (index // N) % N, index % N], 1)
+    origin = torch.tensor(
+        [voxel_origin[2], voxel_origin[1], voxel_origin[0]], device=device
     )
+    return grid_indices.float() * voxel_size + origin
+
+
+def decode_sdf_grid_points(
+    decoder,
+    latent_vec,
+    grid_indices,
+    voxel_origin,
+    voxel_size,
+    max_batch,
+    class_embedding=None,
+):
+    """
+    Evaluate the decoder at the grid points given by an M x 3 tensor of
+    (x, y, z) voxel indices, in chunks of max_batch points.
+    """
+    num_samples = grid_indices.shape[0]
+    origin = torch.tensor([voxel_origin[2], voxel_origin[1], voxel_origin[0]])
+
+    device = deep_sdf.utils.get_module_device(decoder)
+
+    sdf_values = torch.zeros(num_samples)
+
+    head = 0
+
+    while head < num_samples:
+        sample_subset = (
+            grid_indices[head : min(head + max_batch, num_samples)].float()
+            * voxel_size
+            + origin
+        ).to(device)
+        if class_embedding is not None:
+            class_embedding_vec = class_embedding.repeat(sample_subset.shape[0], 1).to(device)
+            sample_subset = torch.cat((sample_subset, class_embedding_vec), dim=1)
+
+        sdf_values[head : min(head + max_batch, num_samples)] = (
+            deep_sdf.utils.decode_sdf(decoder, latent_vec, sample_subset)
+            .squeeze(1)
+            .detach()
+            .cpu()
+        )
+        head += max_batch
+
+    return sdf_values
+
+
+def get_grid_axis(N, stride):
+    axis = torch.arange(0, N, stride)
+    if axis[-1] != N - 1:
+        axis = torch.cat([axis, torch.tensor([N - 1])])
+    return axis
+
+
+def sample_sdf_grid_coarse_to_fine(
+    decoder,
+    latent_vec,
+    N,
+    voxel_origin,
+    voxel_size,
+    max_batch,
+    class_embedding=None,
+    levels=3,
+    volume_dtype=torch.float32,
+):
+    """
+    Sample the SDF on an N x N x N grid, starting from a grid with a spacing of
+    2 ** levels voxels. Cells with a corner closer to the surface than the cell
+    diagonal, or with a sign change, are refined until the full resolution is
+    reached. All other grid points get the sign of their cell, with the smallest
+    absolute corner value of the cell as magnitude.
+    """
+    sdf_values = torch.zeros(N, N, N, dtype=volume_dtype)
+    evaluated = torch.zeros(N, N, N, dtype=torch.bool)
+
+    def evaluate(mask, axis):
+        grid_indices = axis[torch.nonzero(mask)]
+        sdf_values[
+            grid_indices[:, 0], grid_indices[:, 1], grid_indices[:, 2]
+        ] = decode_sdf_grid_points(
+            decoder,
+            latent_vec,
+            grid_indices,
+            voxel_origin,
+            voxel_size,
+            max_batch,
+            class_embedding,
+        ).to(volume_dtype)
+        evaluated[grid_indices[:, 0], grid_indices[:, 1], grid_indices[:, 2]] = True
+        return grid_indices.shape[0]
+
+    stride = 2 ** levels
+    axis = get_grid_axis(N, stride)
+    num_evaluated = evaluate(
+        torch.ones(len(axis), len(axis), len(axis), dtype=torch.bool), axis
+    )
+
+    while stride > 1:
+        n = len(axis)
+
+        corner_values = sdf_values[axis][:, axis][:, :, axis]
+        corner_values = torch.stack(
+            [
+                corner_values[i : n - 1 + i, j : n - 1 + j, k : n - 1 + k]
+                for i, j, k in itertools.product((0, 1), repeat=3)
+            ]
+        )
+        min_abs = corner_values.abs().min(0)[0]
+        sign_change = (corner_values.max(0)[0] > 0) & (corner_values.min(0)[0] < 0)
+
+        cell_sizes = (axis[1:] - axis[:-1]).float() * voxel_size
+        cell_diagonals = torch.sqrt(
+            cell_sizes[:, None, None] ** 2
+            + cell_sizes[None, :, None] ** 2
+            + cell_sizes[None, None, :] ** 2
+        )
+        keep = sign_change | (min_abs < cell_diagonals)
+
+        # fill the grid points of skipped cells which are not evaluated yet
+        cell = (torch.searchsorted(axis, torch.arange(N), right=True) - 1).clamp(
+            0, n - 2
+        )
+        fill_values = torch.sign(corner_values[0]) * min_abs
+        fill_mask = ~keep[cell][:, cell][:, :, cell] & ~evaluated
+        sdf_values[fill_mask] = fill_values[cell][:, cell][:, :, cell][fill_mask]
+
+        # evaluate the grid points of the next level which lie in kept cells;
+        # points on a cell boundary belong to the cells on both sides
+        stride //= 2
+        fine_axis = get_grid_axis(N, stride)
+        upper_cell = (
+            torch.searchsorted(axis, fine_axis, right=True) - 1
+        ).clamp(0, n - 2)
+        lower_cell = upper_cell - (
+            (axis[upper_cell] == fine_axis) & (upper_cell > 0)
+        ).long()
+
+        needed = torch.zeros(
+            len(fine_axis), len(fine_axis), len(fine_axis), dtype=torch.bool
+        )
+        for cx, cy, cz in itertools.product((lower_cell, upper_cell), repeat=3):
+            needed |= keep[cx][:, cy][:, :, cz]
+        needed &= ~evaluated[fine_axis][:, fine_axis][:, :, fine_axis]
+
+        num_evaluated += evaluate(needed, fine_axis)
+
+        axis = fine_axis
+
+    logging.debug(
+        "evaluated the decoder at {} of {} grid points".format(num_evaluated, N ** 3)
+    )
+
+    return sdf_values
 
 
 def convert_sdf_samples_to_ply(
@@ -81,19 +409,24 @@ def convert_sdf_samples_to_ply(
     ply_filename_out,
     offset=None,
     scale=None,
+    write_normals=False,
 ):
     """
     Convert sdf samples to .ply
 
-    :param pytorch_3d_sdf_tensor: a torch.FloatTensor of shape (n,n,n)
+    :param pytorch_3d_sdf_tensor: a float32 or float16 tensor of shape (n,n,n)
     :voxel_grid_origin: a list of three floats: the bottom, left, down origin of the voxel grid
     :voxel_size: float, the size of the voxels
     :ply_filename_out: string, path of the filename to save to
+    :write_normals: bool, if set the vertex normals of marching cubes are saved as well
 
     This function adapted from: https://github.com/RobotLocomotion/spartan
     """
     start_time = time.time()
 
+    # marching cubes takes float32 or float64 volumes
+    if pytorch_3d_sdf_tensor.dtype == torch.float16:
+        pytorch_3d_sdf_tensor = pytorch_3d_sdf_tensor.float()
     numpy_3d_sdf_tensor = pytorch_3d_sdf_tensor.numpy()
 
     verts, faces, normals, values = skimage.measure.marching_cubes(
@@ -115,28 +448,53 @@ def convert_sdf_samples_to_ply(
 
     # try writing to the ply file
 
-    num_verts = verts.shape[0]
-    num_faces = faces.shape[0]
-
-    verts_tuple = np.zeros((num_verts,), dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
-
-    for i in range(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
-
-    faces_building = []
-    for i in range(0, num_faces):
-        faces_building.append(((faces[i, :].tolist(),)))
-    faces_tuple = np.array(faces_building, dtype=[("vertex_indices", "i4", (3,))])
-
-    el_verts = plyfile.PlyElement.describe(verts_tuple, "vertex")
-    el_faces = plyfile.PlyElement.describe(faces_tuple, "face")
-
-    ply_data = plyfile.PlyData([el_verts, el_faces])
     logging.debug("saving mesh to %s" % (ply_filename_out))
-    ply_data.write(ply_filename_out)
+    write_ply(
+        ply_filename_out,
+        mesh_points,
+        faces,
+        normals if write_normals else None,
+    )
 
     logging.debug(
         "converting to ply format and writing to file took {} s".format(
             time.time() - start_time
         )
     )
+
+
+def write_ply(ply_filename_out, vertices, faces, normals=None):
+    """
+    Write a triangle mesh as binary little-endian .ply straight from numpy buffers
+
+    :param vertices: array of shape (v, 3), written as float
+    :param faces: array of shape (f, 3) of vertex indices, written as a list of int
+    :param normals: optional array of shape (v, 3), written as float nx, ny, nz
+    """
+    vertex_properties = ["x", "y", "z"]
+    if normals is not None:
+        vertex_properties += ["nx", "ny", "nz"]
+
+    vertex_data = np.empty((vertices.shape[0], len(vertex_properties)), dtype="<f4")
+    vertex_data[:, 0:3] = vertices
+    if normals is not None:
+        vertex_data[:, 3:6] = normals
+
+    face_data = np.empty(
+        faces.shape[0], dtype=[("count", "u1"), ("vertex_indices", "<i4", (3,))]
+    )
+    face_data["count"] = 3
+    face_data["vertex_indices"] = faces
+
+    header = (
+        ["ply", "format binary_little_endian 1.0"]
+        + ["element vertex {}".format(vertices.shape[0])]
+        + ["property float {}".format(name) for name in vertex_properties]
+        + ["element face {}".format(faces.shape[0])]
+        + ["property list uchar int vertex_indices", "end_header"]
+    )
+
+    with open(ply_filename_out, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        f.write(vertex_data.tobytes())
+        f.write(face_data.tobytes())
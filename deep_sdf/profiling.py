@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import logging
+import time
+import torch
+
+
+class StepProfiler:
+    """
+    Splits the time of every training step into phases. Each call to mark(phase)
+    charges the time since the previous mark to that phase, after waiting for
+    the device, so that asynchronous CUDA work is charged to the phase that
+    launched it. This synchronization slows training down, which is why the
+    profiler is opt-in; when disabled, all methods return immediately.
+    """
+
+    phases = ("data_wait", "h2d", "forward", "backward", "optimizer")
+
+    def __init__(self, device, enabled=False):
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.steps = []
+        self._current = None
+        self._last = None
+
+    def _now(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def begin_epoch(self):
+        if not self.enabled:
+            return
+        self.steps = []
+        self._current = dict.fromkeys(self.phases, 0.0)
+        self._last = self._now()
+
+    def mark(self, phase):
+        if not self.enabled:
+            return
+        now = self._now()
+        self._current[phase] += now - self._last
+        self._last = now
+
+    def end_step(self, num_samples):
+        if not self.enabled:
+            return
+        step = self._current
+        step["num_samples"] = num_samples
+        step["samples_per_second"] = num_samples / max(
+            sum(step[p] for p in self.phases), 1e-12
+        )
+        self.steps.append(step)
+
+        logging.debug(
+            "step: "
+            + ", ".join("{} {:.2f}ms".format(p, step[p] * 1e3) for p in self.phases)
+            + ", {:.0f} samples/s".format(step["samples_per_second"])
+        )
+
+        self._current = dict.fromkeys(self.phases, 0.0)
+
+    def summarize_epoch(self):
+        """
+        Returns the mean time of every phase per step and the throughput over
+        the steps of the epoch, or None if there is nothing to report.
+        """
+        if not self.enabled or len(self.steps) == 0:
+            return None
+
+        num_steps = len(self.steps)
+        summary = {
+            p: sum(step[p] for step in self.steps) / num_steps for p in self.phases
+        }
+        total = sum(summary[p] for p in self.phases)
+        summary["samples_per_second"] = sum(
+            step["num_samples"] for step in self.steps
+        ) / max(total * num_steps, 1e-12)
+
+        logging.info(
+            "mean step {:.2f}ms: ".format(total * 1e3)
+            + ", ".join(
+                "{} {:.0f}%".format(p, 100 * summary[p] / max(total, 1e-12))
+                for p in self.phases
+            )
+            + ", {:.0f} samples/s".format(summary["samples_per_second"])
+        )
+
+        return summary
+
+
+def get_trace_profiler(device, trace_dir, num_steps, skip_steps=5):
+    """
+    Returns a torch.profiler context which skips the first skip_steps training
+    steps, warms up for one and then traces num_steps steps into trace_dir, in
+    the format read by TensorBoard and chrome://tracing. Advance it with step()
+    after every training step.
+    """
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.device(device).type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(
+            wait=skip_steps, warmup=1, active=num_steps, repeat=1
+        ),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True,
+    )
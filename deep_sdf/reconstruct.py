@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import logging
+import math
+import torch
+
+import deep_sdf.data
+import deep_sdf.utils
+
+
+def reconstruct_batch(
+    decoder,
+    num_iterations,
+    latent_size,
+    test_sdfs,
+    stat,
+    clamp_dist,
+    num_samples=30000,
+    lr=5e-4,
+    l2reg=False,
+    class_embeddings=None,
+    generators=None,
+    precision="fp32",
+):
+    """
+    Fit the latent codes of K shapes concurrently. The codes are optimized as a
+    single K x latent_size tensor, with one decoder call per iteration over the
+    K x num_samples points, a loss per shape and a learning rate schedule and
+    Adam state per shape, so shapes do not influence each other's codes.
+
+    :param test_sdfs: list of K [pos, neg] sample tensors, see read_sdf_samples_into_ram
+    :param stat: std. dev. of the initial codes, or an (empirical mean, variance) pair
+    :param lr: initial learning rate, for all shapes or as a list of K
+    :param class_embeddings: optional K x E tensor, appended to the xyz of each shape
+    :param generators: optional list of K torch.Generator, one per shape, which
+        draw its initial code and samples. With these, a shape is reconstructed
+        the same way no matter which shapes it is batched with.
+    :param precision: the precision of the decoder's forward pass, see
+        deep_sdf.utils.autocast. The codes, the loss and Adam stay in fp32.
+    :return: the final losses as a numpy array of K and the K x latent_size codes
+    """
+
+    decreased_by = 10
+    adjust_lr_every = int(num_iterations / 2)
+
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+
+    num_shapes = len(test_sdfs)
+    device = next(decoder.parameters()).device
+
+    if generators is None:
+        generators = [None] * num_shapes
+
+    latents = []
+    for generator in generators:
+        if type(stat) == type(0.1):
+            latent = torch.ones(1, latent_size).normal_(
+                mean=0, std=stat, generator=generator
+            )
+        else:
+            latent = torch.normal(
+                stat[0].detach().cpu(), stat[1].detach().cpu(), generator=generator
+            )
+        latents.append(latent.view(1, latent_size))
+    latent = torch.cat(latents, 0).to(device)
+
+    latent.requires_grad = True
+
+    if isinstance(lr, (list, tuple)):
+        initial_lr = torch.tensor(lr, dtype=torch.float32, device=device).view(-1, 1)
+    else:
+        initial_lr = torch.full((num_shapes, 1), lr, device=device)
+
+    exp_avg = torch.zeros_like(latent)
+    exp_avg_sq = torch.zeros_like(latent)
+
+    if class_embeddings is not None:
+        class_embeddings = class_embeddings.to(device)
+
+    loss_scale = 2.0 ** 12 if precision == "fp16" else 1.0
+
+    decoder.eval()
+
+    for e in range(num_iterations):
+
+        sdf_data = torch.stack(
+            [
+                deep_sdf.data.unpack_sdf_samples_from_ram(
+                    test_sdf, num_samples, generator
+                )
+                for test_sdf, generator in zip(test_sdfs, generators)
+            ]
+        ).to(device)
+        xyz = sdf_data[:, :, 0:3]
+        sdf_gt = torch.clamp(sdf_data[:, :, 3:4], -clamp_dist, clamp_dist)
+
+        if class_embeddings is not None:
+            xyz = torch.cat(
+                [xyz, class_embeddings.unsqueeze(1).expand(-1, xyz.shape[1], -1)], 2
+            )
+
+        inputs = torch.cat(
+            [latent.unsqueeze(1).expand(-1, xyz.shape[1], -1), xyz], 2
+        )
+
+        # one scene per shape, for decoders which attend among its points
+        with deep_sdf.utils.autocast(device, precision):
+            pred_sdf = decoder(inputs)
+        pred_sdf = pred_sdf.float().view(num_shapes, -1, 1)
+        pred_sdf = torch.clamp(pred_sdf, -clamp_dist, clamp_dist)
+
+        loss = torch.mean(torch.abs(pred_sdf - sdf_gt), dim=(1, 2))
+        if l2reg:
+            loss = loss + 1e-4 * torch.mean(latent.pow(2), dim=1)
+
+        # the codes are independent, so the gradient of the summed loss with
+        # respect to a code is the gradient of that shape's own loss
+        # with a static scale, so that small fp16 gradients do not underflow
+        (grad,) = torch.autograd.grad(loss.sum() * loss_scale, latent)
+        grad = grad / loss_scale
+
+        with torch.no_grad():
+            lr_e = initial_lr * ((1 / decreased_by) ** (e // adjust_lr_every))
+
+            # Adam, as in torch.optim.Adam, with a learning rate per shape
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            bias_correction1 = 1 - beta1 ** (e + 1)
+            bias_correction2 = 1 - beta2 ** (e + 1)
+            denom = (exp_avg_sq.sqrt() / math.sqrt(bias_correction2)).add_(eps)
+            latent.sub_((lr_e / bias_correction1) * exp_avg / denom)
+
+        if e % 50 == 0:
+            logging.debug(loss.detach().cpu().numpy())
+            logging.debug(e)
+            logging.debug(latent.detach().norm(dim=1))
+
+    return loss.detach().cpu().numpy(), latent.detach()
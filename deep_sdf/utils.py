@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+import copy
 import logging
 import torch
 
@@ -29,6 +30,238 @@ def add_common_args(arg_parser):
     )
 
 
+def add_device_args(arg_parser):
+    arg_parser.add_argument(
+        "--device",
+        dest="device",
+        default=None,
+        help="The device to run on, e.g. 'cpu', 'cuda' or 'cuda:1'. If unset, the "
+        + "\"Device\" of the experiment specifications is used, and otherwise cuda "
+        + "if it is available.",
+    )
+
+
+def get_device(device=None, specs=None):
+    if device is None and specs is not None:
+        device = specs.get("Device", None)
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+precisions = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def add_precision_args(arg_parser):
+    arg_parser.add_argument(
+        "--precision",
+        dest="precision",
+        default=None,
+        choices=list(precisions.keys()),
+        help="The precision of the decoder's forward pass, run under autocast. If "
+        + "unset, the \"Precision\" of the experiment specifications is used, and "
+        + "otherwise fp32.",
+    )
+
+
+def get_precision(precision=None, specs=None):
+    if precision is None and specs is not None:
+        precision = specs.get("Precision", None)
+    if precision is None:
+        precision = "fp32"
+    if precision not in precisions:
+        raise Exception(
+            'unknown precision "{}", expected one of {}'.format(
+                precision, ", ".join(precisions.keys())
+            )
+        )
+    return precision
+
+
+def autocast(device, precision):
+    """
+    A context which runs the matrix multiplications of the decoder in the given
+    precision, while the parameters and everything outside of it stay in fp32.
+    """
+    return torch.autocast(
+        device_type=torch.device(device).type,
+        dtype=precisions[precision],
+        enabled=precision != "fp32",
+    )
+
+
+compile_modes = ("none", "compile", "script")
+
+
+def add_compile_args(arg_parser):
+    arg_parser.add_argument(
+        "--compile",
+        dest="compile",
+        default=None,
+        choices=compile_modes,
+        help="Compile the decoder with torch.compile, or script its per-point "
+        + "forward pass with TorchScript. If unset, the \"CompileDecoder\" of the "
+        + "experiment specifications is used, and otherwise none.",
+    )
+
+
+def get_compile_mode(mode=None, specs=None):
+    if mode is None and specs is not None:
+        mode = specs.get("CompileDecoder", None)
+    # "CompileDecoder" : true is torch.compile
+    if mode is None or mode is False:
+        mode = "none"
+    elif mode is True:
+        mode = "compile"
+    if mode not in compile_modes:
+        raise Exception(
+            'unknown compile mode "{}", expected one of {}'.format(
+                mode, ", ".join(compile_modes)
+            )
+        )
+    return mode
+
+
+def compile_decoder(decoder, mode):
+    """
+    Compiles a (data parallel) decoder in place, either with torch.compile, or by
+    scripting its layers with TorchScript. The parameters and state dict keys of
+    the decoder stay the same, so it is saved and loaded as before.
+    """
+    module = decoder.module if hasattr(decoder, "module") else decoder
+
+    if mode == "script":
+        if not hasattr(module, "script_layers"):
+            raise Exception(
+                "{} does not support TorchScript".format(type(module).__name__)
+            )
+        module.script_layers()
+    elif mode == "compile":
+        if not hasattr(module, "compile"):
+            raise Exception("compiling the decoder requires torch.compile")
+        module.compile()
+
+    return decoder
+
+
+def add_quantize_args(arg_parser):
+    arg_parser.add_argument(
+        "--quantize",
+        dest="quantize",
+        default=False,
+        action="store_true",
+        help="If set, meshes are extracted on the CPU with an int8 copy of the "
+        + "decoder, whose linear layers are dynamically quantized.",
+    )
+
+
+def quantize_decoder(decoder):
+    """
+    Returns an int8 copy of a (data parallel) decoder on the CPU, for inference
+    only. The weight norm of its layers is folded first, then every linear layer
+    is dynamically quantized with per-channel weight scales, while activations
+    are quantized per batch as they come.
+    """
+    module = decoder.module if hasattr(decoder, "module") else decoder
+
+    if isinstance(module, torch.jit.ScriptModule):
+        raise Exception("cannot quantize an exported decoder, quantize the checkpoint")
+
+    if hasattr(module, "fold_for_inference"):
+        module = module.fold_for_inference()
+    else:
+        module = copy.deepcopy(module).eval()
+
+    return torch.ao.quantization.quantize_dynamic(
+        module.cpu(),
+        {torch.nn.Linear: torch.ao.quantization.per_channel_dynamic_qconfig},
+        dtype=torch.qint8,
+    )
+
+
+def get_mesh_decoder(decoder, quantize=False, precision="fp32"):
+    """
+    The decoder to extract meshes with: the decoder itself, or its int8 copy from
+    quantize_decoder. Callers meshing many shapes convert it once for all of them.
+    """
+    if not quantize:
+        return decoder
+    if precision != "fp32":
+        raise Exception("a quantized decoder runs in int8, not {}".format(precision))
+    return quantize_decoder(decoder)
+
+
+def get_set_attention(decoder):
+    """
+    Returns "group" or "scene" if points attend to other points in a layer of a
+    (data parallel, folded, quantized or scripted) decoder, else None.
+    """
+    module = decoder.module if hasattr(decoder, "module") else decoder
+    layers = getattr(getattr(module, "plan", None), "layers", None)
+    if layers is None:
+        return None
+    for layer in layers.children():
+        transformer = getattr(layer, "transformer", None)
+        if getattr(layer, "use_transformer", False) and transformer is not None:
+            attention = getattr(transformer, "attention", "point")
+            if attention != "point":
+                return attention
+    return None
+
+
+def check_mesh_decoder(decoder):
+    # a grid chunk is decoded as one scene, so its points would attend to each
+    # other and the SDF would depend on how the grid is chunked
+    attention = get_set_attention(decoder)
+    if attention is not None:
+        raise Exception(
+            "cannot extract meshes with a decoder using {} attention, whose SDF "
+            "depends on the points decoded together".format(attention)
+        )
+
+
+def add_mesh_batch_args(arg_parser):
+    arg_parser.add_argument(
+        "--mesh_batch",
+        dest="shapes_per_batch",
+        default=8,
+        type=int,
+        help="The number of shapes whose SDF grids are decoded together.",
+    )
+    arg_parser.add_argument(
+        "--mesh_workers",
+        dest="mesh_workers",
+        default=4,
+        type=int,
+        help="The number of processes running marching cubes on finished SDF "
+        + "grids while the next shapes are decoded, 0 runs it in place.",
+    )
+
+
+def add_sample_cache_args(arg_parser):
+    arg_parser.add_argument(
+        "--sample_cache_mb",
+        dest="sample_cache_mb",
+        default=0,
+        type=float,
+        help="The size in MB of the cache of decoded SDF samples, so that shapes "
+        + "read more than once are only decoded once. 0 disables it.",
+    )
+
+
+def get_module_device(module):
+    for param in module.parameters():
+        return param.device
+    return torch.device("cpu")
+
+
+def get_default_max_batch(device):
+    # large chunks keep a GPU busy, on CPU they only add activation memory
+    if torch.device(device).type == "cuda":
+        return 2 ** 18
+    return 2 ** 15
+
+
 def configure_logging(args):
     logger = logging.getLogger()
     if args.debug:
@@ -5,10 +5,13 @@ import json
 import os
 import torch
 
+import deep_sdf.utils
+
 model_params_subdir = "ModelParameters"
 optimizer_params_subdir = "OptimizerParameters"
 latent_codes_subdir = "LatentCodes"
 logs_filename = "Logs.pth"
+streaming_logs_filename = "Logs.jsonl"
 reconstructions_subdir = "Reconstructions"
 reconstruction_meshes_subdir = "Meshes"
 reconstruction_codes_subdir = "Codes"
@@ -16,9 +19,15 @@ specifications_filename = "specs.json"
 data_source_map_filename = ".datasources.json"
 evaluation_subdir = "Evaluation"
 sdf_samples_subdir = "SdfSamples"
+sdf_samples_manifest_filename = ".manifest.json"
 surface_samples_subdir = "SurfaceSamples"
 normalization_param_subdir = "NormalizationParameters"
 training_meshes_subdir = "TrainingMeshes"
+profiles_subdir = "Profiles"
+inference_models_subdir = "InferenceModels"
+packed_samples_subdir = "PackedSamples"
+packed_samples_data_extension = ".bin"
+packed_samples_index_extension = ".index.npz"
 
 
 def load_experiment_specifications(experiment_directory):
@@ -43,14 +52,144 @@ def load_model_parameters(experiment_directory, checkpoint, decoder):
     if not os.path.isfile(filename):
         raise Exception('model state dict "{}" does not exist'.format(filename))
 
-    data = torch.load(filename)
+    data = torch.load(filename, map_location="cpu")
 
-    decoder.load_state_dict(data["model_state_dict"])
+    load_model_state_dict(decoder, data["model_state_dict"])
 
     return data["epoch"]
 
 
-def build_decoder(experiment_directory, experiment_specs):
+def _split_legacy_logs(logs):
+    # Logs.pth holds whole-run lists, with a fixed number of iterations per epoch
+    num_epochs = len(logs["learning_rate"])
+    iters_per_epoch = len(logs["loss"]) // max(num_epochs, 1)
+
+    for i in range(num_epochs):
+        losses = logs["loss"][i * iters_per_epoch : (i + 1) * iters_per_epoch]
+        yield {
+            "epoch": i + 1,
+            "loss": [float(l) for l in losses],
+            "learning_rate": logs["learning_rate"][i],
+            "timing": logs["timing"][i],
+            "latent_magnitude": float(logs["latent_magnitude"][i]),
+            "param_magnitude": {n: m[i] for n, m in logs["param_magnitude"].items()},
+        }
+
+
+def iterate_training_logs(experiment_directory):
+    """
+    Yields the training log one epoch record at a time, from Logs.jsonl or, for
+    older experiments, from Logs.pth.
+    """
+    filename = os.path.join(experiment_directory, streaming_logs_filename)
+
+    if os.path.isfile(filename):
+        with open(filename, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # a record whose write was interrupted
+                    break
+                yield json.loads(line)
+        return
+
+    legacy_filename = os.path.join(experiment_directory, logs_filename)
+
+    if not os.path.isfile(legacy_filename):
+        raise Exception('log file "{}" does not exist'.format(filename))
+
+    yield from _split_legacy_logs(torch.load(legacy_filename, map_location="cpu"))
+
+
+def load_training_logs(experiment_directory):
+    """
+    Collects the training log into whole-run lists, keyed as the records, with
+    the per-iteration losses concatenated.
+    """
+    logs = {"epoch": 0, "loss": []}
+
+    for record in iterate_training_logs(experiment_directory):
+        for key, value in record.items():
+            if key == "epoch":
+                logs["epoch"] = value
+            elif key == "loss":
+                logs["loss"].extend(value)
+            elif isinstance(value, dict):
+                for name, v in value.items():
+                    logs.setdefault(key, {}).setdefault(name, []).append(v)
+            else:
+                logs.setdefault(key, []).append(value)
+
+    return logs
+
+
+def append_training_logs(experiment_directory, records):
+
+    filename = os.path.join(experiment_directory, streaming_logs_filename)
+
+    with open(filename, "a") as f:
+        f.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+def clip_training_logs(experiment_directory, epoch):
+    """
+    Drops the records after epoch, e.g. those logged after the snapshot training
+    continues from, and returns the last remaining epoch. Logs.pth is converted
+    to Logs.jsonl on the way.
+    """
+    filename = os.path.join(experiment_directory, streaming_logs_filename)
+
+    if not os.path.isfile(filename):
+        records = [
+            r for r in iterate_training_logs(experiment_directory) if r["epoch"] <= epoch
+        ]
+        append_training_logs(experiment_directory, records)
+        return records[-1]["epoch"] if len(records) > 0 else 0
+
+    last_epoch = 0
+    with open(filename, "r+b") as f:
+        offset = 0
+        for line in iter(f.readline, b""):
+            if not line.endswith(b"\n"):
+                break
+            record_epoch = json.loads(line)["epoch"]
+            if record_epoch > epoch:
+                break
+            last_epoch = record_epoch
+            offset += len(line)
+        f.truncate(offset)
+
+    return last_epoch
+
+
+def is_data_parallel(decoder):
+    return isinstance(
+        decoder,
+        (torch.nn.DataParallel, torch.nn.parallel.DistributedDataParallel),
+    )
+
+
+def get_model_state_dict(decoder):
+    """
+    Returns the state dict of a decoder keyed as in a DataParallel wrapper, the
+    format of all saved model parameters, whether or not the decoder is wrapped.
+    """
+    state_dict = decoder.state_dict()
+    if is_data_parallel(decoder):
+        return state_dict
+    return type(state_dict)(("module." + k, v) for k, v in state_dict.items())
+
+
+def load_model_state_dict(decoder, state_dict):
+    saved_data_parallel = all(k.startswith("module.") for k in state_dict)
+    if saved_data_parallel and not is_data_parallel(decoder):
+        state_dict = {k[len("module.") :]: v for k, v in state_dict.items()}
+    elif is_data_parallel(decoder) and not saved_data_parallel:
+        state_dict = {"module." + k: v for k, v in state_dict.items()}
+
+    decoder.load_state_dict(state_dict)
+
+
+def build_decoder(experiment_directory, experiment_specs, device=None):
 
     arch = __import__(
         "networks." + experiment_specs["NetworkArch"], fromlist=["Decoder"]
@@ -58,16 +197,25 @@ def build_decoder(experiment_directory, experiment_specs):
 
     latent_size = experiment_specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **experiment_specs["NetworkSpecs"]).cuda()
+    device = deep_sdf.utils.get_device(device, experiment_specs)
+
+    decoder = arch.Decoder(latent_size, **experiment_specs["NetworkSpecs"]).to(device)
 
     return decoder
 
 
 def load_decoder(
-    experiment_directory, experiment_specs, checkpoint, data_parallel=True
+    experiment_directory, experiment_specs, checkpoint, data_parallel=True, device=None
 ):
 
-    decoder = build_decoder(experiment_directory, experiment_specs)
+    decoder = build_decoder(experiment_directory, experiment_specs, device)
+
+    # there is nothing to parallelize on the CPU or a single GPU
+    data_parallel = (
+        data_parallel
+        and deep_sdf.utils.get_module_device(decoder).type == "cuda"
+        and torch.cuda.device_count() > 1
+    )
 
     if data_parallel:
         decoder = torch.nn.DataParallel(decoder)
@@ -77,7 +225,7 @@ def load_decoder(
     return (decoder, epoch)
 
 
-def load_latent_vectors(experiment_directory, checkpoint):
+def load_latent_vectors(experiment_directory, checkpoint, device=None):
 
     filename = os.path.join(
         experiment_directory, latent_codes_subdir, checkpoint + ".pth"
@@ -89,7 +237,9 @@ def load_latent_vectors(experiment_directory, checkpoint):
             + " for checkpoint '{}'".format(experiment_directory, checkpoint)
         )
 
-    data = torch.load(filename)
+    data = torch.load(filename, map_location="cpu")
+
+    device = deep_sdf.utils.get_device(device)
 
     if isinstance(data["latent_codes"], torch.Tensor):
 
@@ -97,7 +247,7 @@ def load_latent_vectors(experiment_directory, checkpoint):
 
         lat_vecs = []
         for i in range(num_vecs):
-            lat_vecs.append(data["latent_codes"][i].cuda())
+            lat_vecs.append(data["latent_codes"][i].to(device))
 
         return lat_vecs
 
@@ -109,7 +259,7 @@ def load_latent_vectors(experiment_directory, checkpoint):
 
         lat_vecs.load_state_dict(data["latent_codes"])
 
-        return lat_vecs.weight.data.detach()
+        return lat_vecs.weight.data.detach().to(device)
 
 
 def get_data_source_map_filename(data_dir):
@@ -186,6 +336,53 @@ def get_latent_codes_dir(experiment_dir, create_if_nonexistent=False):
     return dir
 
 
+def get_profiles_dir(experiment_dir, create_if_nonexistent=False):
+
+    dir = os.path.join(experiment_dir, profiles_subdir)
+
+    if create_if_nonexistent and not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    return dir
+
+
+def get_inference_models_dir(experiment_dir, create_if_nonexistent=False):
+
+    dir = os.path.join(experiment_dir, inference_models_subdir)
+
+    if create_if_nonexistent and not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    return dir
+
+
+def get_inference_model_filename(experiment_dir, checkpoint, extension=".pt"):
+    return os.path.join(get_inference_models_dir(experiment_dir), checkpoint + extension)
+
+
+def load_inference_decoder(experiment_directory, checkpoint, device=None):
+    """
+    Loads the TorchScript inference decoder exported by export_decoder.py for a
+    checkpoint, returning it together with the epoch it was trained for.
+    """
+    filename = get_inference_model_filename(experiment_directory, checkpoint)
+
+    if not os.path.isfile(filename):
+        raise Exception(
+            'inference model "{}" does not exist, export it with '.format(filename)
+            + "export_decoder.py"
+        )
+
+    extra_files = {"epoch": ""}
+    decoder = torch.jit.load(
+        filename,
+        map_location=deep_sdf.utils.get_device(device),
+        _extra_files=extra_files,
+    )
+
+    return decoder, int(extra_files["epoch"])
+
+
 def get_normalization_params_filename(
     data_dir, dataset_name, class_name, instance_name
 ):
@@ -196,3 +393,20 @@ def get_normalization_params_filename(
         class_name,
         instance_name + ".npz",
     )
+
+
+def get_packed_samples_dir(data_dir, create_if_nonexistent=False):
+
+    dir = os.path.join(data_dir, packed_samples_subdir)
+
+    if create_if_nonexistent and not os.path.isdir(dir):
+        os.makedirs(dir)
+
+    return dir
+
+
+def get_packed_samples_filenames(packed_samples):
+    return (
+        packed_samples + packed_samples_data_extension,
+        packed_samples + packed_samples_index_extension,
+    )
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import argparse
+import logging
+import os
+import torch
+
+import deep_sdf
+import deep_sdf.workspace as ws
+
+
+def get_parity_inputs(experiment_directory, checkpoint, specs, num_points):
+    """
+    N x (L+3+num_classes) decoder inputs with the latent codes of the checkpoint,
+    if they were saved, points in the unit cube and random one-hot classes.
+    """
+    latent_size = specs["CodeLength"]
+    generator = torch.Generator().manual_seed(0)
+
+    try:
+        latent_vectors = torch.stack(
+            list(ws.load_latent_vectors(experiment_directory, checkpoint, "cpu"))
+        )
+        indices = torch.randint(
+            0, latent_vectors.shape[0], (num_points,), generator=generator
+        )
+        latents = latent_vectors[indices]
+    except Exception:
+        latents = torch.randn(num_points, latent_size, generator=generator) * 0.01
+
+    columns = [latents, torch.rand(num_points, 3, generator=generator) * 2 - 1]
+
+    if specs["NetworkSpecs"].get("class_embedding", False):
+        num_classes = specs["NetworkSpecs"].get("num_classes", 9)
+        columns.append(
+            torch.nn.functional.one_hot(
+                torch.randint(0, num_classes, (num_points,), generator=generator),
+                num_classes,
+            ).float()
+        )
+
+    return torch.cat(columns, 1)
+
+
+def check_parity(name, reference, output, tolerance):
+    difference = (output - reference).abs().max().item()
+    identical = torch.equal(output, reference)
+    logging.info(
+        "{}: max difference {:.3e}{}".format(
+            name, difference, " (bit-identical)" if identical else ""
+        )
+    )
+    if difference > tolerance:
+        raise Exception(
+            "{} differs from the trained decoder by {} > {}".format(
+                name, difference, tolerance
+            )
+        )
+
+
+def export_decoder(experiment_directory, checkpoint, onnx, num_points, tolerance):
+
+    specs = ws.load_experiment_specifications(experiment_directory)
+
+    decoder, epoch = ws.load_decoder(
+        experiment_directory, specs, checkpoint, data_parallel=False, device="cpu"
+    )
+    decoder.eval()
+
+    inference_decoder = decoder.fold_for_inference()
+    scripted_decoder = torch.jit.script(inference_decoder)
+
+    inputs = get_parity_inputs(experiment_directory, checkpoint, specs, num_points)
+
+    with torch.no_grad():
+        reference = decoder(inputs)
+        # folding computes the weights exactly as the forward pass of the decoder
+        check_parity("folded decoder", reference, inference_decoder(inputs), 0.0)
+        check_parity("TorchScript", reference, scripted_decoder(inputs), tolerance)
+
+    filename = ws.get_inference_model_filename(experiment_directory, checkpoint)
+    ws.get_inference_models_dir(experiment_directory, True)
+
+    torch.jit.save(scripted_decoder, filename, _extra_files={"epoch": str(epoch)})
+    logging.info('saved the decoder of epoch {} to "{}"'.format(epoch, filename))
+
+    if onnx:
+        export_onnx(
+            inference_decoder,
+            ws.get_inference_model_filename(experiment_directory, checkpoint, ".onnx"),
+            inputs,
+            reference,
+            tolerance,
+        )
+
+
+def export_onnx(inference_decoder, onnx_filename, inputs, reference, tolerance):
+    # the tracer records the attention of every group or query chunk of the traced
+    # points, so the model would only take that many points
+    attention = deep_sdf.get_set_attention(inference_decoder)
+    if attention is not None:
+        logging.warning(
+            "not exporting an ONNX model, {} attention depends on the number of "
+            "points".format(attention)
+        )
+        return
+
+    try:
+        import onnxruntime
+    except ImportError:
+        logging.warning(
+            "not exporting an ONNX model, checking it requires onnxruntime"
+        )
+        return
+
+    # only moved into place once it decodes as the trained decoder
+    unchecked_filename = onnx_filename + ".unchecked"
+    try:
+        torch.onnx.export(
+            inference_decoder,
+            inputs[:1024],
+            unchecked_filename,
+            input_names=["input"],
+            output_names=["sdf"],
+            dynamic_axes={"input": {0: "points"}, "sdf": {0: "points"}},
+            opset_version=17,
+        )
+
+        session = onnxruntime.InferenceSession(
+            unchecked_filename, providers=["CPUExecutionProvider"]
+        )
+        (output,) = session.run(None, {"input": inputs.numpy()})
+        check_parity("ONNX", reference, torch.from_numpy(output), tolerance)
+
+        os.replace(unchecked_filename, onnx_filename)
+    finally:
+        if os.path.isfile(unchecked_filename):
+            os.remove(unchecked_filename)
+
+    logging.info('saved the ONNX model to "{}"'.format(onnx_filename))
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        description="Export the decoder of a checkpoint for inference, with weight "
+        + "norm folded into its linear layers and without dropout, as TorchScript "
+        + "and ONNX models in the InferenceModels subdirectory of the experiment. "
+        + "Both are checked against the trained decoder in eval mode."
+    )
+    arg_parser.add_argument(
+        "--experiment",
+        "-e",
+        dest="experiment_directory",
+        required=True,
+        help="The experiment directory which includes specifications and saved model "
+        + "files to export.",
+    )
+    arg_parser.add_argument(
+        "--checkpoint",
+        "-c",
+        dest="checkpoint",
+        default="latest",
+        help="The checkpoint weights to export. This can be a number indicated an "
+        + "epoch or 'latest' for the latest weights (this is the default)",
+    )
+    arg_parser.add_argument(
+        "--no_onnx",
+        dest="onnx",
+        default=True,
+        action="store_false",
+        help="If set, only the TorchScript model is exported. The ONNX model is "
+        + "also skipped if onnxruntime is not installed to check it, or if the "
+        + "decoder uses group or scene attention.",
+    )
+    arg_parser.add_argument(
+        "--parity_points",
+        dest="num_points",
+        default=65536,
+        type=int,
+        help="The number of decoder inputs the exported models are checked on.",
+    )
+    arg_parser.add_argument(
+        "--tolerance",
+        dest="tolerance",
+        default=1e-5,
+        type=float,
+        help="The largest difference to the trained decoder that the TorchScript "
+        + "and ONNX models may have, as they may fuse operations. The folded "
+        + "decoder itself has to match exactly.",
+    )
+    deep_sdf.add_common_args(arg_parser)
+
+    args = arg_parser.parse_args()
+
+    deep_sdf.configure_logging(args)
+
+    export_decoder(
+        args.experiment_directory,
+        args.checkpoint,
+        args.onnx,
+        args.num_points,
+        args.tolerance,
+    )
@@ -11,7 +11,22 @@ import deep_sdf
 import deep_sdf.workspace as ws
 
 
-def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
+def code_to_mesh(
+    experiment_directory,
+    checkpoint,
+    keep_normalized=False,
+    octree_levels=0,
+    write_normals=False,
+    device=None,
+    precision=None,
+    compile_mode=None,
+    exported=False,
+    quantize=False,
+    resolution=256,
+    half_volume=False,
+    shapes_per_batch=8,
+    mesh_workers=4,
+):
 
     specs_filename = os.path.join(experiment_directory, "specs.json")
 
@@ -26,22 +41,37 @@ def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
 
     latent_size = specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
+    device = deep_sdf.get_device(device, specs)
+    precision = deep_sdf.get_precision(precision, specs)
 
-    decoder = torch.nn.DataParallel(decoder)
-
-    saved_model_state = torch.load(
-        os.path.join(experiment_directory, ws.model_params_subdir, checkpoint + ".pth")
-    )
-    saved_model_epoch = saved_model_state["epoch"]
+    if exported:
+        decoder, saved_model_epoch = ws.load_inference_decoder(
+            experiment_directory, checkpoint, device
+        )
+    else:
+        decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
+
+        saved_model_state = torch.load(
+            os.path.join(
+                experiment_directory, ws.model_params_subdir, checkpoint + ".pth"
+            ),
+            map_location="cpu",
+        )
+        saved_model_epoch = saved_model_state["epoch"]
 
-    decoder.load_state_dict(saved_model_state["model_state_dict"])
+        ws.load_model_state_dict(decoder, saved_model_state["model_state_dict"])
 
-    decoder = decoder.module.cuda()
+        decoder = decoder.to(device)
+        deep_sdf.compile_decoder(
+            decoder, deep_sdf.get_compile_mode(compile_mode, specs)
+        )
 
     decoder.eval()
 
-    latent_vectors = ws.load_latent_vectors(experiment_directory, checkpoint)
+    # converted once for all shapes
+    mesh_decoder = deep_sdf.get_mesh_decoder(decoder, quantize, precision)
+
+    latent_vectors = ws.load_latent_vectors(experiment_directory, checkpoint, device)
 
     train_split_file = specs["TrainSplit"]
 
@@ -54,6 +84,10 @@ def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
 
     print(len(instance_filenames), " vs ", len(latent_vectors))
 
+    mesh_filenames = []
+    offsets = []
+    scales = []
+
     for i, latent_vector in enumerate(latent_vectors):
 
         dataset_name, class_name, instance_name = instance_filenames[i].split("/")
@@ -90,15 +124,41 @@ def code_to_mesh(experiment_directory, checkpoint, keep_normalized=False):
             offset = normalization_params["offset"]
             scale = normalization_params["scale"]
 
-        with torch.no_grad():
-            deep_sdf.mesh.create_mesh(
-                decoder,
-                latent_vector,
-                mesh_filename,
-                N=256,
-                max_batch=int(2 ** 18),
-                offset=offset,
-                scale=scale,
+        mesh_filenames.append(mesh_filename)
+        offsets.append(offset)
+        scales.append(scale)
+
+    volume_dtype = torch.float16 if half_volume else torch.float32
+
+    with torch.no_grad():
+        # coarse-to-fine sampling evaluates different points for every shape
+        if octree_levels > 0:
+            for i, latent_vector in enumerate(latent_vectors):
+                deep_sdf.mesh.create_mesh(
+                    mesh_decoder,
+                    latent_vector,
+                    mesh_filenames[i],
+                    N=resolution,
+                    offset=offsets[i],
+                    scale=scales[i],
+                    octree_levels=octree_levels,
+                    write_normals=write_normals,
+                    precision=precision,
+                    volume_dtype=volume_dtype,
+                )
+        else:
+            deep_sdf.mesh.create_meshes(
+                mesh_decoder,
+                latent_vectors,
+                mesh_filenames,
+                N=resolution,
+                offsets=offsets,
+                scales=scales,
+                write_normals=write_normals,
+                precision=precision,
+                volume_dtype=volume_dtype,
+                shapes_per_batch=shapes_per_batch,
+                num_workers=mesh_workers,
             )
 
 
@@ -130,10 +190,69 @@ if __name__ == "__main__":
         action="store_true",
         help="If set, keep the meshes in the normalized scale.",
     )
+    arg_parser.add_argument(
+        "--resolution",
+        "-N",
+        dest="resolution",
+        default=256,
+        type=int,
+        help="The number of grid points along each axis of the SDF grid.",
+    )
+    arg_parser.add_argument(
+        "--half_volume",
+        dest="half_volume",
+        default=False,
+        action="store_true",
+        help="If set, the SDF grid is held in float16 while the decoder runs, "
+        + "which halves its memory at high resolutions.",
+    )
+    arg_parser.add_argument(
+        "--octree_levels",
+        dest="octree_levels",
+        default=0,
+        type=int,
+        help="If positive, the SDF grid is sampled coarse-to-fine, starting with a "
+        + "spacing of 2 ** octree_levels voxels and refining only near the surface.",
+    )
+    arg_parser.add_argument(
+        "--normals",
+        dest="write_normals",
+        default=False,
+        action="store_true",
+        help="If set, the vertex normals are written to the meshes as well.",
+    )
+    arg_parser.add_argument(
+        "--exported",
+        dest="exported",
+        default=False,
+        action="store_true",
+        help="If set, the inference decoder exported by export_decoder.py for the "
+        + "checkpoint is used instead of the trained one, and --compile is ignored.",
+    )
+    deep_sdf.add_device_args(arg_parser)
+    deep_sdf.add_precision_args(arg_parser)
+    deep_sdf.add_compile_args(arg_parser)
+    deep_sdf.add_quantize_args(arg_parser)
+    deep_sdf.add_mesh_batch_args(arg_parser)
     deep_sdf.add_common_args(arg_parser)
 
     args = arg_parser.parse_args()
 
     deep_sdf.configure_logging(args)
 
-    code_to_mesh(args.experiment_directory, args.checkpoint, args.keep_normalized)
+    code_to_mesh(
+        args.experiment_directory,
+        args.checkpoint,
+        args.keep_normalized,
+        args.octree_levels,
+        args.write_normals,
+        args.device,
+        args.precision,
+        args.compile,
+        args.exported,
+        args.quantize,
+        args.resolution,
+        args.half_volume,
+        args.shapes_per_batch,
+        args.mesh_workers,
+    )
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+import copy
 import torch.nn as nn
 import torch
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 
 class Decoder(nn.Module):
@@ -20,19 +22,30 @@ class Decoder(nn.Module):
         use_tanh=False,
         latent_dropout=False,
         class_embedding=False,
+        num_classes=9,
+        learned_class_embedding=False,
         use_transformers=False,
         transformer_hidden_size=1024,
         num_heads=16,
+        transformer_attention=None,
+        attention_group_size=64,
+        attention_chunk_size=256,
     ):
         super(Decoder, self).__init__()
 
         def make_sequence():
             return []
 
-        self.input_coord_length = 3
-        if class_embedding:
-            self.input_coord_length = 12
-        
+        # the class of a point enters the network as num_classes columns after its
+        # xyz, either its one-hot encoding or a learned embedding of its class
+        self.num_classes = num_classes if class_embedding else 0
+        self.input_coord_length = 3 + self.num_classes
+        self.class_embedder = None
+        if class_embedding and learned_class_embedding:
+            self.class_embedder = nn.Embedding(num_classes, num_classes)
+            # starts out as the one-hot encoding
+            nn.init.eye_(self.class_embedder.weight)
+
         dims = [latent_size + self.input_coord_length] + dims + [1]
 
         self.num_layers = len(dims)
@@ -45,13 +58,8 @@ class Decoder(nn.Module):
         self.xyz_in_all = xyz_in_all
         self.weight_norm = weight_norm
 
+        layers = []
         for layer in range(0, self.num_layers - 1):
-            setattr(
-                self,
-                "multi_head_attn" + str(layer),
-                nn.MultiheadAttention()
-            )
-
             if layer + 1 in latent_in:
                 out_dim = dims[layer + 1] - dims[0]
             else:
@@ -59,81 +67,411 @@ class Decoder(nn.Module):
                 if self.xyz_in_all and layer != self.num_layers - 2:
                     out_dim -= self.input_coord_length
 
+            transformer = None
             if use_transformers and (layer+1)%2 == 0:
-                setattr(self, "transformer" + str(layer), TransformerLayer(dims[layer], out_dim, transformer_hidden_size, num_heads, dropout_prob))
-
-            if use_transformers and (layer+1)%2 == 0:
-                setattr(self, "transformer" + str(layer), TransformerLayer(dims[layer], out_dim, transformer_hidden_size, num_heads, dropout_prob))
+                transformer = TransformerLayer(
+                    dims[layer],
+                    out_dim,
+                    transformer_hidden_size,
+                    num_heads,
+                    dropout_prob,
+                    attention=transformer_attention or "point",
+                    group_size=attention_group_size,
+                    chunk_size=attention_chunk_size,
+                )
 
             if weight_norm and layer in self.norm_layers:
-                setattr(
-                    self,
-                    "lin" + str(layer),
-                    nn.utils.weight_norm(nn.Linear(dims[layer], out_dim)),
-                )
+                lin = WeightNormLinear(dims[layer], out_dim)
             else:
-                setattr(self, "lin" + str(layer), nn.Linear(dims[layer], out_dim))
+                lin = nn.Linear(dims[layer], out_dim)
 
+            bn = None
             if (
                 (not weight_norm)
                 and self.norm_layers is not None
                 and layer in self.norm_layers
             ):
-                setattr(self, "bn" + str(layer), nn.LayerNorm(out_dim))
+                bn = nn.LayerNorm(out_dim)
+
+            is_last = layer == self.num_layers - 2
+            layers.append(
+                DecoderLayer(
+                    lin,
+                    bn=bn,
+                    transformer=transformer,
+                    # the transformer replaces lin once an attention is chosen
+                    use_transformer=transformer is not None
+                    and transformer_attention is not None,
+                    concat_input=layer in latent_in,
+                    concat_xyz=layer != 0 and bool(xyz_in_all),
+                    is_last=is_last,
+                    use_tanh=is_last and use_tanh,
+                    dropout_prob=(
+                        dropout_prob
+                        if dropout is not None and layer in dropout
+                        else None
+                    ),
+                )
+            )
+
         self.use_tanh = use_tanh
-        if use_tanh:
-            self.tanh = nn.Tanh()
-        self.relu = nn.ReLU()
 
         self.dropout_prob = dropout_prob
         self.dropout = dropout
-        self.th = nn.Tanh()
 
-    # input: N x (L+4)
-    def forward(self, input):
-        xyz = input[:, -self.input_coord_length:]
+        # the layers with all of their flags resolved once, rather than looked up
+        # by name on every call. The state dict keeps the lin<i>, bn<i> and
+        # transformer<i> keys of the former layer attributes.
+        self.plan = LayerPlan(layers, self.input_coord_length)
+
+        # a layer with a transformer only runs one of it and its linear layer, and
+        # a transformer that changes the width skips its second norm
+        self.has_unused_parameters = any(
+            layer.transformer is not None for layer in layers
+        )
+        self._register_state_dict_hook(_save_legacy_layer_keys)
+        self._register_load_state_dict_pre_hook(_load_legacy_layer_keys)
+
+    def script_layers(self):
+        """
+        Replace the per-point forward pass over the layers by its TorchScript
+        compilation. Parameters and state dict keys stay the same.
+        """
+        if not isinstance(self.plan, torch.jit.ScriptModule):
+            self.plan = torch.jit.script(self.plan)
+
+    def fold_for_inference(self):
+        """
+        Returns an InferenceDecoder with a copy of the layers, in which the weight
+        norm of every layer is folded into a plain linear weight and dropout is
+        removed. It decodes the same as the decoder in eval mode.
+        """
+        if isinstance(self.plan, torch.jit.ScriptModule):
+            raise Exception("cannot fold a decoder whose layers are scripted")
+
+        plan = copy.deepcopy(self.plan)
+        for layer in plan.layers:
+            if isinstance(layer.lin, WeightNormLinear):
+                lin = nn.Linear(layer.lin.in_features, layer.lin.out_features)
+                lin.to(layer.lin.weight_v.device)
+                with torch.no_grad():
+                    lin.weight.copy_(linear_weight(layer.lin))
+                    lin.bias.copy_(layer.lin.bias)
+                layer.lin = lin
+            layer.use_dropout = False
+            layer.dropout_prob = 0.0
+            if layer.transformer is not None:
+                layer.transformer.dropout_prob = 0.0
+                layer.transformer.ff[2] = nn.Identity()
+
+        class_weight = None
+        if self.class_embedder is not None:
+            class_weight = self.class_embedder.weight.detach().clone()
+
+        inference_decoder = InferenceDecoder(plan, self.input_coord_length, class_weight)
+        inference_decoder.eval()
+        inference_decoder.requires_grad_(False)
+        return inference_decoder
+
+    def embed_classes(self, classes, dtype):
+        """
+        Returns the class columns for class indices, or for [..., num_classes]
+        class weights such as one-hot encodings, which select (or blend) the
+        learned embeddings.
+        """
+        if not torch.is_floating_point(classes):
+            if self.class_embedder is not None:
+                return self.class_embedder(classes).to(dtype)
+            return F.one_hot(classes, self.num_classes).to(dtype)
+
+        if self.class_embedder is not None:
+            return torch.matmul(classes.to(dtype), self.class_embedder.weight)
+        return classes.to(dtype)
+
+    # input: N x (L+3) with classes: N, N x (L+3+num_classes) with one-hot
+    # classes, or B x L latent codes together with xyz: B x S x 3 (and classes: B).
+    # Inputs of B x S x ... points are decoded as B scenes of S points.
+    def forward(self, input, xyz=None, classes=None):
+        if xyz is not None:
+            return self.forward_scenes(input, xyz, classes)
+
+        if classes is not None:
+            input = torch.cat([input, self.embed_classes(classes, input.dtype)], -1)
+        elif self.class_embedder is not None:
+            input = torch.cat(
+                [
+                    input[..., : -self.num_classes],
+                    self.embed_classes(input[..., -self.num_classes :], input.dtype),
+                ],
+                -1,
+            )
+
+        return self.forward_points(input)
 
-        if input.shape[1] > 4 and self.latent_dropout:
-            latent_vecs = input[:, :-self.input_coord_length]
+    # input: N x (L+3+num_classes), or B x S x (L+3+num_classes) for B scenes
+    def forward_points(self, input):
+        if input.shape[-1] > 4 and self.latent_dropout:
+            xyz = input[..., -self.input_coord_length:]
+            latent_vecs = input[..., :-self.input_coord_length]
             latent_vecs = F.dropout(latent_vecs, p=0.2, training=self.training)
-            x = torch.cat([latent_vecs, xyz], 1)
+            x = torch.cat([latent_vecs, xyz], -1)
         else:
             x = input
 
-        for layer in range(0, self.num_layers - 1):
-            lin = getattr(self, "lin" + str(layer), None)
-            transformer = getattr(self, "transformer" + str(layer), None)
-            assert lin is not None or transformer is not None
-            if layer in self.latent_in:
-                x = torch.cat([x, input], 1)
-            elif layer != 0 and self.xyz_in_all:
-                x = torch.cat([x, xyz], 1)
-            if lin is not None:
-                x = lin(x)
+        return self.plan(x, input)
+
+    # latents: B x L, xyz: B x S x 3 with classes: B, or B x S x (3+num_classes)
+    def forward_scenes(self, latents, xyz, classes=None):
+        """
+        Decode S samples of each of B scenes. Every layer that takes the latent
+        code as input is split into its latent and point columns, so the latent
+        part is computed once per scene and broadcast over the scene's samples.
+        Per-scene classes are folded into the latent part the same way.
+        """
+        num_samples = xyz.shape[1]
+
+        class_features = None
+        if classes is not None:
+            class_features = self.embed_classes(classes, latents.dtype)
+        elif self.class_embedder is not None:
+            xyz = torch.cat(
+                [
+                    xyz[..., : -self.num_classes],
+                    self.embed_classes(xyz[..., -self.num_classes :], xyz.dtype),
+                ],
+                2,
+            )
+
+        # the full point columns, for layers that take them as they are
+        point_input = xyz
+        if class_features is not None:
+            point_input = torch.cat(
+                [xyz, class_features.unsqueeze(1).expand(-1, num_samples, -1)], 2
+            )
+
+        if (self.latent_dropout and self.training) or 0 in self.latent_in:
+            # latent dropout acts on the code of every single sample
+            input = torch.cat(
+                [latents.unsqueeze(1).expand(-1, num_samples, -1), point_input], 2
+            )
+            return self.forward_points(input)
+
+        latent_size = latents.shape[1]
+
+        scene_input = latents
+        if class_features is not None:
+            scene_input = torch.cat([latents, class_features], 1)
+
+        x = None
+        for layer, block in enumerate(self.plan.layers):
+            lin = block.lin
+            if block.use_transformer:
+                # attention needs the full input of the layer, over each scene
+                if block.concat_input:
+                    x = torch.cat(
+                        [
+                            x,
+                            latents.unsqueeze(1).expand(-1, num_samples, -1),
+                            point_input,
+                        ],
+                        2,
+                    )
+                elif block.concat_xyz:
+                    x = torch.cat([x, point_input], 2)
+                x = block.transformer(x)
+            elif layer == 0 or block.concat_input:
+                # [x, latent, xyz] W^T = x W_x^T + latent W_latent^T + xyz W_xyz^T
+                weight = linear_weight(lin)
+                num_x = weight.shape[1] - latent_size - self.input_coord_length
+                weight_x, weight_latent, weight_xyz = torch.split(
+                    weight, [num_x, latent_size, self.input_coord_length], 1
+                )
+                if class_features is not None:
+                    weight_xyz, weight_class = torch.split(
+                        weight_xyz, [xyz.shape[2], self.num_classes], 1
+                    )
+                    weight_latent = torch.cat([weight_latent, weight_class], 1)
+                y = F.linear(xyz, weight_xyz) + F.linear(
+                    scene_input, weight_latent, lin.bias
+                ).unsqueeze(1)
+                if x is not None:
+                    y = y + F.linear(x, weight_x)
+                x = y
             else:
-                x = transformer(x)
-            # last layer Tanh
-            if layer == self.num_layers - 2 and self.use_tanh:
-                x = self.tanh(x)
-            if layer < self.num_layers - 2:
-                if (
-                    self.norm_layers is not None
-                    and layer in self.norm_layers
-                    and not self.weight_norm
-                ):
-                    bn = getattr(self, "bn" + str(layer))
-                    x = bn(x)
-                x = self.relu(x)
-                if self.dropout is not None and layer in self.dropout:
-                    x = F.dropout(x, p=self.dropout_prob, training=self.training)
-
-        if hasattr(self, "th"):
-            x = self.th(x)
+                if block.concat_xyz:
+                    x = torch.cat([x, point_input], 2)
+                x = lin(x)
+            x = block.activate(x)
+
+        return torch.tanh(x)
+
+
+class WeightNormLinear(nn.Module):
+    """
+    A linear layer with the parameters of nn.utils.weight_norm(nn.Linear(...)),
+    weight = weight_g * weight_v / ||weight_v|| per output row, which computes its
+    weight in forward instead of in a forward pre-hook, so that it can be scripted.
+    """
+
+    def __init__(self, in_features, out_features):
+        super(WeightNormLinear, self).__init__()
+        linear = nn.Linear(in_features, out_features)
+        self.in_features = in_features
+        self.out_features = out_features
+        # in the order of nn.utils.weight_norm, which saved optimizer states rely on
+        self.bias = linear.bias
+        self.weight_g = nn.Parameter(torch.norm_except_dim(linear.weight, 2, 0).data)
+        self.weight_v = nn.Parameter(linear.weight.data)
+
+    def forward(self, x):
+        return F.linear(x, torch._weight_norm(self.weight_v, self.weight_g, 0), self.bias)
+
+
+class DecoderLayer(nn.Module):
+    def __init__(
+        self,
+        lin,
+        bn=None,
+        transformer=None,
+        use_transformer=False,
+        concat_input=False,
+        concat_xyz=False,
+        is_last=False,
+        use_tanh=False,
+        dropout_prob=None,
+    ):
+        super(DecoderLayer, self).__init__()
+        # in the order of the former transformer<i>, lin<i> and bn<i> attributes
+        # of the decoder, which saved optimizer states rely on
+        self.transformer = transformer
+        self.lin = lin
+        self.bn = bn if bn is not None else nn.Identity()
+        self.use_transformer = use_transformer
+
+        # the input is concatenated to the output of the previous layer, else xyz
+        self.concat_input = concat_input
+        self.concat_xyz = concat_xyz
+        self.is_last = is_last
+        self.use_tanh = use_tanh
+        self.use_dropout = dropout_prob is not None
+        self.dropout_prob = dropout_prob if dropout_prob is not None else 0.0
 
+    def activate(self, x):
+        # last layer Tanh
+        if self.use_tanh:
+            x = torch.tanh(x)
+        if not self.is_last:
+            x = self.bn(x)
+            x = F.relu(x)
+            if self.use_dropout:
+                x = F.dropout(x, p=self.dropout_prob, training=self.training)
         return x
 
+    def forward(self, x):
+        if self.use_transformer and self.transformer is not None:
+            return self.activate(self.transformer(x))
+        return self.activate(self.lin(x))
+
+
+class LayerPlan(nn.Module):
+    def __init__(self, layers, input_coord_length):
+        super(LayerPlan, self).__init__()
+        self.layers = nn.ModuleList(layers)
+        self.input_coord_length = input_coord_length
+
+    # x: the input after latent dropout, input: [..., L+3+num_classes]
+    def forward(self, x, input):
+        xyz = input[..., -self.input_coord_length :]
+        for layer in self.layers:
+            if layer.concat_input:
+                x = torch.cat([x, input], -1)
+            elif layer.concat_xyz:
+                x = torch.cat([x, xyz], -1)
+            x = layer(x)
+        return torch.tanh(x)
+
+
+class InferenceDecoder(nn.Module):
+    """
+    A decoder for inference only, see Decoder.fold_for_inference, which can be
+    scripted as a whole. It takes N x (L+3+num_classes) inputs, or B x S x ... for
+    B scenes, with one-hot class columns as create_mesh and reconstruct_batch
+    pass them.
+    """
+
+    def __init__(self, plan, input_coord_length, class_weight=None):
+        super(InferenceDecoder, self).__init__()
+        self.plan = plan
+        self.input_coord_length = input_coord_length
+        self.has_class_weight = class_weight is not None
+        self.num_classes = 0 if class_weight is None else class_weight.shape[0]
+        self.register_buffer(
+            "class_weight", class_weight if class_weight is not None else torch.zeros(0)
+        )
+
+    def forward(self, input):
+        if self.has_class_weight:
+            # one-hot class columns select their learned embedding
+            input = torch.cat(
+                [
+                    input[..., : -self.num_classes],
+                    torch.matmul(input[..., -self.num_classes :], self.class_weight),
+                ],
+                -1,
+            )
+        return self.plan(input, input)
+
+
+_legacy_layer_modules = ("transformer", "lin", "bn")
+
+
+def _save_legacy_layer_keys(module, state_dict, prefix, local_metadata):
+    # plan.layers.<i>.lin.weight_g -> lin<i>.weight_g
+    plan_prefix = prefix + "plan.layers."
+    items = list(state_dict.items())
+    state_dict.clear()
+    for key, value in items:
+        if key.startswith(plan_prefix):
+            layer, name, rest = key[len(plan_prefix) :].split(".", 2)
+            key = prefix + name + layer + "." + rest
+        state_dict[key] = value
+    return state_dict
+
+
+def _load_legacy_layer_keys(
+    state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs
+):
+    # lin<i>.weight_g -> plan.layers.<i>.lin.weight_g
+    for key in list(state_dict.keys()):
+        if not key.startswith(prefix):
+            continue
+        name, _, rest = key[len(prefix) :].partition(".")
+        for module_name in _legacy_layer_modules:
+            layer = name[len(module_name) :]
+            if name.startswith(module_name) and layer.isdigit():
+                state_dict[
+                    "{}plan.layers.{}.{}.{}".format(prefix, layer, module_name, rest)
+                ] = state_dict.pop(key)
+                break
+
+
+def linear_weight(lin):
+    # WeightNormLinear computes its weight in forward
+    if hasattr(lin, "weight_g"):
+        return torch._weight_norm(lin.weight_v, lin.weight_g, 0)
+    return lin.weight
+
 
 class TransformerLayer(nn.Module):
+    """
+    A transformer block over the points of a scene. The attention is either
+    "point", where every point only attends to itself, which reduces to a linear
+    layer on the values; "group", among consecutive groups of group_size points;
+    or "scene", among all points of a scene. Group and scene attention are
+    evaluated in chunks of chunk_size queries, so that their memory grows with
+    the chunk size rather than with the square of the number of points.
+    """
+
     def __init__(
             self,
             input_dim,
@@ -141,8 +479,13 @@ class TransformerLayer(nn.Module):
             hidden_layers,
             num_heads,
             dropout_prob=0.0,
+            attention="point",
+            group_size=64,
+            chunk_size=256,
     ):
         super(TransformerLayer, self).__init__()
+        if attention not in ("point", "group", "scene"):
+            raise Exception('unknown attention "{}"'.format(attention))
         self.attn = nn.MultiheadAttention(input_dim, num_heads, dropout=dropout_prob)
         self.norm = nn.LayerNorm(input_dim)
         self.ff = nn.Sequential(
@@ -152,12 +495,106 @@ class TransformerLayer(nn.Module):
             nn.Linear(hidden_layers, output_dim)
         )
         self.norm2 = nn.LayerNorm(input_dim)
+        self.num_heads = num_heads
+        self.attention = attention
+        self.group_size = group_size
+        self.chunk_size = chunk_size
+        self.dropout_prob = dropout_prob
+
+    def point_attention(self, x):
+        # the softmax over a single key is 1, so the attention is out_proj(v)
+        dim = x.shape[-1]
+        v = F.linear(
+            x, self.attn.in_proj_weight[2 * dim :], self.attn.in_proj_bias[2 * dim :]
+        )
+        if self.training and self.dropout_prob > 0:
+            # dropping the attention weight of the only key drops the whole head
+            heads = v.view(list(v.shape[:-1]) + [self.num_heads, -1])
+            keep = F.dropout(
+                heads.new_ones(list(heads.shape[:-1]) + [1]), self.dropout_prob
+            )
+            v = (heads * keep).flatten(-2)
+        return self.attn.out_proj(v)
+
+    def _attend(self, q, k, v):
+        chunks = []
+        for start in range(0, q.shape[2], self.chunk_size):
+            chunks.append(
+                F.scaled_dot_product_attention(
+                    q[:, :, start : start + self.chunk_size],
+                    k,
+                    v,
+                    dropout_p=self.dropout_prob if self.training else 0.0,
+                )
+            )
+        return torch.cat(chunks, 2)
+
+    @torch.jit.unused
+    def _attend_checkpointed(self, q, k, v):
+        # recomputes the attention of each chunk in the backward pass, instead of
+        # keeping all of them for it
+        chunks = []
+        for start in range(0, q.shape[2], self.chunk_size):
+            chunks.append(
+                torch.utils.checkpoint.checkpoint(
+                    F.scaled_dot_product_attention,
+                    q[:, :, start : start + self.chunk_size],
+                    k,
+                    v,
+                    None,
+                    self.dropout_prob if self.training else 0.0,
+                    use_reentrant=False,
+                )
+            )
+        return torch.cat(chunks, 2)
+
+    def set_attention(self, x):
+        # N x D points are a single scene, B x S x D points B scenes of S points
+        shape = x.shape
+        if x.dim() == 2:
+            x = x.unsqueeze(0)
+        num_points = x.shape[1]
+
+        if self.attention == "group":
+            # pad every scene to whole groups, the padding is dropped afterwards
+            padding = (-num_points) % self.group_size
+            if padding > 0:
+                x = F.pad(x, [0, 0, 0, padding])
+            x = x.reshape(-1, self.group_size, x.shape[2])
+
+        # B x S x 3D -> 3 x B x H x S x D/H
+        qkv = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias)
+        qkv = qkv.view(x.shape[0], x.shape[1], 3, self.num_heads, -1)
+        qkv = qkv.permute(2, 0, 3, 1, 4)
+
+        if (
+            not torch.jit.is_scripting()
+            and torch.is_grad_enabled()
+            and qkv.requires_grad
+        ):
+            y = self._attend_checkpointed(qkv[0], qkv[1], qkv[2])
+        else:
+            y = self._attend(qkv[0], qkv[1], qkv[2])
+
+        y = y.transpose(1, 2).reshape(x.shape[0], x.shape[1], -1)
+        y = self.attn.out_proj(y)
+
+        if self.attention == "group":
+            y = y.reshape(-1, num_points + (-num_points) % self.group_size, y.shape[2])
+            y = y[:, :num_points]
+
+        return y.reshape(shape)
 
     def forward(self, input):
-        x = input.unsqueeze(0) #Add fake sequence dim
-        attn_output, _ = self.attn(x, x, x)
-        x = self.norm(input+attn_output)
+        if self.attention == "point":
+            attn_output = self.point_attention(input)
+        else:
+            attn_output = self.set_attention(input)
+        x = self.norm(input + attn_output)
         ff_output = self.ff(x)
-        x = self.norm2(x+ff_output)
+        # without a residual when the block changes the width
+        if ff_output.shape[-1] != x.shape[-1]:
+            return ff_output
+        x = self.norm2(x + ff_output)
 
-        return x.squeeze(0)
\ No newline at end of file
+        return x
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright 2004-present Facebook. All Rights Reserved.
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+
+import deep_sdf
+import deep_sdf.workspace as ws
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        description="Pack the SDF samples of a split into a single memory-mappable "
+        + "file with an offsets index. Point an experiment at it by setting "
+        + '"PackedSamples" in its specifications.',
+    )
+    arg_parser.add_argument(
+        "--data",
+        "-d",
+        dest="data_source",
+        required=True,
+        help="The data source directory.",
+    )
+    arg_parser.add_argument(
+        "--split",
+        "-s",
+        dest="split_filename",
+        required=True,
+        help="The split to pack.",
+    )
+    arg_parser.add_argument(
+        "--output",
+        "-o",
+        dest="packed_samples",
+        default=None,
+        help="The packed samples to write, without extension. If unspecified, it "
+        + "defaults to the split name within the data source's PackedSamples "
+        + "directory.",
+    )
+    arg_parser.add_argument(
+        "--half",
+        dest="half",
+        default=False,
+        action="store_true",
+        help="If set, the samples are stored as float16 instead of float32.",
+    )
+    arg_parser.add_argument(
+        "--quantize",
+        dest="quantize",
+        default=False,
+        action="store_true",
+        help="If set, the samples are stored as int16, with the coordinates "
+        + "quantized over the bounding cube of each shape and the sdf as float16. "
+        + "This halves the size of the samples; the largest error is reported.",
+    )
+    deep_sdf.add_common_args(arg_parser)
+
+    args = arg_parser.parse_args()
+
+    deep_sdf.configure_logging(args)
+
+    if args.half and args.quantize:
+        raise Exception("--half and --quantize are mutually exclusive")
+
+    with open(args.split_filename, "r") as f:
+        split = json.load(f)
+
+    packed_samples = args.packed_samples
+    if packed_samples is None:
+        packed_samples = os.path.join(
+            ws.get_packed_samples_dir(args.data_source, True),
+            os.path.splitext(os.path.basename(args.split_filename))[0],
+        )
+
+    num_rows = deep_sdf.data.pack_sdf_samples(
+        args.data_source,
+        split,
+        packed_samples,
+        np.float16 if args.half else np.float32,
+        args.quantize,
+    )
+
+    logging.info(
+        "packed {} samples to {}".format(
+            num_rows, ws.get_packed_samples_filenames(packed_samples)[0]
+        )
+    )
@@ -4,8 +4,6 @@
 import logging
 import matplotlib.pyplot as plt
 import numpy as np
-import os
-import torch
 import deep_sdf
 import deep_sdf.workspace as ws
 
@@ -17,7 +15,7 @@ def running_mean(x, N):
 
 def load_logs(experiment_directory, type):
 
-    logs = torch.load(os.path.join(experiment_directory, ws.logs_filename))
+    logs = ws.load_training_logs(experiment_directory)
 
     logging.info("latest epoch is {}".format(logs["epoch"]))
 
@@ -72,6 +70,14 @@ def load_logs(experiment_directory, type):
         ax.set(xlabel="Epoch", ylabel="Magnitude", title="Parameter Magnitude")
         ax.legend(logs["param_magnitude"].keys())
 
+    elif type == "step_profile":
+        if "step_profile" not in logs:
+            raise Exception("the experiment was not trained with --profile")
+        for phase in deep_sdf.StepProfiler.phases:
+            ax.plot(np.array(logs["step_profile"][phase]) * 1e3)
+        ax.set(xlabel="Epoch", ylabel="Time per Step (ms)", title="Step Profile")
+        ax.legend(deep_sdf.StepProfiler.phases)
+
     else:
         raise Exception('unrecognized plot type "{}"'.format(type))
 
@@ -16,7 +16,7 @@ def load_latent_vector(filename):
     if not os.path.isfile(filename):
         raise Exception('latent state file "{}" does not exist'.format(filename))
 
-    data = torch.load(filename).squeeze()
+    data = torch.load(filename, map_location="cpu").squeeze()
     return data
 
 def interpolate(latent_code_1, latent_code_2, num_interpolation_steps):
@@ -80,6 +80,27 @@ if __name__ == "__main__":
         help="Number of interpolation steps.",
     )
 
+    arg_parser.add_argument(
+        "--octree_levels",
+        dest="octree_levels",
+        default=0,
+        type=int,
+        help="If positive, the SDF grid is sampled coarse-to-fine, starting with a "
+        + "spacing of 2 ** octree_levels voxels and refining only near the surface.",
+    )
+    arg_parser.add_argument(
+        "--exported",
+        dest="exported",
+        default=False,
+        action="store_true",
+        help="If set, the inference decoder exported by export_decoder.py for the "
+        + "checkpoint is used instead of the trained one, and --compile is ignored.",
+    )
+    deep_sdf.add_device_args(arg_parser)
+    deep_sdf.add_precision_args(arg_parser)
+    deep_sdf.add_compile_args(arg_parser)
+    deep_sdf.add_quantize_args(arg_parser)
+    deep_sdf.add_mesh_batch_args(arg_parser)
     deep_sdf.add_common_args(arg_parser)
 
     args = arg_parser.parse_args()
@@ -99,20 +120,35 @@ if __name__ == "__main__":
 
     latent_size = specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
-
-    decoder = torch.nn.DataParallel(decoder)
+    device = deep_sdf.get_device(args.device, specs)
+    precision = deep_sdf.get_precision(args.precision, specs)
 
-    saved_model_state = torch.load(
-        os.path.join(
-            args.experiment_directory, ws.model_params_subdir, args.checkpoint + ".pth"
+    if args.exported:
+        decoder, saved_model_epoch = ws.load_inference_decoder(
+            args.experiment_directory, args.checkpoint, device
         )
-    )
-    saved_model_epoch = saved_model_state["epoch"]
+    else:
+        decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
+
+        saved_model_state = torch.load(
+            os.path.join(
+                args.experiment_directory,
+                ws.model_params_subdir,
+                args.checkpoint + ".pth",
+            ),
+            map_location="cpu",
+        )
+        saved_model_epoch = saved_model_state["epoch"]
 
-    decoder.load_state_dict(saved_model_state["model_state_dict"])
+        ws.load_model_state_dict(decoder, saved_model_state["model_state_dict"])
+
+        decoder = decoder.to(device)
+        deep_sdf.compile_decoder(
+            decoder, deep_sdf.get_compile_mode(args.compile, specs)
+        )
 
-    decoder = decoder.module.cuda()
+    # converted once for all shapes
+    mesh_decoder = deep_sdf.get_mesh_decoder(decoder, args.quantize, precision)
 
     with open(args.split_filename, "r") as f:
         split = json.load(f)
@@ -183,9 +219,24 @@ if __name__ == "__main__":
             os.makedirs(os.path.dirname(mesh_filename))
         
         start = time.time()
-        for i, latent_vec in enumerate(interpolated_latent_vecs):
+        if args.octree_levels > 0:
+            for i, latent_vec in enumerate(interpolated_latent_vecs):
+                with torch.no_grad():
+                    deep_sdf.mesh.create_mesh(
+                        mesh_decoder, latent_vec, mesh_filename+f"-{i}", N=256, class_embedding=interpolated_embeddings[i],
+                        octree_levels=args.octree_levels,
+                        precision=precision,
+                    )
+        else:
             with torch.no_grad():
-                deep_sdf.mesh.create_mesh(
-                    decoder, latent_vec, mesh_filename+f"-{i}", N=256, max_batch=int(2 ** 18), class_embedding=interpolated_embeddings[i]
+                deep_sdf.mesh.create_meshes(
+                    mesh_decoder,
+                    interpolated_latent_vecs,
+                    [mesh_filename + f"-{i}" for i in range(len(interpolated_latent_vecs))],
+                    N=256,
+                    class_embeddings=interpolated_embeddings,
+                    precision=precision,
+                    shapes_per_batch=args.shapes_per_batch,
+                    num_workers=args.mesh_workers,
                 )
         logging.debug("total time: {}".format(time.time() - start))
@@ -13,85 +13,6 @@ import deep_sdf
 import deep_sdf.workspace as ws
 
 
-def reconstruct(
-    decoder,
-    num_iterations,
-    latent_size,
-    test_sdf,
-    stat,
-    clamp_dist,
-    num_samples=30000,
-    lr=5e-4,
-    l2reg=False,
-    enable_class_embedding = False
-):
-    def adjust_learning_rate(
-        initial_lr, optimizer, num_iterations, decreased_by, adjust_lr_every
-    ):
-        lr = initial_lr * ((1 / decreased_by) ** (num_iterations // adjust_lr_every))
-        for param_group in optimizer.param_groups:
-            param_group["lr"] = lr
-
-    decreased_by = 10
-    adjust_lr_every = int(num_iterations / 2)
-
-    if type(stat) == type(0.1):
-        latent = torch.ones(1, latent_size).normal_(mean=0, std=stat).cuda()
-    else:
-        latent = torch.normal(stat[0].detach(), stat[1].detach()).cuda()
-
-    latent.requires_grad = True
-
-    optimizer = torch.optim.Adam([latent], lr=lr)
-
-    loss_num = 0
-    loss_l1 = torch.nn.L1Loss()
-
-    for e in range(num_iterations):
-
-        decoder.eval()
-        sdf_data = deep_sdf.data.unpack_sdf_samples_from_ram(
-            test_sdf, num_samples
-        ).cuda()
-        xyz = sdf_data[:, 0:3]
-        sdf_gt = sdf_data[:, 3].unsqueeze(1)
-
-        if enable_class_embedding:
-            class_embedding = sdf_data[:, 4].unsqueeze(1)
-            xyz = torch.cat((xyz, class_embedding), dim=1)
-        sdf_gt = torch.clamp(sdf_gt, -clamp_dist, clamp_dist)
-
-        adjust_learning_rate(lr, optimizer, e, decreased_by, adjust_lr_every)
-
-        optimizer.zero_grad()
-
-        latent_inputs = latent.expand(num_samples, -1)
-
-        inputs = torch.cat([latent_inputs, xyz], 1).cuda()
-
-        pred_sdf = decoder(inputs)
-
-        # TODO: why is this needed?
-        if e == 0:
-            pred_sdf = decoder(inputs)
-
-        pred_sdf = torch.clamp(pred_sdf, -clamp_dist, clamp_dist)
-
-        loss = loss_l1(pred_sdf, sdf_gt)
-        if l2reg:
-            loss += 1e-4 * torch.mean(latent.pow(2))
-        loss.backward()
-        optimizer.step()
-
-        if e % 50 == 0:
-            logging.debug(loss.cpu().data.numpy())
-            logging.debug(e)
-            logging.debug(latent.norm())
-        loss_num = loss.cpu().data.numpy()
-
-    return loss_num, latent
-
-
 if __name__ == "__main__":
 
     arg_parser = argparse.ArgumentParser(
@@ -140,14 +61,52 @@ if __name__ == "__main__":
         action="store_true",
         help="Skip meshes which have already been reconstructed.",
     )
+    arg_parser.add_argument(
+        "--octree_levels",
+        dest="octree_levels",
+        default=0,
+        type=int,
+        help="If positive, the SDF grid is sampled coarse-to-fine, starting with a "
+        + "spacing of 2 ** octree_levels voxels and refining only near the surface.",
+    )
+    arg_parser.add_argument(
+        "--batch",
+        dest="shapes_per_batch",
+        default=1,
+        type=int,
+        help="The number of shapes whose latent codes are optimized concurrently.",
+    )
+    arg_parser.add_argument(
+        "--seed",
+        dest="seed",
+        default=None,
+        type=int,
+        help="If set, every shape draws its initial code and samples from its own "
+        + "generator seeded with seed + its index in the split, which makes the "
+        + "reconstructions independent of --batch.",
+    )
+    arg_parser.add_argument(
+        "--exported",
+        dest="exported",
+        default=False,
+        action="store_true",
+        help="If set, the inference decoder exported by export_decoder.py for the "
+        + "checkpoint is used instead of the trained one, and --compile is ignored.",
+    )
+    deep_sdf.add_device_args(arg_parser)
+    deep_sdf.add_precision_args(arg_parser)
+    deep_sdf.add_compile_args(arg_parser)
+    deep_sdf.add_quantize_args(arg_parser)
+    deep_sdf.add_sample_cache_args(arg_parser)
     deep_sdf.add_common_args(arg_parser)
 
     args = arg_parser.parse_args()
 
     deep_sdf.configure_logging(args)
+    deep_sdf.data.set_sdf_samples_cache_size(int(args.sample_cache_mb * 2 ** 20))
 
     def empirical_stat(latent_vecs, indices):
-        lat_mat = torch.zeros(0).cuda()
+        lat_mat = torch.zeros(0, device=latent_vecs[0].device)
         for ind in indices:
             lat_mat = torch.cat([lat_mat, latent_vecs[ind]], 0)
         mean = torch.mean(lat_mat, 0)
@@ -167,20 +126,38 @@ if __name__ == "__main__":
 
     latent_size = specs["CodeLength"]
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
+    device = deep_sdf.get_device(args.device, specs)
+    precision = deep_sdf.get_precision(args.precision, specs)
 
-    decoder = torch.nn.DataParallel(decoder)
+    if args.exported:
+        decoder, saved_model_epoch = ws.load_inference_decoder(
+            args.experiment_directory, args.checkpoint, device
+        )
+    else:
+        decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"])
+
+        saved_model_state = torch.load(
+            os.path.join(
+                args.experiment_directory,
+                ws.model_params_subdir,
+                args.checkpoint + ".pth",
+            ),
+            map_location="cpu",
+        )
+        saved_model_epoch = saved_model_state["epoch"]
+
+        ws.load_model_state_dict(decoder, saved_model_state["model_state_dict"])
 
-    saved_model_state = torch.load(
-        os.path.join(
-            args.experiment_directory, ws.model_params_subdir, args.checkpoint + ".pth"
+        decoder = decoder.to(device)
+        deep_sdf.compile_decoder(
+            decoder, deep_sdf.get_compile_mode(args.compile, specs)
         )
-    )
-    saved_model_epoch = saved_model_state["epoch"]
 
-    decoder.load_state_dict(saved_model_state["model_state_dict"])
+    # refused before any code is optimized rather than at the first mesh
+    deep_sdf.check_mesh_decoder(decoder)
 
-    decoder = decoder.module.cuda()
+    # converted once for all shapes
+    mesh_decoder = deep_sdf.get_mesh_decoder(decoder, args.quantize, precision)
 
     with open(args.split_filename, "r") as f:
         split = json.load(f)
@@ -215,20 +192,13 @@ if __name__ == "__main__":
     if not os.path.isdir(reconstruction_codes_dir):
         os.makedirs(reconstruction_codes_dir)
 
+    reconstructions = []
+
     for ii, npz in enumerate(npz_filenames):
 
         if "npz" not in npz:
             continue
 
-        full_filename = os.path.join(args.data_source, ws.sdf_samples_subdir, npz)
-
-        logging.debug("loading {}".format(npz))
-
-        class_embedding = None
-        if specs["NetworkSpecs"]["class_embedding"]:
-            class_embedding = specs["ClassEmbedding"][class_names[ii]]
-        data_sdf = deep_sdf.data.read_sdf_samples_into_ram(full_filename, class_embedding)
-
         for k in range(repeat):
 
             if rerun > 1:
@@ -251,29 +221,72 @@ if __name__ == "__main__":
             ):
                 continue
 
+            reconstructions.append((ii, npz, mesh_filename, latent_filename))
+
+    for head in range(0, len(reconstructions), args.shapes_per_batch):
+
+        batch = reconstructions[head : head + args.shapes_per_batch]
+
+        generators = None
+        if args.seed is not None:
+            generators = [
+                torch.Generator().manual_seed(args.seed + ii) for ii, _, _, _ in batch
+            ]
+
+        data_sdfs = []
+        class_embeddings = None
+        if specs["NetworkSpecs"]["class_embedding"]:
+            class_embeddings = torch.zeros(len(batch), 9)
+
+        for j, (ii, npz, _, _) in enumerate(batch):
+
+            full_filename = os.path.join(args.data_source, ws.sdf_samples_subdir, npz)
+
+            logging.debug("loading {}".format(npz))
+
+            data_sdf = deep_sdf.data.read_sdf_samples_into_ram(full_filename)
+
+            generator = None if generators is None else generators[j]
+            data_sdf[0] = data_sdf[0][
+                torch.randperm(data_sdf[0].shape[0], generator=generator)
+            ]
+            data_sdf[1] = data_sdf[1][
+                torch.randperm(data_sdf[1].shape[0], generator=generator)
+            ]
+            data_sdfs.append(data_sdf)
+
+            if class_embeddings is not None:
+                class_embeddings[j, specs["ClassEmbedding"][class_names[ii]]] = 1
+
             logging.info("reconstructing {}".format(npz))
 
-            data_sdf[0] = data_sdf[0][torch.randperm(data_sdf[0].shape[0])]
-            data_sdf[1] = data_sdf[1][torch.randperm(data_sdf[1].shape[0])]
-
-            start = time.time()
-            err, latent = reconstruct(
-                decoder,
-                int(args.iterations),
-                latent_size,
-                data_sdf,
-                0.01,  # [emp_mean,emp_var],
-                0.1,
-                num_samples=8000,
-                lr=5e-3,
-                l2reg=True,
-                enable_class_embedding = specs["NetworkSpecs"]["class_embedding"]
-            )
-            logging.debug("reconstruct time: {}".format(time.time() - start))
-            err_sum += err
-            logging.debug("current_error avg: {}".format((err_sum / (ii + 1))))
+        start = time.time()
+        errs, latents = deep_sdf.reconstruct.reconstruct_batch(
+            decoder,
+            int(args.iterations),
+            latent_size,
+            data_sdfs,
+            0.01,  # [emp_mean,emp_var],
+            0.1,
+            num_samples=8000,
+            lr=5e-3,
+            l2reg=True,
+            class_embeddings=class_embeddings,
+            generators=generators,
+            precision=precision,
+        )
+        logging.debug("reconstruct time: {}".format(time.time() - start))
+
+        for j, (ii, npz, mesh_filename, latent_filename) in enumerate(batch):
+
+            err_sum += errs[j]
+            logging.debug("current_error avg: {}".format((err_sum / (head + j + 1))))
             logging.debug(ii)
 
+            # a copy, so that every code file only holds its own code rather than
+            # the storage of the whole batch
+            latent = latents[j : j + 1].detach().cpu().clone()
+
             logging.debug("latent: {}".format(latent.detach().cpu().numpy()))
 
             decoder.eval()
@@ -282,14 +295,21 @@ if __name__ == "__main__":
                 os.makedirs(os.path.dirname(mesh_filename))
 
             if not save_latvec_only:
+                class_embedding = None
+                if class_embeddings is not None:
+                    class_embedding = class_embeddings[j]
                 start = time.time()
                 with torch.no_grad():
                     deep_sdf.mesh.create_mesh(
-                        decoder, latent, mesh_filename, N=256, max_batch=int(2 ** 18), class_embedding=class_embedding
+                        mesh_decoder, latent, mesh_filename, N=256, class_embedding=class_embedding,
+                        octree_levels=args.octree_levels,
+                        precision=precision,
                     )
                 logging.debug("total time: {}".format(time.time() - start))
 
             if not os.path.exists(os.path.dirname(latent_filename)):
                 os.makedirs(os.path.dirname(latent_filename))
 
-            torch.save(latent.unsqueeze(0), latent_filename)
\ No newline at end of file
+            torch.save(latent.unsqueeze(0), latent_filename)
+
+    deep_sdf.data.log_sdf_samples_cache_stats()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# Compares the wall time of meshing the first training shapes of an experiment
+# one by one with create_mesh and together with create_meshes, for a few numbers
+# of shapes per decoder batch and marching cubes workers.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/batched_meshing.py -e <experiment_directory>
+
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+import deep_sdf
+import deep_sdf.workspace as ws
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark batched meshing")
+    arg_parser.add_argument(
+        "--experiment", "-e", dest="experiment_directory", required=True
+    )
+    arg_parser.add_argument("--checkpoint", "-c", dest="checkpoint", default="latest")
+    arg_parser.add_argument("--shapes", dest="num_shapes", default=32, type=int)
+    arg_parser.add_argument("--resolution", "-N", dest="N", default=128, type=int)
+    arg_parser.add_argument(
+        "--mesh_batches", dest="mesh_batches", nargs="+", default=[4, 16], type=int
+    )
+    arg_parser.add_argument(
+        "--mesh_workers", dest="mesh_workers", nargs="+", default=[0, 4], type=int
+    )
+    deep_sdf.add_device_args(arg_parser)
+    args = arg_parser.parse_args()
+
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    device = deep_sdf.get_device(args.device, specs)
+
+    decoder, epoch = ws.load_decoder(
+        args.experiment_directory, specs, args.checkpoint, device=device
+    )
+    latent_vectors = ws.load_latent_vectors(
+        args.experiment_directory, args.checkpoint, device
+    )[: args.num_shapes]
+    num_shapes = len(latent_vectors)
+
+    print("epoch {}, N = {}, {} shapes on {}".format(epoch, args.N, num_shapes, device))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filenames = [os.path.join(tmp_dir, str(i)) for i in range(num_shapes)]
+
+        start = time.time()
+        with torch.no_grad():
+            for latent_vector, filename in zip(latent_vectors, filenames):
+                deep_sdf.mesh.create_mesh(decoder, latent_vector, filename, N=args.N)
+        one_by_one = time.time() - start
+        print(
+            "create_mesh per shape        {:7.2f} s/mesh".format(one_by_one / num_shapes)
+        )
+
+        for shapes_per_batch in args.mesh_batches:
+            for num_workers in args.mesh_workers:
+                start = time.time()
+                with torch.no_grad():
+                    deep_sdf.mesh.create_meshes(
+                        decoder,
+                        latent_vectors,
+                        filenames,
+                        N=args.N,
+                        shapes_per_batch=shapes_per_batch,
+                        num_workers=num_workers,
+                    )
+                seconds = time.time() - start
+                print(
+                    "batch {:3}, {:2} workers      {:7.2f} s/mesh ({:.2f}x)".format(
+                        shapes_per_batch,
+                        num_workers,
+                        seconds / num_shapes,
+                        one_by_one / seconds,
+                    )
+                )
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Compares the per-call time of the decoder's per-point forward pass with the
+# former per-layer name lookups, with the static layer plan, and with the plan
+# scripted or compiled, for small batches where Python overhead dominates and
+# for large ones. Also checks that all of them agree.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/decoder_overhead.py
+
+import argparse
+import json
+import time
+
+import torch
+import torch.nn.functional as F
+
+import deep_sdf
+from networks.deep_sdf_decoder import Decoder
+
+
+def legacy_forward_points(decoder, modules, input):
+    # the loop of Decoder.forward_points before the layer plan, which looked up
+    # every layer by name and tested its flags on every call
+    xyz = input[:, -decoder.input_coord_length :]
+    x = input
+    for layer in range(0, decoder.num_layers - 1):
+        lin = modules.get("lin" + str(layer), None)
+        transformer = modules.get("transformer" + str(layer), None)
+        assert lin is not None or transformer is not None
+        if layer in decoder.latent_in:
+            x = torch.cat([x, input], 1)
+        elif layer != 0 and decoder.xyz_in_all:
+            x = torch.cat([x, xyz], 1)
+        x = lin(x)
+        if layer == decoder.num_layers - 2 and decoder.use_tanh:
+            x = torch.tanh(x)
+        if layer < decoder.num_layers - 2:
+            if (
+                decoder.norm_layers is not None
+                and layer in decoder.norm_layers
+                and not decoder.weight_norm
+            ):
+                x = modules["bn" + str(layer)](x)
+            x = F.relu(x)
+            if decoder.dropout is not None and layer in decoder.dropout:
+                x = F.dropout(x, p=decoder.dropout_prob, training=decoder.training)
+    return torch.tanh(x)
+
+
+def time_calls(function, num_calls):
+    with torch.no_grad():
+        for _ in range(3):
+            function()
+        start = time.time()
+        for _ in range(num_calls):
+            function()
+    return (time.time() - start) / num_calls
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark decoder overhead")
+    arg_parser.add_argument(
+        "--specs", dest="specs", default="examples/sofas/specs.json"
+    )
+    arg_parser.add_argument(
+        "--points", dest="points", nargs="+", default=[256, 4096, 65536], type=int
+    )
+    arg_parser.add_argument("--calls", dest="num_calls", default=50, type=int)
+    deep_sdf.add_device_args(arg_parser)
+    args = arg_parser.parse_args()
+
+    with open(args.specs) as f:
+        specs = json.load(f)
+    device = deep_sdf.get_device(args.device, specs)
+
+    decoders = {}
+    for mode in deep_sdf.compile_modes:
+        torch.manual_seed(0)
+        decoders[mode] = Decoder(specs["CodeLength"], **specs["NetworkSpecs"])
+        decoders[mode] = decoders[mode].to(device).eval()
+        deep_sdf.compile_decoder(decoders[mode], mode)
+
+    decoder = decoders["none"]
+    modules = {}
+    for layer, block in enumerate(decoder.plan.layers):
+        modules["lin" + str(layer)] = block.lin
+        modules["bn" + str(layer)] = block.bn
+
+    for num_points in args.points:
+        input = torch.randn(
+            num_points, specs["CodeLength"] + decoder.input_coord_length, device=device
+        )
+
+        reference = legacy_forward_points(decoder, modules, input)
+        for mode, d in decoders.items():
+            with torch.no_grad():
+                difference = (d(input) - reference).abs().max().item()
+            assert difference < 1e-4, (mode, difference)
+
+        legacy = time_calls(
+            lambda: legacy_forward_points(decoder, modules, input), args.num_calls
+        )
+        print("{} points".format(num_points))
+        print("  name lookups       {:8.3f} ms".format(legacy * 1e3))
+        for mode, d in decoders.items():
+            seconds = time_calls(lambda: d(input), args.num_calls)
+            print(
+                "  plan, {:<12} {:8.3f} ms ({:.2f}x)".format(
+                    mode, seconds * 1e3, legacy / seconds
+                )
+            )
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Runs a few training steps of a decoder under DistributedDataParallel in CPU
+# processes, with the batch split in two as train_deep_sdf.py does it, for the
+# decoder of a specification file and for a transformer decoder with each
+# attention. Checks that every step finishes and that all ranks end up with the
+# same decoder gradients.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/distributed_check.py
+
+import argparse
+import contextlib
+import json
+
+import torch
+import torch.distributed as dist
+
+import deep_sdf.distributed as distributed
+from networks.deep_sdf_decoder import Decoder
+
+
+def transformer_specs(attention):
+    return {
+        "dims": [64, 64, 64, 64],
+        "dropout": [0, 1, 2, 3],
+        "dropout_prob": 0.2,
+        "norm_layers": [0, 1, 2, 3],
+        "latent_in": [2],
+        "weight_norm": True,
+        "use_transformers": True,
+        "transformer_hidden_size": 128,
+        "num_heads": 4,
+        "transformer_attention": attention,
+    }
+
+
+def check(name, latent_size, network_specs, num_steps, batch_split):
+    torch.manual_seed(0)
+    decoder = Decoder(latent_size, **network_specs)
+    decoder = torch.nn.parallel.DistributedDataParallel(
+        decoder, find_unused_parameters=decoder.has_unused_parameters
+    )
+
+    generator = torch.Generator().manual_seed(distributed.get_rank())
+    for _ in range(num_steps):
+        decoder.zero_grad()
+        # scenes of 32 points, decoded as 2 scenes per subbatch
+        inputs = torch.randn(batch_split, 2, 32, latent_size + 3, generator=generator)
+        for i in range(batch_split):
+            if i < batch_split - 1:
+                sync_context = decoder.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                decoder(inputs[i]).abs().mean().backward()
+
+    grads = torch.cat(
+        [p.grad.flatten() for p in decoder.parameters() if p.grad is not None]
+    )
+    gathered = [torch.empty_like(grads) for _ in range(distributed.get_world_size())]
+    dist.all_gather(gathered, grads)
+    if not all(torch.equal(gathered[0], g) for g in gathered):
+        raise Exception("{}: the decoder gradients differ across ranks".format(name))
+
+    if distributed.is_main_process():
+        print(
+            "{:<24} ok, find_unused_parameters={}".format(
+                name, decoder.module.has_unused_parameters
+            )
+        )
+
+
+def run(specs_filename, num_steps, batch_split):
+    distributed.init_distributed(torch.device("cpu"))
+
+    with open(specs_filename) as f:
+        specs = json.load(f)
+
+    check(
+        specs_filename, specs["CodeLength"], specs["NetworkSpecs"], num_steps, batch_split
+    )
+    for attention in (None, "point", "group", "scene"):
+        check(
+            "transformer ({})".format(attention),
+            16,
+            transformer_specs(attention),
+            num_steps,
+            batch_split,
+        )
+
+    distributed.cleanup_distributed()
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Check distributed training")
+    arg_parser.add_argument(
+        "--specs", dest="specs", default="examples/sofas/specs.json"
+    )
+    arg_parser.add_argument("--nprocs", dest="nprocs", default=2, type=int)
+    arg_parser.add_argument("--steps", dest="num_steps", default=2, type=int)
+    arg_parser.add_argument("--batch_split", dest="batch_split", default=2, type=int)
+    args = arg_parser.parse_args()
+
+    distributed.spawn_distributed(
+        run, (args.specs, args.num_steps, args.batch_split), args.nprocs
+    )
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# Compares the per-mesh write time of the previous plyfile based writer with
+# deep_sdf.mesh.write_ply on a marching cubes mesh of a synthetic SDF volume.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/ply_writer.py
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import plyfile
+import skimage.measure
+
+import deep_sdf.mesh
+
+
+def write_ply_plyfile(ply_filename_out, mesh_points, faces):
+    # the writer used by convert_sdf_samples_to_ply before it was vectorized
+    num_verts = mesh_points.shape[0]
+    num_faces = faces.shape[0]
+
+    verts_tuple = np.zeros((num_verts,), dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
+
+    for i in range(0, num_verts):
+        verts_tuple[i] = tuple(mesh_points[i, :])
+
+    faces_building = []
+    for i in range(0, num_faces):
+        faces_building.append(((faces[i, :].tolist(),)))
+    faces_tuple = np.array(faces_building, dtype=[("vertex_indices", "i4", (3,))])
+
+    el_verts = plyfile.PlyElement.describe(verts_tuple, "vertex")
+    el_faces = plyfile.PlyElement.describe(faces_tuple, "face")
+
+    ply_data = plyfile.PlyData([el_verts, el_faces])
+    ply_data.write(ply_filename_out)
+
+
+def sdf_volume(N):
+    # a torus, which gives a mesh of realistic size for a ShapeNet shape
+    grid = np.linspace(-1, 1, N, dtype=np.float32)
+    x, y, z = np.meshgrid(grid, grid, grid, indexing="ij")
+    return np.sqrt((np.sqrt(x ** 2 + y ** 2) - 0.6) ** 2 + z ** 2) - 0.25
+
+
+def time_writer(writer, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        writer()
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark the .ply writer")
+    arg_parser.add_argument("--resolution", "-N", dest="N", default=256, type=int)
+    arg_parser.add_argument("--repeats", dest="repeats", default=3, type=int)
+    args = arg_parser.parse_args()
+
+    verts, faces, normals, _ = skimage.measure.marching_cubes(
+        sdf_volume(args.N), level=0.0, spacing=[2.0 / (args.N - 1)] * 3
+    )
+    verts = verts - 1.0
+
+    print(
+        "N = {}: {} vertices, {} faces".format(args.N, verts.shape[0], faces.shape[0])
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        before = time_writer(
+            lambda: write_ply_plyfile(os.path.join(tmp_dir, "a.ply"), verts, faces),
+            args.repeats,
+        )
+        after = time_writer(
+            lambda: deep_sdf.mesh.write_ply(os.path.join(tmp_dir, "b.ply"), verts, faces),
+            args.repeats,
+        )
+        with_normals = time_writer(
+            lambda: deep_sdf.mesh.write_ply(
+                os.path.join(tmp_dir, "c.ply"), verts, faces, normals
+            ),
+            args.repeats,
+        )
+
+        # both files describe the same mesh
+        before_mesh = plyfile.PlyData.read(os.path.join(tmp_dir, "a.ply"))
+        after_mesh = plyfile.PlyData.read(os.path.join(tmp_dir, "b.ply"))
+        assert np.array_equal(
+            before_mesh["vertex"].data["x"], after_mesh["vertex"].data["x"]
+        )
+        assert np.array_equal(
+            np.vstack(before_mesh["face"].data["vertex_indices"]),
+            np.vstack(after_mesh["face"].data["vertex_indices"]),
+        )
+
+    print("plyfile writer:            {:.3f} s".format(before))
+    print("vectorized writer:         {:.3f} s ({:.1f}x)".format(after, before / after))
+    print("vectorized, with normals:  {:.3f} s".format(with_normals))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Compares the throughput and peak memory of a forward and backward pass through
+# a transformer layer of the decoder with the former nn.MultiheadAttention over a
+# sequence of length 1, and with point, group and scene attention, on scenes of
+# 16384 points. Peak memory is only measured on CUDA.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/point_attention.py
+
+import argparse
+import time
+
+import torch
+
+import deep_sdf
+from networks.deep_sdf_decoder import TransformerLayer
+
+
+def legacy_forward(layer, input):
+    # TransformerLayer.forward before the attention modes, every point attends to
+    # itself through a fake sequence dimension
+    x = input.unsqueeze(0)
+    attn_output, _ = layer.attn(x, x, x)
+    x = layer.norm(input + attn_output)
+    ff_output = layer.ff(x)
+    x = layer.norm2(x + ff_output)
+    return x.squeeze(0)
+
+
+def measure(function, input, device, repeats):
+    times = []
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    for _ in range(repeats + 1):
+        input.grad = None
+        start = time.time()
+        function(input).sum().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(time.time() - start)
+    peak = None
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # the first pass warms up
+    return min(times[1:]), peak
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark point attention")
+    arg_parser.add_argument("--scenes", dest="num_scenes", default=4, type=int)
+    arg_parser.add_argument("--points", dest="num_points", default=16384, type=int)
+    arg_parser.add_argument("--width", dest="width", default=512, type=int)
+    arg_parser.add_argument("--heads", dest="num_heads", default=16, type=int)
+    arg_parser.add_argument("--group_size", dest="group_size", default=64, type=int)
+    arg_parser.add_argument(
+        "--chunk_sizes", dest="chunk_sizes", nargs="+", default=[256, 1024], type=int
+    )
+    arg_parser.add_argument("--repeats", dest="repeats", default=3, type=int)
+    deep_sdf.add_device_args(arg_parser)
+    args = arg_parser.parse_args()
+
+    device = deep_sdf.get_device(args.device)
+
+    def make_layer(attention, chunk_size=256):
+        torch.manual_seed(0)
+        return TransformerLayer(
+            args.width,
+            args.width,
+            1024,
+            args.num_heads,
+            attention=attention,
+            group_size=args.group_size,
+            chunk_size=chunk_size,
+        ).to(device)
+
+    input = torch.randn(
+        args.num_scenes, args.num_points, args.width, device=device, requires_grad=True
+    )
+    flat_input = input.detach().view(-1, args.width).requires_grad_()
+
+    # point attention is the former layer, computed as a linear layer
+    legacy_layer = make_layer("point")
+    with torch.no_grad():
+        difference = (
+            legacy_forward(legacy_layer, flat_input) - legacy_layer(flat_input)
+        ).abs().max().item()
+    print("point attention vs. former layer: max difference {:.2e}".format(difference))
+
+    runs = [
+        ("former (length 1)", lambda x: legacy_forward(legacy_layer, x), flat_input),
+        ("point", make_layer("point"), flat_input),
+        ("group ({})".format(args.group_size), make_layer("group"), input),
+    ]
+    for chunk_size in args.chunk_sizes:
+        runs.append(
+            (
+                "scene, chunks of {}".format(chunk_size),
+                make_layer("scene", chunk_size),
+                input,
+            )
+        )
+
+    num_points = args.num_scenes * args.num_points
+    for name, function, x in runs:
+        seconds, peak = measure(function, x, device, args.repeats)
+        line = "{:<24} {:8.1f} ms, {:6.2f} M points/s".format(
+            name, seconds * 1e3, num_points / seconds / 1e6
+        )
+        if peak is not None:
+            line += ", peak {:8.1f} MB".format(peak)
+        print(line)
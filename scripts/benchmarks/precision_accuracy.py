@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Meshes the first training shapes of an experiment from their latent codes in
+# fp32 and in reduced precision, and compares the meshing time and the chamfer
+# distances to the ground truth surface samples, and to the fp32 meshes.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/precision_accuracy.py -e <experiment_directory>
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import trimesh
+
+import deep_sdf
+import deep_sdf.workspace as ws
+
+
+def get_class_embedding(specs, class_name):
+    if not specs["NetworkSpecs"].get("class_embedding", False):
+        return None
+    class_embedding = torch.zeros(specs["NetworkSpecs"].get("num_classes", 9))
+    class_embedding[specs["ClassEmbedding"][class_name]] = 1
+    return class_embedding
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        description="Compare meshes decoded in reduced precision with fp32"
+    )
+    arg_parser.add_argument(
+        "--experiment", "-e", dest="experiment_directory", required=True
+    )
+    arg_parser.add_argument("--checkpoint", "-c", dest="checkpoint", default="latest")
+    arg_parser.add_argument("--shapes", dest="num_shapes", default=10, type=int)
+    arg_parser.add_argument("--resolution", "-N", dest="N", default=128, type=int)
+    arg_parser.add_argument(
+        "--precisions", dest="precisions", nargs="+", default=["bf16"]
+    )
+    deep_sdf.add_device_args(arg_parser)
+    args = arg_parser.parse_args()
+
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    device = deep_sdf.get_device(args.device, specs)
+
+    decoder, epoch = ws.load_decoder(
+        args.experiment_directory, specs, args.checkpoint, device=device
+    )
+    latent_vectors = ws.load_latent_vectors(
+        args.experiment_directory, args.checkpoint, device
+    )
+
+    with open(specs["TrainSplit"], "r") as f:
+        train_split = json.load(f)
+    data_source = specs["DataSource"]
+    instance_filenames = deep_sdf.data.get_instance_filenames(data_source, train_split)
+
+    precisions = ["fp32"] + [p for p in args.precisions if p != "fp32"]
+    times = {p: [] for p in precisions}
+    chamfer_to_gt = {p: [] for p in precisions}
+    chamfer_to_fp32 = {p: [] for p in precisions[1:]}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i in range(min(args.num_shapes, len(instance_filenames))):
+            dataset, class_name, instance_name = instance_filenames[i].split("/")
+            instance_name = instance_name[: -len(".npz")]
+            class_embedding = get_class_embedding(specs, class_name)
+
+            meshes = {}
+            for precision in precisions:
+                mesh_filename = os.path.join(tmp_dir, "{}-{}".format(i, precision))
+                start = time.time()
+                with torch.no_grad():
+                    deep_sdf.mesh.create_mesh(
+                        decoder,
+                        latent_vectors[i],
+                        mesh_filename,
+                        N=args.N,
+                        class_embedding=class_embedding,
+                        precision=precision,
+                    )
+                times[precision].append(time.time() - start)
+                meshes[precision] = trimesh.load(mesh_filename + ".ply")
+
+            # the surface within the distance to fp32 is what reduced precision costs
+            fp32_points = trimesh.points.PointCloud(
+                trimesh.sample.sample_surface(meshes["fp32"], 30000)[0]
+            )
+            for precision in precisions[1:]:
+                chamfer_to_fp32[precision].append(
+                    deep_sdf.metrics.chamfer.compute_trimesh_chamfer(
+                        fp32_points, meshes[precision], 0.0, 1.0
+                    )
+                )
+
+            surface_samples_filename = os.path.join(
+                data_source,
+                ws.surface_samples_subdir,
+                dataset,
+                class_name,
+                instance_name + ".ply",
+            )
+            normalization_params_filename = ws.get_normalization_params_filename(
+                data_source, dataset, class_name, instance_name
+            )
+            if os.path.isfile(surface_samples_filename) and os.path.isfile(
+                normalization_params_filename
+            ):
+                ground_truth_points = trimesh.load(surface_samples_filename)
+                normalization_params = np.load(normalization_params_filename)
+                for precision in precisions:
+                    chamfer_to_gt[precision].append(
+                        deep_sdf.metrics.chamfer.compute_trimesh_chamfer(
+                            ground_truth_points,
+                            meshes[precision],
+                            normalization_params["offset"],
+                            normalization_params["scale"],
+                        )
+                    )
+
+    print(
+        "epoch {}, N = {}, {} shapes on {}".format(
+            epoch, args.N, len(times["fp32"]), device
+        )
+    )
+    for precision in precisions:
+        line = "{:5} {:7.2f} s/mesh".format(precision, np.mean(times[precision]))
+        if len(chamfer_to_gt[precision]) > 0:
+            line += ", chamfer to ground truth: mean {:.6f}, median {:.6f}".format(
+                np.mean(chamfer_to_gt[precision]), np.median(chamfer_to_gt[precision])
+            )
+        if precision != "fp32":
+            line += ", chamfer to fp32: mean {:.2e}, max {:.2e}".format(
+                np.mean(chamfer_to_fp32[precision]), np.max(chamfer_to_fp32[precision])
+            )
+        print(line)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# Meshes the first shapes of a split from the latent codes of an experiment on
+# the CPU with the fp32 decoder and with its int8 dynamically quantized copy, and
+# compares the mesh extraction time, which leaves out the one-off quantization,
+# and the chamfer distances to the ground truth surface samples, and of the int8
+# meshes to the fp32 ones. The split defaults to the training split, whose latent
+# codes are saved with the checkpoint.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/quantization_accuracy.py -e <experiment_directory>
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+import trimesh
+
+import deep_sdf
+import deep_sdf.workspace as ws
+
+
+def get_class_embedding(specs, class_name):
+    if not specs["NetworkSpecs"].get("class_embedding", False):
+        return None
+    class_embedding = torch.zeros(specs["NetworkSpecs"].get("num_classes", 9))
+    class_embedding[specs["ClassEmbedding"][class_name]] = 1
+    return class_embedding
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        description="Compare meshes decoded by an int8 quantized decoder with fp32"
+    )
+    arg_parser.add_argument(
+        "--experiment", "-e", dest="experiment_directory", required=True
+    )
+    arg_parser.add_argument("--checkpoint", "-c", dest="checkpoint", default="latest")
+    arg_parser.add_argument("--split", "-s", dest="split_filename", default=None)
+    arg_parser.add_argument("--shapes", dest="num_shapes", default=10, type=int)
+    arg_parser.add_argument("--resolution", "-N", dest="N", default=128, type=int)
+    arg_parser.add_argument("--threads", dest="num_threads", default=None, type=int)
+    args = arg_parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+
+    # dynamically quantized layers only run on the CPU
+    decoder, epoch = ws.load_decoder(
+        args.experiment_directory, specs, args.checkpoint, device="cpu"
+    )
+    latent_vectors = ws.load_latent_vectors(
+        args.experiment_directory, args.checkpoint, "cpu"
+    )
+
+    # converted once, as the meshing scripts do, and timed on its own
+    start = time.time()
+    decoders = {
+        "fp32": decoder,
+        "int8": deep_sdf.get_mesh_decoder(decoder, quantize=True),
+    }
+    quantization_time = time.time() - start
+
+    data_source = specs["DataSource"]
+    with open(specs["TrainSplit"], "r") as f:
+        train_filenames = deep_sdf.data.get_instance_filenames(
+            data_source, json.load(f)
+        )
+    split_filenames = train_filenames
+    if args.split_filename is not None:
+        with open(args.split_filename, "r") as f:
+            split_filenames = deep_sdf.data.get_instance_filenames(
+                data_source, json.load(f)
+            )
+    latent_indices = {filename: i for i, filename in enumerate(train_filenames)}
+
+    modes = ["fp32", "int8"]
+    times = {m: [] for m in modes}
+    chamfer_to_gt = {m: [] for m in modes}
+    chamfer_to_fp32 = []
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, filename in enumerate(split_filenames[: args.num_shapes]):
+            if filename not in latent_indices:
+                raise Exception(
+                    '"{}" is not a training shape and has no latent code'.format(
+                        filename
+                    )
+                )
+            dataset, class_name, instance_name = filename.split("/")
+            instance_name = instance_name[: -len(".npz")]
+            class_embedding = get_class_embedding(specs, class_name)
+
+            meshes = {}
+            for mode in modes:
+                mesh_filename = os.path.join(tmp_dir, "{}-{}".format(i, mode))
+                start = time.time()
+                with torch.no_grad():
+                    deep_sdf.mesh.create_mesh(
+                        decoders[mode],
+                        latent_vectors[latent_indices[filename]],
+                        mesh_filename,
+                        N=args.N,
+                        class_embedding=class_embedding,
+                    )
+                times[mode].append(time.time() - start)
+                meshes[mode] = trimesh.load(mesh_filename + ".ply")
+
+            fp32_points = trimesh.points.PointCloud(
+                trimesh.sample.sample_surface(meshes["fp32"], 30000)[0]
+            )
+            chamfer_to_fp32.append(
+                deep_sdf.metrics.chamfer.compute_trimesh_chamfer(
+                    fp32_points, meshes["int8"], 0.0, 1.0
+                )
+            )
+
+            surface_samples_filename = os.path.join(
+                data_source,
+                ws.surface_samples_subdir,
+                dataset,
+                class_name,
+                instance_name + ".ply",
+            )
+            normalization_params_filename = ws.get_normalization_params_filename(
+                data_source, dataset, class_name, instance_name
+            )
+            if os.path.isfile(surface_samples_filename) and os.path.isfile(
+                normalization_params_filename
+            ):
+                ground_truth_points = trimesh.load(surface_samples_filename)
+                normalization_params = np.load(normalization_params_filename)
+                for mode in modes:
+                    chamfer_to_gt[mode].append(
+                        deep_sdf.metrics.chamfer.compute_trimesh_chamfer(
+                            ground_truth_points,
+                            meshes[mode],
+                            normalization_params["offset"],
+                            normalization_params["scale"],
+                        )
+                    )
+
+    print(
+        "epoch {}, N = {}, {} shapes, {} threads, quantized in {:.2f} s".format(
+            epoch,
+            args.N,
+            len(times["fp32"]),
+            torch.get_num_threads(),
+            quantization_time,
+        )
+    )
+    for mode in modes:
+        line = "{:5} {:7.2f} s/mesh ({:.2f}x)".format(
+            mode, np.mean(times[mode]), np.mean(times["fp32"]) / np.mean(times[mode])
+        )
+        if len(chamfer_to_gt[mode]) > 0:
+            line += ", chamfer to ground truth: mean {:.6f}, median {:.6f}".format(
+                np.mean(chamfer_to_gt[mode]), np.median(chamfer_to_gt[mode])
+            )
+        if mode == "int8":
+            line += ", chamfer to fp32: mean {:.2e}, max {:.2e}".format(
+                np.mean(chamfer_to_fp32), np.max(chamfer_to_fp32)
+            )
+        print(line)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# Reconstructs the first shapes of a split one at a time and all together with
+# reconstruct_batch, seeded per shape as reconstruct_original.py --seed does it,
+# and compares the codes and losses of both and the time they take. The codes
+# only differ by the rounding of the decoder's batched matrix products.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/reconstruction_batching.py -e <experiment_directory> -s <split>
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+import deep_sdf
+import deep_sdf.workspace as ws
+
+
+def load_shape(data_source, npz, seed):
+    # the generator draws the shuffle of the samples, then the initial code and
+    # every subsample, the same way no matter which shapes are batched together
+    generator = torch.Generator().manual_seed(seed)
+    data_sdf = deep_sdf.data.read_sdf_samples_into_ram(
+        os.path.join(data_source, ws.sdf_samples_subdir, npz)
+    )
+    for i in range(2):
+        data_sdf[i] = data_sdf[i][
+            torch.randperm(data_sdf[i].shape[0], generator=generator)
+        ]
+    return data_sdf, generator
+
+
+def reconstruct(decoder, specs, shapes, args):
+    data_sdfs = []
+    generators = []
+    class_embeddings = None
+    if specs["NetworkSpecs"].get("class_embedding", False):
+        class_embeddings = torch.zeros(len(shapes), 9)
+    for j, (ii, npz, class_name) in enumerate(shapes):
+        data_sdf, generator = load_shape(args.data_source, npz, args.seed + ii)
+        data_sdfs.append(data_sdf)
+        generators.append(generator)
+        if class_embeddings is not None:
+            class_embeddings[j, specs["ClassEmbedding"][class_name]] = 1
+
+    errs, latents = deep_sdf.reconstruct.reconstruct_batch(
+        decoder,
+        args.iterations,
+        specs["CodeLength"],
+        data_sdfs,
+        0.01,
+        0.1,
+        num_samples=8000,
+        lr=5e-3,
+        l2reg=True,
+        class_embeddings=class_embeddings,
+        generators=generators,
+    )
+    return np.asarray(errs), latents.detach().cpu()
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(
+        description="Compare batched and one by one reconstruction"
+    )
+    arg_parser.add_argument(
+        "--experiment", "-e", dest="experiment_directory", required=True
+    )
+    arg_parser.add_argument("--checkpoint", "-c", dest="checkpoint", default="latest")
+    arg_parser.add_argument("--data", "-d", dest="data_source", default="data")
+    arg_parser.add_argument("--split", "-s", dest="split_filename", required=True)
+    arg_parser.add_argument("--shapes", dest="num_shapes", default=8, type=int)
+    arg_parser.add_argument("--iterations", dest="iterations", default=100, type=int)
+    arg_parser.add_argument("--seed", dest="seed", default=0, type=int)
+    deep_sdf.add_device_args(arg_parser)
+    deep_sdf.add_sample_cache_args(arg_parser)
+    args = arg_parser.parse_args()
+
+    # every shape is read twice, once per mode
+    deep_sdf.data.set_sdf_samples_cache_size(int(args.sample_cache_mb * 2 ** 20))
+
+    specs = ws.load_experiment_specifications(args.experiment_directory)
+    device = deep_sdf.get_device(args.device, specs)
+
+    decoder, epoch = ws.load_decoder(
+        args.experiment_directory, specs, args.checkpoint, device=device
+    )
+
+    with open(args.split_filename, "r") as f:
+        split = json.load(f)
+    npz_filenames, class_names = deep_sdf.data.get_instance_classnames_filenames(
+        args.data_source, split
+    )
+    shapes = [
+        (ii, npz, class_name)
+        for ii, (npz, class_name) in enumerate(zip(npz_filenames, class_names))
+    ][: args.num_shapes]
+
+    start = time.time()
+    one_by_one = [reconstruct(decoder, specs, [shape], args) for shape in shapes]
+    one_by_one_time = time.time() - start
+    errs = np.concatenate([e for e, _ in one_by_one])
+    latents = torch.cat([l for _, l in one_by_one], 0)
+
+    start = time.time()
+    batched_errs, batched_latents = reconstruct(decoder, specs, shapes, args)
+    batched_time = time.time() - start
+
+    print(
+        "epoch {}, {} shapes, {} iterations on {}".format(
+            epoch, len(shapes), args.iterations, device
+        )
+    )
+    print(
+        "--batch 1: {:.2f} s/shape, --batch {}: {:.2f} s/shape ({:.2f}x)".format(
+            one_by_one_time / len(shapes),
+            len(shapes),
+            batched_time / len(shapes),
+            one_by_one_time / batched_time,
+        )
+    )
+    print(
+        "max difference: {:.3e} in the codes ({}), {:.3e} in the losses".format(
+            (batched_latents - latents).abs().max().item(),
+            "identical" if torch.equal(batched_latents, latents) else "not identical",
+            np.abs(batched_errs - errs).max(),
+        )
+    )
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# Compares the batch throughput of SDFSamples with random row subsampling and
+# with contiguous windows over the shuffled samples, on synthetic shapes, and
+# checks that both draw every sample about equally often.
+# Run from the repository root: PYTHONPATH=. python scripts/benchmarks/window_sampling.py
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+import deep_sdf.data
+import deep_sdf.workspace as ws
+
+
+def write_shapes(data_source, num_shapes, num_samples):
+    class_dir = os.path.join(data_source, ws.sdf_samples_subdir, "synthetic", "shapes")
+    os.makedirs(class_dir)
+    for i in range(num_shapes):
+        pos = np.random.rand(num_samples, 4).astype(np.float32)
+        neg = np.random.rand(num_samples, 4).astype(np.float32)
+        neg[:, 3] *= -1
+        # the row index of every sample in its sdf, to count how often it is drawn
+        pos[:, 3] = np.arange(num_samples)
+        neg[:, 3] = -1 - np.arange(num_samples)
+        np.savez(os.path.join(class_dir, "{}.npz".format(i)), pos=pos, neg=neg)
+    return {"synthetic": {"shapes": [str(i) for i in range(num_shapes)]}}
+
+
+def run(dataset, num_batches, batch_size):
+    num_rows = dataset.ram_offsets[0, 2] - dataset.ram_offsets[0, 0]
+    counts = np.zeros(num_rows, dtype=np.int64)
+    generator = torch.Generator().manual_seed(0)
+
+    times = []
+    for _ in range(num_batches):
+        indices = torch.randperm(len(dataset), generator=generator)[:batch_size]
+        start = time.time()
+        batch, _ = dataset.sample_batch(indices)
+        times.append(time.time() - start)
+
+        # how often the samples of shape 0 were drawn
+        for b in (indices == 0).nonzero().view(-1).tolist():
+            sdf = batch[b, :, 3].long().numpy()
+            np.add.at(counts, np.where(sdf >= 0, sdf, counts.shape[0] // 2 - 1 - sdf), 1)
+
+    return np.median(times), counts
+
+
+if __name__ == "__main__":
+
+    arg_parser = argparse.ArgumentParser(description="Benchmark window subsampling")
+    arg_parser.add_argument("--shapes", dest="num_shapes", default=64, type=int)
+    arg_parser.add_argument("--samples", dest="num_samples", default=125000, type=int)
+    arg_parser.add_argument("--subsample", dest="subsample", default=16384, type=int)
+    arg_parser.add_argument("--batch_size", dest="batch_size", default=32, type=int)
+    arg_parser.add_argument("--batches", dest="num_batches", default=200, type=int)
+    args = arg_parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_source:
+        split = write_shapes(data_source, args.num_shapes, args.num_samples)
+
+        results = {}
+        for windows in [False, True]:
+            dataset = deep_sdf.data.SDFSamples(
+                data_source,
+                split,
+                args.subsample,
+                load_ram=True,
+                contiguous_windows=windows,
+            )
+            results[windows] = run(dataset, args.num_batches, args.batch_size)
+
+    samples_per_batch = args.batch_size * args.subsample
+    for windows, name in [(False, "random rows"), (True, "contiguous windows")]:
+        seconds, counts = results[windows]
+        print(
+            "{:<20} {:7.2f} ms/batch, {:6.1f} M samples/s, "
+            "draws per sample of shape 0: mean {:.2f}, std {:.2f}".format(
+                name,
+                seconds * 1e3,
+                samples_per_batch / seconds / 1e6,
+                counts.mean(),
+                counts.std(),
+            )
+        )
+    print("speedup: {:.1f}x".format(results[False][0] / results[True][0]))
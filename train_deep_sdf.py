@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # Copyright 2004-present Facebook. All Rights Reserved.
 
+import contextlib
 import torch
 import torch.utils.data as data_utils
 import signal
@@ -12,6 +13,7 @@ import json
 import time
 
 import deep_sdf
+import deep_sdf.distributed as distributed
 import deep_sdf.workspace as ws
 
 
@@ -88,23 +90,35 @@ def get_learning_rate_schedules(specs):
     return schedules
 
 
-def save_model(experiment_directory, filename, decoder, epoch):
+def save_checkpoint_file(obj, filename, checkpoint_writer=None):
+
+    if checkpoint_writer is None:
+        deep_sdf.save_atomic(obj, filename)
+    else:
+        checkpoint_writer.save(obj, filename)
+
+
+def save_model(experiment_directory, filename, decoder, epoch, checkpoint_writer=None):
 
     model_params_dir = ws.get_model_params_dir(experiment_directory, True)
 
-    torch.save(
-        {"epoch": epoch, "model_state_dict": decoder.state_dict()},
+    save_checkpoint_file(
+        {"epoch": epoch, "model_state_dict": ws.get_model_state_dict(decoder)},
         os.path.join(model_params_dir, filename),
+        checkpoint_writer,
     )
 
 
-def save_optimizer(experiment_directory, filename, optimizer, epoch):
+def save_optimizer(
+    experiment_directory, filename, optimizer_state_dict, epoch, checkpoint_writer=None
+):
 
     optimizer_params_dir = ws.get_optimizer_params_dir(experiment_directory, True)
 
-    torch.save(
-        {"epoch": epoch, "optimizer_state_dict": optimizer.state_dict()},
+    save_checkpoint_file(
+        {"epoch": epoch, "optimizer_state_dict": optimizer_state_dict},
         os.path.join(optimizer_params_dir, filename),
+        checkpoint_writer,
     )
 
 
@@ -119,22 +133,26 @@ def load_optimizer(experiment_directory, filename, optimizer):
             'optimizer state dict "{}" does not exist'.format(full_filename)
         )
 
-    data = torch.load(full_filename)
+    data = torch.load(full_filename, map_location="cpu")
 
-    optimizer.load_state_dict(data["optimizer_state_dict"])
+    # the latent codes are the second param group, sharded across ranks
+    optimizer.load_state_dict(
+        distributed.shard_optimizer_state(data["optimizer_state_dict"], 1)
+    )
 
     return data["epoch"]
 
 
-def save_latent_vectors(experiment_directory, filename, latent_vec, epoch):
+def save_latent_vectors(
+    experiment_directory, filename, all_latents, epoch, checkpoint_writer=None
+):
 
     latent_codes_dir = ws.get_latent_codes_dir(experiment_directory, True)
 
-    all_latents = latent_vec.state_dict()
-
-    torch.save(
+    save_checkpoint_file(
         {"epoch": epoch, "latent_codes": all_latents},
         os.path.join(latent_codes_dir, filename),
+        checkpoint_writer,
     )
 
 
@@ -148,84 +166,61 @@ def load_latent_vectors(experiment_directory, filename, lat_vecs):
     if not os.path.isfile(full_filename):
         raise Exception('latent state file "{}" does not exist'.format(full_filename))
 
-    data = torch.load(full_filename)
+    data = torch.load(full_filename, map_location="cpu")
 
+    # when training distributed, lat_vecs only holds the codes of this rank
     if isinstance(data["latent_codes"], torch.Tensor):
 
+        latent_codes = distributed.shard_rows(data["latent_codes"])
+
         # for backwards compatibility
-        if not lat_vecs.num_embeddings == data["latent_codes"].size()[0]:
+        if not lat_vecs.num_embeddings == latent_codes.size()[0]:
             raise Exception(
                 "num latent codes mismatched: {} vs {}".format(
-                    lat_vecs.num_embeddings, data["latent_codes"].size()[0]
+                    lat_vecs.num_embeddings, latent_codes.size()[0]
                 )
             )
 
-        if not lat_vecs.embedding_dim == data["latent_codes"].size()[2]:
+        if not lat_vecs.embedding_dim == latent_codes.size()[2]:
             raise Exception("latent code dimensionality mismatch")
 
-        for i, lat_vec in enumerate(data["latent_codes"]):
+        for i, lat_vec in enumerate(latent_codes):
             lat_vecs.weight.data[i, :] = lat_vec
 
     else:
-        lat_vecs.load_state_dict(data["latent_codes"])
+        latent_codes = data["latent_codes"]
+        latent_codes["weight"] = distributed.shard_rows(latent_codes["weight"])
+        lat_vecs.load_state_dict(latent_codes)
 
     return data["epoch"]
 
 
-def save_logs(
-    experiment_directory,
-    loss_log,
-    lr_log,
-    timing_log,
-    lat_mag_log,
-    param_mag_log,
-    epoch,
-):
-
-    torch.save(
-        {
-            "epoch": epoch,
-            "loss": loss_log,
-            "learning_rate": lr_log,
-            "timing": timing_log,
-            "latent_magnitude": lat_mag_log,
-            "param_magnitude": param_mag_log,
-        },
-        os.path.join(experiment_directory, ws.logs_filename),
-    )
-
-
-def load_logs(experiment_directory):
-
-    full_filename = os.path.join(experiment_directory, ws.logs_filename)
-
-    if not os.path.isfile(full_filename):
-        raise Exception('log file "{}" does not exist'.format(full_filename))
-
-    data = torch.load(full_filename)
-
-    return (
-        data["loss"],
-        data["learning_rate"],
-        data["timing"],
-        data["latent_magnitude"],
-        data["param_magnitude"],
-        data["epoch"],
-    )
-
-
-def clip_logs(loss_log, lr_log, timing_log, lat_mag_log, param_mag_log, epoch):
-
-    iters_per_epoch = len(loss_log) // len(lr_log)
-
-    loss_log = loss_log[: (iters_per_epoch * epoch)]
-    lr_log = lr_log[:epoch]
-    timing_log = timing_log[:epoch]
-    lat_mag_log = lat_mag_log[:epoch]
-    for n in param_mag_log:
-        param_mag_log[n] = param_mag_log[n][:epoch]
+def collect_logs(pending_logs, param_names):
+    """
+    Moves the values logged on the device during a log window to the host, with
+    a single transfer per kind of value, and returns the per-epoch log records.
+    """
+    losses = [loss for record in pending_logs for loss in record["loss"]]
+    if len(losses) > 0:
+        losses = distributed.all_reduce_mean(torch.stack(losses)).tolist()
+
+    lat_mags = torch.stack([r["latent_magnitude"] for r in pending_logs]).tolist()
+    param_mags = torch.stack([r["param_magnitude"] for r in pending_logs]).tolist()
+
+    records = []
+    for record, lat_mag, param_mag in zip(pending_logs, lat_mags, param_mags):
+        num_iters = len(record["loss"])
+        records.append(
+            dict(
+                record,
+                loss=losses[:num_iters],
+                latent_magnitude=lat_mag,
+                param_magnitude=dict(zip(param_names, param_mag)),
+            )
+        )
+        losses = losses[num_iters:]
 
-    return (loss_log, lr_log, timing_log, lat_mag_log, param_mag_log)
+    return records
 
 
 def get_spec_with_default(specs, key, default):
@@ -235,20 +230,33 @@ def get_spec_with_default(specs, key, default):
         return default
 
 
-def get_mean_latent_vector_magnitude(latent_vectors):
-    return torch.mean(torch.norm(latent_vectors.weight.data.detach(), dim=1))
-
-
-def append_parameter_magnitudes(param_mag_log, model):
-    for name, param in model.named_parameters():
+def get_parameter_names(model):
+    # as saved in the state dict, which may rename parameters for compatibility
+    parameter_ids = set(id(param) for param in model.parameters())
+    names = []
+    for name, value in model.state_dict(keep_vars=True).items():
+        if id(value) not in parameter_ids:
+            continue
         if len(name) > 7 and name[:7] == "module.":
             name = name[7:]
-        if name not in param_mag_log.keys():
-            param_mag_log[name] = []
-        param_mag_log[name].append(param.data.norm().item())
+        names.append(name)
+    return names
+
+
+def get_parameter_magnitudes(model):
+    return torch.stack([param.detach().norm() for param in model.parameters()])
 
 
-def main_function(experiment_directory, continue_from, batch_split):
+def main_function(
+    experiment_directory,
+    continue_from,
+    batch_split,
+    device=None,
+    profile=None,
+    profile_trace_steps=None,
+    precision=None,
+    compile_mode=None,
+):
 
     logging.debug("running " + experiment_directory)
 
@@ -265,6 +273,26 @@ def main_function(experiment_directory, continue_from, batch_split):
 
     latent_size = specs["CodeLength"]
 
+    device = deep_sdf.get_device(device, specs)
+
+    if distributed.launched_distributed():
+        device = distributed.init_distributed(device)
+        if not distributed.is_main_process():
+            logging.getLogger().setLevel(logging.WARNING)
+
+    world_size = distributed.get_world_size()
+    is_main_process = distributed.is_main_process()
+
+    # the forward pass runs under autocast, the parameters, latent codes and the
+    # loss stay in fp32
+    precision = deep_sdf.get_precision(precision, specs)
+    if precision == "fp16" and device.type != "cuda":
+        raise Exception("fp16 training requires CUDA, use bf16 on the CPU")
+    logging.info("training in {}".format(precision))
+
+    # fp16 gradients underflow without scaling, bf16 has the range of fp32
+    grad_scaler = torch.cuda.amp.GradScaler(enabled=precision == "fp16")
+
     checkpoints = list(
         range(
             specs["SnapshotFrequency"],
@@ -283,20 +311,56 @@ def main_function(experiment_directory, continue_from, batch_split):
     if grad_clip is not None:
         logging.debug("clipping gradients to max norm {}".format(grad_clip))
 
+    # snapshots are copied to CPU memory and written on a background thread
+    checkpoint_writer = None
+    if is_main_process and get_spec_with_default(specs, "AsyncCheckpoints", True):
+        checkpoint_writer = deep_sdf.CheckpointWriter(
+            get_spec_with_default(specs, "CheckpointQueueSize", 2)
+        )
+
+    def save_snapshot(filename, epoch):
+
+        start = time.time()
+
+        # gathering the sharded latent codes is collective, so every rank takes
+        # part, but only the first one writes
+        latent_state = lat_vecs.state_dict()
+        latent_state["weight"] = distributed.gather_shard_rows(
+            latent_state["weight"], num_scenes
+        )
+        optimizer_state = distributed.gather_sharded_optimizer_state(
+            optimizer_all.state_dict(), num_scenes, 1
+        )
+
+        if not is_main_process:
+            return
+
+        save_model(experiment_directory, filename, decoder, epoch, checkpoint_writer)
+        save_optimizer(
+            experiment_directory, filename, optimizer_state, epoch, checkpoint_writer
+        )
+        save_latent_vectors(
+            experiment_directory, filename, latent_state, epoch, checkpoint_writer
+        )
+
+        logging.info(
+            "snapshot {} blocked training for {:.3f}s".format(
+                filename, time.time() - start
+            )
+        )
+
     def save_latest(epoch):
 
-        save_model(experiment_directory, "latest.pth", decoder, epoch)
-        save_optimizer(experiment_directory, "latest.pth", optimizer_all, epoch)
-        save_latent_vectors(experiment_directory, "latest.pth", lat_vecs, epoch)
+        save_snapshot("latest.pth", epoch)
 
     def save_checkpoints(epoch):
 
-        save_model(experiment_directory, str(epoch) + ".pth", decoder, epoch)
-        save_optimizer(experiment_directory, str(epoch) + ".pth", optimizer_all, epoch)
-        save_latent_vectors(experiment_directory, str(epoch) + ".pth", lat_vecs, epoch)
+        save_snapshot(str(epoch) + ".pth", epoch)
 
     def signal_handler(sig, frame):
         logging.info("Stopping early...")
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
         sys.exit(0)
 
     def adjust_learning_rate(lr_schedules, optimizer, epoch):
@@ -305,7 +369,7 @@ def main_function(experiment_directory, continue_from, batch_split):
             param_group["lr"] = lr_schedules[i].get_learning_rate(epoch)
 
     def empirical_stat(latent_vecs, indices):
-        lat_mat = torch.zeros(0).cuda()
+        lat_mat = torch.zeros(0, device=device)
         for ind in indices:
             lat_mat = torch.cat([lat_mat, latent_vecs[ind]], 0)
         mean = torch.mean(lat_mat, 0)
@@ -327,12 +391,39 @@ def main_function(experiment_directory, continue_from, batch_split):
 
     code_bound = get_spec_with_default(specs, "CodeBound", None)
 
-    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).cuda()
+    # project every latent code once per scene instead of once per sample
+    scene_batched = get_spec_with_default(specs, "SceneBatchedDecoding", True)
 
-    logging.info("training with {} GPU(s)".format(torch.cuda.device_count()))
+    if (
+        specs["NetworkSpecs"].get("transformer_attention", None) == "scene"
+        and not scene_batched
+    ):
+        raise Exception(
+            'scene attention requires "SceneBatchedDecoding", or it would attend '
+            + "across scenes"
+        )
 
-    # if torch.cuda.device_count() > 1:
-    decoder = torch.nn.DataParallel(decoder)
+    decoder = arch.Decoder(latent_size, **specs["NetworkSpecs"]).to(device)
+
+    compile_mode = deep_sdf.get_compile_mode(compile_mode, specs)
+    if compile_mode != "none":
+        logging.info("compiling the decoder ({})".format(compile_mode))
+        deep_sdf.compile_decoder(decoder, compile_mode)
+
+    if world_size > 1:
+        logging.info("training with {} processes".format(world_size))
+        decoder = torch.nn.parallel.DistributedDataParallel(
+            decoder,
+            device_ids=[device] if device.type == "cuda" else None,
+            # otherwise the reduction waits for gradients which never come
+            find_unused_parameters=getattr(decoder, "has_unused_parameters", False),
+        )
+    elif device.type == "cuda":
+        logging.info("training with {} GPU(s)".format(torch.cuda.device_count()))
+        if torch.cuda.device_count() > 1:
+            decoder = torch.nn.DataParallel(decoder)
+    else:
+        logging.info("training on {}".format(device))
 
     num_epochs = specs["NumEpochs"]
     log_frequency = get_spec_with_default(specs, "LogFrequency", 10)
@@ -340,32 +431,126 @@ def main_function(experiment_directory, continue_from, batch_split):
     with open(train_split_file, "r") as f:
         train_split = json.load(f)
 
-    sdf_dataset = deep_sdf.data.SDFSamples(
-        data_source, train_split, num_samp_per_scene, load_ram=True, 
-        class_embedding=specs["ClassEmbedding"], use_class_embedding = enable_class_embedding
-    )
-        
+    packed_samples = get_spec_with_default(specs, "PackedSamples", None)
+
     num_data_loader_threads = get_spec_with_default(specs, "DataLoaderThreads", 1)
     logging.debug("loading data with {} threads".format(num_data_loader_threads))
 
-    sdf_loader = data_utils.DataLoader(
-        sdf_dataset,
-        batch_size=scene_per_batch,
-        shuffle=True,
-        num_workers=num_data_loader_threads,
-        drop_last=True,
-        pin_memory=False
-    )
+    if scene_per_batch % world_size != 0:
+        raise Exception(
+            "ScenesPerBatch ({}) is not divisible by the number of processes ({})".format(
+                scene_per_batch, world_size
+            )
+        )
+
+    # reads the packed samples sequentially instead of holding them in memory
+    streaming = get_spec_with_default(specs, "StreamingSamples", False)
+    if streaming and packed_samples is None:
+        raise Exception('"StreamingSamples" requires "PackedSamples"')
+
+    if streaming:
+        sdf_dataset = deep_sdf.data.StreamingSDFSamples(
+            packed_samples,
+            train_split,
+            num_samp_per_scene,
+            scene_per_batch // world_size,
+            pool_size=get_spec_with_default(specs, "StreamingPoolSize", 256),
+            shard_size=get_spec_with_default(specs, "StreamingShardSize", 64),
+            num_workers=num_data_loader_threads,
+            class_embedding=specs["ClassEmbedding"],
+            use_class_embedding=enable_class_embedding,
+            rank=distributed.get_rank(),
+            world_size=world_size,
+        )
+    else:
+        # without loading into RAM, the decoded samples of recently used shapes
+        # can be kept in a cache of bounded size, which is split between the
+        # data loader workers as each of them holds a cache of its own
+        load_ram = get_spec_with_default(specs, "LoadSamplesIntoRam", True)
+        sample_cache_init = deep_sdf.data.SdfSamplesCacheWorkerInit(
+            int(get_spec_with_default(specs, "SampleCacheMegabytes", 0) * 2 ** 20),
+            num_data_loader_threads,
+        )
+
+        sdf_dataset = deep_sdf.data.SDFSamples(
+            data_source, train_split, num_samp_per_scene, load_ram=load_ram, 
+            class_embedding=specs["ClassEmbedding"], use_class_embedding = enable_class_embedding,
+            packed_samples=packed_samples,
+            share_memory=num_data_loader_threads > 0,
+            quantize=get_spec_with_default(specs, "QuantizeSamples", False),
+            contiguous_windows=get_spec_with_default(
+                specs, "ContiguousSubsampling", False
+            ),
+        )
+
+    # every rank draws its scenes from a fixed shard, whose codes it owns
+    scene_sampler = None
+    if world_size > 1 and not streaming:
+        scene_sampler = distributed.SceneShardSampler(sdf_dataset)
+
+    if streaming:
+        # the dataset shards, shuffles and batches the scenes itself
+        sdf_loader = data_utils.DataLoader(
+            sdf_dataset,
+            batch_size=None,
+            num_workers=num_data_loader_threads,
+            pin_memory=False,
+        )
+    elif sdf_dataset.supports_batches():
+        # the dataset draws all scenes of a batch in one gather, so the loader
+        # hands it whole index batches and does not collate
+        sdf_loader = data_utils.DataLoader(
+            sdf_dataset,
+            batch_size=None,
+            sampler=data_utils.BatchSampler(
+                scene_sampler
+                if scene_sampler is not None
+                else data_utils.RandomSampler(sdf_dataset),
+                scene_per_batch // world_size,
+                drop_last=True,
+            ),
+            num_workers=num_data_loader_threads,
+            worker_init_fn=sample_cache_init,
+            pin_memory=False,
+            # the workers keep their window cursors from epoch to epoch
+            persistent_workers=num_data_loader_threads > 0,
+        )
+    else:
+        sdf_loader = data_utils.DataLoader(
+            sdf_dataset,
+            batch_size=scene_per_batch // world_size,
+            shuffle=scene_sampler is None,
+            sampler=scene_sampler,
+            num_workers=num_data_loader_threads,
+            drop_last=True,
+            worker_init_fn=sample_cache_init,
+            pin_memory=False,
+            # the workers keep their sample caches from epoch to epoch
+            persistent_workers=num_data_loader_threads > 0,
+        )
+
+    if not streaming and num_data_loader_threads == 0:
+        # the main process loads the samples itself
+        sample_cache_init(0)
 
     logging.debug("torch num_threads: {}".format(torch.get_num_threads()))
 
     num_scenes = len(sdf_dataset)
 
+    if enable_class_embedding:
+        scene_classes = torch.from_numpy(sdf_dataset.class_indices)
+
     logging.info("There are {} scenes".format(num_scenes))
 
     logging.debug(decoder)
 
-    lat_vecs = torch.nn.Embedding(num_scenes, latent_size, max_norm=code_bound)
+    lat_vecs = torch.nn.Embedding(
+        distributed.get_num_shard_rows(
+            num_scenes, distributed.get_rank(), world_size
+        ),
+        latent_size,
+        max_norm=code_bound,
+    ).to(device)
     torch.nn.init.normal_(
         lat_vecs.weight.data,
         0.0,
@@ -374,7 +559,7 @@ def main_function(experiment_directory, continue_from, batch_split):
 
     logging.debug(
         "initialized with mean magnitude {}".format(
-            get_mean_latent_vector_magnitude(lat_vecs)
+            distributed.get_mean_sharded_latent_magnitude(lat_vecs)
         )
     )
 
@@ -393,11 +578,24 @@ def main_function(experiment_directory, continue_from, batch_split):
         ]
     )
 
-    loss_log = []
-    lr_log = []
-    lat_mag_log = []
-    timing_log = []
-    param_mag_log = {}
+    # per-phase step timings, which synchronize the device and are off by default
+    if profile is None:
+        profile = get_spec_with_default(specs, "ProfileSteps", False)
+    step_profiler = deep_sdf.StepProfiler(device, profile)
+
+    if profile_trace_steps is None:
+        profile_trace_steps = get_spec_with_default(specs, "ProfilerTraceSteps", 0)
+    trace_profiler = None
+    if profile_trace_steps > 0:
+        trace_profiler = deep_sdf.get_trace_profiler(
+            device, ws.get_profiles_dir(experiment_directory, True), profile_trace_steps
+        )
+        trace_profiler.start()
+
+    # the records of the epochs since the logs were last written, holding device
+    # tensors which are only synchronized once per log window
+    pending_logs = []
+    param_names = get_parameter_names(decoder)
 
     start_epoch = 1
 
@@ -417,14 +615,9 @@ def main_function(experiment_directory, continue_from, batch_split):
             experiment_directory, continue_from + ".pth", optimizer_all
         )
 
-        loss_log, lr_log, timing_log, lat_mag_log, param_mag_log, log_epoch = load_logs(
-            experiment_directory
-        )
-
-        if not log_epoch == model_epoch:
-            loss_log, lr_log, timing_log, lat_mag_log, param_mag_log = clip_logs(
-                loss_log, lr_log, timing_log, lat_mag_log, param_mag_log, model_epoch
-            )
+        log_epoch = model_epoch
+        if is_main_process:
+            log_epoch = ws.clip_training_logs(experiment_directory, model_epoch)
 
         if not (model_epoch == optimizer_epoch and model_epoch == lat_epoch):
             raise RuntimeError(
@@ -437,6 +630,11 @@ def main_function(experiment_directory, continue_from, batch_split):
 
         logging.debug("loaded")
 
+    elif is_main_process:
+        # a fresh run starts an empty log rather than appending to the one of an
+        # earlier run in the same experiment directory
+        ws.clip_training_logs(experiment_directory, 0)
+
     logging.info("starting from epoch {}".format(start_epoch))
 
     logging.info(
@@ -446,8 +644,8 @@ def main_function(experiment_directory, continue_from, batch_split):
     )
     logging.info(
         "Number of shape code parameters: {} (# codes {}, code dim {})".format(
-            lat_vecs.num_embeddings * lat_vecs.embedding_dim,
-            lat_vecs.num_embeddings,
+            num_scenes * lat_vecs.embedding_dim,
+            num_scenes,
             lat_vecs.embedding_dim,
         )
     )
@@ -462,88 +660,177 @@ def main_function(experiment_directory, continue_from, batch_split):
 
         adjust_learning_rate(lr_schedules, optimizer_all, epoch)
 
-        
-        for sdf_data, indices in sdf_loader:
+        if scene_sampler is not None:
+            scene_sampler.set_epoch(epoch)
+
+        num_batches = None
+        if streaming:
+            sdf_dataset.set_epoch(epoch)
+            num_batches = sdf_dataset.get_num_batches()
+
+        epoch_losses = []
+
+        step_profiler.begin_epoch()
+
+        for batch_index, (sdf_data, indices) in enumerate(sdf_loader):
+
+            # the streams of the ranks may differ by a batch, keep them in step
+            if num_batches is not None and batch_index >= num_batches:
+                break
+
+            step_profiler.mark("data_wait")
+
             # Process the input data
-            if enable_class_embedding:
-                sdf_data = sdf_data.reshape(-1, 13)
-            else:
-                sdf_data = sdf_data.reshape(-1, 4)
-                
+            sdf_data = sdf_data.reshape(-1, 4)
+
             num_sdf_samples = sdf_data.shape[0]
 
             sdf_data.requires_grad = False
 
-
             xyz = sdf_data[:, 0:3]
             sdf_gt = sdf_data[:, 3].unsqueeze(1)
 
+            # the decoder expands the class of each scene into its class columns
+            classes = None
             if enable_class_embedding:
-                class_embedding = sdf_data[:, 4:14]
-                xyz = torch.cat((xyz, class_embedding), dim=1)
-                
+                classes = scene_classes[indices]
+
             if enforce_minmax:
                 sdf_gt = torch.clamp(sdf_gt, minT, maxT)
 
-            xyz = torch.chunk(xyz, batch_split)
-            indices = torch.chunk(
-                indices.unsqueeze(-1).repeat(1, num_samp_per_scene).view(-1),
-                batch_split,
-            )
+            if scene_batched:
+                xyz = torch.chunk(
+                    xyz.view(-1, num_samp_per_scene, xyz.shape[1]), batch_split
+                )
+                indices = torch.chunk(indices, batch_split)
+                if classes is not None:
+                    classes = torch.chunk(classes, batch_split)
+
+                sdf_gt = torch.chunk(
+                    sdf_gt.view(-1, num_samp_per_scene, 1), batch_split
+                )
+            else:
+                xyz = torch.chunk(xyz, batch_split)
+                indices = torch.chunk(
+                    indices.unsqueeze(-1).repeat(1, num_samp_per_scene).view(-1),
+                    batch_split,
+                )
+                if classes is not None:
+                    classes = torch.chunk(
+                        classes.unsqueeze(-1).repeat(1, num_samp_per_scene).view(-1),
+                        batch_split,
+                    )
+
+                sdf_gt = torch.chunk(sdf_gt, batch_split)
+
+            xyz = [x.to(device) for x in xyz]
+            sdf_gt = [sdf.to(device) for sdf in sdf_gt]
+            indices = [
+                distributed.get_shard_rows(ind, world_size).to(device)
+                for ind in indices
+            ]
+            if classes is not None:
+                classes = [c.to(device) for c in classes]
+            else:
+                classes = [None] * len(xyz)
 
-            sdf_gt = torch.chunk(sdf_gt, batch_split)
+            step_profiler.mark("h2d")
 
             batch_loss = 0.0
 
             optimizer_all.zero_grad()
 
-            for i in range(batch_split):
+            for i in range(len(xyz)):
 
-                batch_vecs = lat_vecs(indices[i])
+                # the decoder gradients are only averaged across ranks on the
+                # last subbatch. DDP decides this in the forward pass, so both
+                # passes run in no_sync.
+                if world_size > 1 and i < len(xyz) - 1:
+                    sync_context = decoder.no_sync()
+                else:
+                    sync_context = contextlib.nullcontext()
 
-                input = torch.cat([batch_vecs, xyz[i]], dim=1)
+                with sync_context:
+                    batch_vecs = lat_vecs(indices[i])
 
-                # NN optimization
-                pred_sdf = decoder(input)
+                    # NN optimization
+                    with deep_sdf.autocast(device, precision):
+                        if scene_batched:
+                            pred_sdf = decoder(batch_vecs, xyz[i], classes[i])
+                        else:
+                            input = torch.cat([batch_vecs, xyz[i]], dim=1)
 
-                if enforce_minmax:
-                    pred_sdf = torch.clamp(pred_sdf, minT, maxT)
+                            pred_sdf = decoder(input, classes=classes[i])
 
-                chunk_loss = loss_l1(pred_sdf, sdf_gt[i].cuda()) / num_sdf_samples
+                    pred_sdf = pred_sdf.float()
 
-                if do_code_regularization:
-                    l2_size_loss = torch.sum(torch.norm(batch_vecs, dim=1))
-                    reg_loss = (
-                        code_reg_lambda * min(1, epoch / 100) * l2_size_loss
-                    ) / num_sdf_samples
+                    if enforce_minmax:
+                        pred_sdf = torch.clamp(pred_sdf, minT, maxT)
 
-                    chunk_loss = chunk_loss + reg_loss.cuda()
+                    chunk_loss = loss_l1(pred_sdf, sdf_gt[i]) / num_sdf_samples
 
-                chunk_loss.backward()
+                    if do_code_regularization:
+                        l2_size_loss = torch.sum(torch.norm(batch_vecs, dim=1))
+                        if scene_batched:
+                            l2_size_loss = l2_size_loss * num_samp_per_scene
+                        reg_loss = (
+                            code_reg_lambda * min(1, epoch / 100) * l2_size_loss
+                        ) / num_sdf_samples
 
-                batch_loss += chunk_loss.item()
+                        chunk_loss = chunk_loss + reg_loss
 
-            logging.debug("loss = {}".format(batch_loss))
+                    step_profiler.mark("forward")
 
-            loss_log.append(batch_loss)
+                    grad_scaler.scale(chunk_loss).backward()
+
+                    batch_loss = batch_loss + chunk_loss.detach()
+
+                step_profiler.mark("backward")
+
+            epoch_losses.append(batch_loss)
 
             if grad_clip is not None:
 
+                grad_scaler.unscale_(optimizer_all)
                 torch.nn.utils.clip_grad_norm_(decoder.parameters(), grad_clip)
 
-            optimizer_all.step()
+            if world_size > 1:
+                # each rank's loss is normalized by its share of the batch only
+                lat_vecs.weight.grad.div_(world_size)
+
+            # skips the step if the scaled fp16 gradients overflowed
+            grad_scaler.step(optimizer_all)
+            grad_scaler.update()
+
+            step_profiler.mark("optimizer")
+            step_profiler.end_step(num_sdf_samples)
+
+            if trace_profiler is not None:
+                trace_profiler.step()
 
         end = time.time()
 
         seconds_elapsed = end - start
-        timing_log.append(seconds_elapsed)
         logging.info(f"Time: {seconds_elapsed}s")
 
-        lr_log.append([schedule.get_learning_rate(epoch) for schedule in lr_schedules])
-
-        lat_mag_log.append(get_mean_latent_vector_magnitude(lat_vecs))
+        pending_logs.append(
+            {
+                "epoch": epoch,
+                "loss": epoch_losses,
+                "learning_rate": [
+                    schedule.get_learning_rate(epoch) for schedule in lr_schedules
+                ],
+                "timing": seconds_elapsed,
+                "latent_magnitude": distributed.get_mean_sharded_latent_magnitude(
+                    lat_vecs
+                ),
+                "param_magnitude": get_parameter_magnitudes(decoder),
+            }
+        )
 
-        append_parameter_magnitudes(param_mag_log, decoder)
+        step_summary = step_profiler.summarize_epoch()
+        if step_summary is not None:
+            pending_logs[-1]["step_profile"] = step_summary
 
         if epoch in checkpoints:
             save_checkpoints(epoch)
@@ -551,15 +838,50 @@ def main_function(experiment_directory, continue_from, batch_split):
         if epoch % log_frequency == 0:
 
             save_latest(epoch)
-            save_logs(
-                experiment_directory,
-                loss_log,
-                lr_log,
-                timing_log,
-                lat_mag_log,
-                param_mag_log,
-                epoch,
+
+            if not streaming:
+                deep_sdf.data.log_sdf_samples_cache_stats(sample_cache_init)
+
+            # only appends the new epochs, so the cost does not grow with the run
+            epoch_logs = collect_logs(pending_logs, param_names)
+            pending_logs = []
+            logging.debug(
+                "loss = {}".format(
+                    sum(sum(r["loss"]) for r in epoch_logs)
+                    / max(sum(len(r["loss"]) for r in epoch_logs), 1)
+                )
+            )
+            if is_main_process:
+                ws.append_training_logs(experiment_directory, epoch_logs)
+
+    if trace_profiler is not None:
+        trace_profiler.stop()
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+        logging.info(
+            "checkpoint writes blocked training for {:.3f}s in total".format(
+                checkpoint_writer.blocked_seconds
             )
+        )
+
+    distributed.cleanup_distributed()
+
+
+def run_training(args):
+
+    deep_sdf.configure_logging(args)
+
+    main_function(
+        args.experiment_directory,
+        args.continue_from,
+        int(args.batch_split),
+        args.device,
+        args.profile,
+        args.profile_trace_steps,
+        args.precision,
+        args.compile,
+    )
 
 
 if __name__ == "__main__":
@@ -594,10 +916,44 @@ if __name__ == "__main__":
         + "sizes in memory constrained environments.",
     )
 
+    arg_parser.add_argument(
+        "--profile",
+        dest="profile",
+        default=None,
+        action="store_true",
+        help="If set, the time every training step spends waiting for data, copying "
+        + "it to the device, in the forward and backward passes and in the optimizer "
+        + "is measured. This synchronizes the device after every phase. Overrides "
+        + '"ProfileSteps" in the specifications.',
+    )
+    arg_parser.add_argument(
+        "--profile_trace",
+        dest="profile_trace_steps",
+        default=None,
+        type=int,
+        help="If set, this many training steps are traced with torch.profiler, "
+        + "after skipping the first few, and the trace is written to the Profiles "
+        + 'subdirectory of the experiment. Overrides "ProfilerTraceSteps" in the '
+        + "specifications.",
+    )
+    arg_parser.add_argument(
+        "--nprocs",
+        dest="nprocs",
+        default=1,
+        type=int,
+        help="The number of local processes to train with, using "
+        + "DistributedDataParallel. Each process holds the latent codes of its "
+        + "share of the scenes. Multi-node jobs are launched with torchrun instead.",
+    )
+
+    deep_sdf.add_device_args(arg_parser)
+    deep_sdf.add_precision_args(arg_parser)
+    deep_sdf.add_compile_args(arg_parser)
     deep_sdf.add_common_args(arg_parser)
 
     args = arg_parser.parse_args()
 
-    deep_sdf.configure_logging(args)
-
-    main_function(args.experiment_directory, args.continue_from, int(args.batch_split))
+    if args.nprocs > 1:
+        distributed.spawn_distributed(run_training, (args,), args.nprocs)
+    else:
+        run_training(args)